@@ -12,6 +12,8 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import atexit
+import collections
 import json
 import os
 
@@ -21,12 +23,32 @@ from slackclient import SlackClient
 from watson_developer_cloud import ConversationV1
 from watson_developer_cloud import DiscoveryV1
 
+from watsononlinestore.database.cart_journal import CartJournal
+from watsononlinestore.database.cart_journal import WriteBehindOnlineStore
+from watsononlinestore.database.changes_feed import CachingOnlineStore
+from watsononlinestore.database.changes_feed import ChangesFeed
 from watsononlinestore.database.cloudant_online_store import \
     CloudantOnlineStore
+from watsononlinestore.database.session_snapshots import SessionSnapshots
+from watsononlinestore.database.sqlite_online_store import \
+    SQLiteOnlineStore
+from watsononlinestore import admin
+from watsononlinestore import logs
+from watsononlinestore import memory
+from watsononlinestore import profiling
+from watsononlinestore.admission import AdmissionController
+from watsononlinestore.catalog.similar import SimilarProducts
+from watsononlinestore import sharding
+from watsononlinestore import slack_events
+from watsononlinestore import tenants
+from watsononlinestore.runtime_config import ConfigWatcher
+from watsononlinestore.slack_outbox import SlackOutbox
 from watsononlinestore.watson_online_store import WatsonOnlineStore
 
 
 MISSING_ENV_VARS = "ERROR: Required environment variables are not set."
+STORE_BACKENDS = ('cloudant', 'sqlite')
+SLACK_INGESTION_MODES = ('rtm', 'events')
 
 
 class WatsonEnv:
@@ -44,14 +66,14 @@ class WatsonEnv:
                     return first['credentials']
 
     @staticmethod
-    def get_slack_user_id(slack_client):
+    def get_slack_user_id(slack_client, environ=os.environ):
         """Get slack bot user ID from SLACK_BOT_USER or BOT_ID env vars.
 
         Use the original BOT_ID if found, but now we can instead take the
         SLACK_BOT_USER (familiar bot name) and look-up the ID.
         This should be called after env is loaded when using dotenv.
         """
-        slack_bot_user = os.environ.get('SLACK_BOT_USER')
+        slack_bot_user = environ.get('SLACK_BOT_USER')
         print("Looking up BOT_ID for '%s'" % slack_bot_user)
 
         api_call = slack_client.api_call("users.list")
@@ -70,35 +92,110 @@ class WatsonEnv:
         return None
 
     @staticmethod
-    def get_watson_online_store():
+    def load_env():
         load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
 
+    @staticmethod
+    def get_slack_client(environ):
+        """SlackClient for SLACK_BOT_TOKEN, or None if it is not set."""
+        slack_bot_token = environ.get('SLACK_BOT_TOKEN')
+        if not slack_bot_token:
+            return None
+        if 'placeholder' in slack_bot_token:
+            raise Exception("SLACK_BOT_TOKEN needs to be set correctly. "
+                            "It is currently set to 'placeholder'.")
+        return SlackClient(slack_bot_token)
+
+    @staticmethod
+    def get_shard_store(index):
+        """Build the bot of worker process index.
+
+        Its local files are named for it (see sharding.shard_environ).
+        """
+        WatsonEnv.load_env()
+        watsononlinestore = WatsonEnv.get_watson_online_store(
+            sharding.shard_environ(os.environ, index))
+        if watsononlinestore is None:
+            raise Exception("Worker %d is not fully configured." % index)
+        return watsononlinestore
+
+    @staticmethod
+    def get_tenant_stores(tenants_path):
+        """Build one bot per tenant listed in tenants_path.
+
+        Each tenant's settings override the environment's for its bot.
+        Returns - OrderedDict of tenant name to WatsonOnlineStore
+        """
+        WatsonEnv.load_env()
+        shared = tenants.SharedResources()
+        environs = []
+        for name, settings in tenants.load_tenants(tenants_path):
+            environ = dict(os.environ)
+            environ.update(settings)
+            environs.append((name, environ))
+        tenants.check_separate_files(environs)
+        stores = collections.OrderedDict()
+        for name, environ in environs:
+            watsononlinestore = WatsonEnv.get_watson_online_store(environ,
+                                                                  shared)
+            if watsononlinestore is None:
+                raise Exception("Tenant %s is not fully configured." % name)
+            watsononlinestore.tenant = name
+            stores[name] = watsononlinestore
+        return stores
+
+    @staticmethod
+    def get_watson_online_store(environ=None, shared=None):
+        """Build the bot from environ (default: .env and os.environ).
+
+        Clients built from the same credentials come from shared, a
+        tenants.SharedResources, when one process hosts several tenants.
+        """
+        if environ is None:
+            WatsonEnv.load_env()
+            environ = os.environ
+        shared = shared or tenants.SharedResources()
+
         # Use these env vars first if set
-        bot_id = os.environ.get("BOT_ID")
-        slack_bot_token = os.environ.get('SLACK_BOT_TOKEN')
-        conversation_username = os.environ.get("CONVERSATION_USERNAME")
-        conversation_password = os.environ.get("CONVERSATION_PASSWORD")
-        cloudant_username = os.environ.get("CLOUDANT_USERNAME")
-        cloudant_password = os.environ.get("CLOUDANT_PASSWORD")
-        cloudant_url = os.environ.get("CLOUDANT_URL")
-        cloudant_db_name = os.environ.get("CLOUDANT_DB_NAME")
+        bot_id = environ.get("BOT_ID")
+        slack_bot_token = environ.get('SLACK_BOT_TOKEN')
+        conversation_username = environ.get("CONVERSATION_USERNAME")
+        conversation_password = environ.get("CONVERSATION_PASSWORD")
+        cloudant_username = environ.get("CLOUDANT_USERNAME")
+        cloudant_password = environ.get("CLOUDANT_PASSWORD")
+        cloudant_url = environ.get("CLOUDANT_URL")
+        cloudant_db_name = environ.get("CLOUDANT_DB_NAME")
+        # Use Cloudant unless configured to use the embedded SQLite store.
+        store_backend = environ.get("STORE_BACKEND", "cloudant").lower()
+        sqlite_db_path = environ.get("SQLITE_DB_PATH",
+                                     tenants.DEFAULT_SQLITE_DB_PATH)
+        if store_backend not in STORE_BACKENDS:
+            print("Error: STORE_BACKEND must be one of: %s" %
+                  ", ".join(STORE_BACKENDS))
+            return None
+        use_cloudant = store_backend == 'cloudant'
+        # Optional local journal so cart updates don't wait for the store.
+        cart_journal_path = environ.get("CART_JOURNAL_PATH")
+        # Optional in-process customer and cart cache, kept coherent with
+        # other replicas by following Cloudant's _changes feed.
+        store_cache = environ.get("STORE_CACHE", "false").lower() == "true"
 
         # TODO: It looks like we'll want to make discovery required too.
-        discovery_username = os.environ.get('DISCOVERY_USERNAME')
-        discovery_password = os.environ.get('DISCOVERY_PASSWORD')
-        discovery_environment_id = os.environ.get('DISCOVERY_ENVIRONMENT_ID')
-        discovery_collection_id = os.environ.get('DISCOVERY_COLLECTION_ID')
+        discovery_username = environ.get('DISCOVERY_USERNAME')
+        discovery_password = environ.get('DISCOVERY_PASSWORD')
+        discovery_environment_id = environ.get('DISCOVERY_ENVIRONMENT_ID')
+        discovery_collection_id = environ.get('DISCOVERY_COLLECTION_ID')
 
         if not all((conversation_username,
                     conversation_password,
-                    cloudant_username,
-                    cloudant_password,
-                    cloudant_url,
+                    cloudant_username or not use_cloudant,
+                    cloudant_password or not use_cloudant,
+                    cloudant_url or not use_cloudant,
                     discovery_username,
                     discovery_password)):
             # If some of the service env vars are not set get them from VCAP
             vcap_env = None
-            vcap_services = os.environ.get("VCAP_SERVICES")
+            vcap_services = environ.get("VCAP_SERVICES")
             if vcap_services:
                 vcap_env = json.loads(vcap_services)
             if vcap_env:
@@ -109,13 +206,14 @@ class WatsonEnv:
                 conversation_password = \
                     conversation_password or conversation_creds['password']
 
-                cloudant_creds = WatsonEnv.get_vcap_credentials(
-                    vcap_env, 'cloudantNoSQLDB')
-                cloudant_username = \
-                    cloudant_username or cloudant_creds['username']
-                cloudant_password = \
-                    cloudant_password or cloudant_creds['password']
-                cloudant_url = cloudant_url or cloudant_creds['url']
+                if use_cloudant:
+                    cloudant_creds = WatsonEnv.get_vcap_credentials(
+                        vcap_env, 'cloudantNoSQLDB')
+                    cloudant_username = \
+                        cloudant_username or cloudant_creds['username']
+                    cloudant_password = \
+                        cloudant_password or cloudant_creds['password']
+                    cloudant_url = cloudant_url or cloudant_creds['url']
 
                 discovery_creds = WatsonEnv.get_vcap_credentials(
                     vcap_env, 'discovery')
@@ -127,39 +225,60 @@ class WatsonEnv:
         # If we still don't have all the above plus a few, then no WOS.
         if not all((slack_bot_token,
                     conversation_username,
-                    conversation_password,
-                    cloudant_username,
-                    cloudant_password,
-                    cloudant_url,
-                    cloudant_db_name)):
+                    conversation_password)):
+            print(MISSING_ENV_VARS)
+            return None
+        if use_cloudant and not all((cloudant_username,
+                                     cloudant_password,
+                                     cloudant_url,
+                                     cloudant_db_name)):
             print(MISSING_ENV_VARS)
             return None
 
-        if 'placeholder' in slack_bot_token:
-            raise Exception("SLACK_BOT_TOKEN needs to be set correctly. "
-                            "It is currently set to 'placeholder'.")
-        slack_client = SlackClient(slack_bot_token)
+        slack_client = WatsonEnv.get_slack_client(environ)
         # If BOT_ID wasn't set, we can get it using SlackClient and user ID.
         if not bot_id:
-            bot_id = WatsonEnv.get_slack_user_id(slack_client)
+            bot_id = WatsonEnv.get_slack_user_id(slack_client, environ)
             if not bot_id:
                 print("Error: Missing BOT_ID or invalid SLACK_BOT_USER.")
                 return None
 
-        conversation_client = ConversationV1(
-            username=conversation_username,
-            password=conversation_password,
-            version='2016-07-11')
-
-        cloudant_online_store = CloudantOnlineStore(
-            Cloudant(
-                cloudant_username,
-                cloudant_password,
-                url=cloudant_url,
-                connect=True
-            ),
-            cloudant_db_name
-        )
+        # Tenants with the same credentials share one client. Cloudant
+        # clients are not shared: the store connects and disconnects its
+        # client around every operation.
+        conversation_client = shared.get(
+            ('conversation', conversation_username, conversation_password),
+            lambda: ConversationV1(
+                username=conversation_username,
+                password=conversation_password,
+                version='2016-07-11'))
+
+        if use_cloudant:
+            online_store = CloudantOnlineStore(
+                Cloudant(
+                    cloudant_username,
+                    cloudant_password,
+                    url=cloudant_url,
+                    connect=True
+                ),
+                cloudant_db_name
+            )
+            if store_cache:
+                online_store = CachingOnlineStore(
+                    online_store,
+                    ChangesFeed(cloudant_url, cloudant_db_name,
+                                cloudant_username, cloudant_password,
+                                environ.get(
+                                    "CHANGES_CHECKPOINT_PATH",
+                                    tenants.DEFAULT_CHANGES_CHECKPOINT_PATH)))
+        else:
+            online_store = SQLiteOnlineStore(sqlite_db_path)
+            if store_cache:
+                # Only this process writes an embedded database.
+                online_store = CachingOnlineStore(online_store)
+        if cart_journal_path:
+            online_store = WriteBehindOnlineStore(
+                online_store, CartJournal(cart_journal_path))
         #
         # Init Watson Discovery only if all the env vars are set.
         #
@@ -168,19 +287,178 @@ class WatsonEnv:
                 discovery_password,
                 discovery_environment_id,
                 discovery_collection_id)):
-            discovery_client = DiscoveryV1(
-                version='2016-11-07',
-                username=discovery_username,
-                password=discovery_password)
+            discovery_client = shared.get(
+                ('discovery', discovery_username, discovery_password),
+                lambda: DiscoveryV1(
+                    version='2016-11-07',
+                    username=discovery_username,
+                    password=discovery_password))
+        # Post to Slack from a background queue unless SLACK_OUTBOX=false.
+        slack_outbox = None
+        if environ.get('SLACK_OUTBOX', 'true').lower() != 'false':
+            slack_outbox = SlackOutbox(
+                slack_client,
+                rate=float(environ.get('SLACK_OUTBOX_RATE', 1.0)))
         watsononlinestore = WatsonOnlineStore(bot_id,
                                               slack_client,
                                               conversation_client,
                                               discovery_client,
-                                              cloudant_online_store)
+                                              online_store,
+                                              slack_outbox,
+                                              environ)
+        # Bound and merge inbound messages unless ADMISSION=false.
+        if environ.get('ADMISSION', 'true').lower() != 'false':
+            watsononlinestore.admission = AdmissionController(
+                watsononlinestore,
+                per_user_limit=int(environ.get(
+                    'ADMISSION_PER_USER_LIMIT', 3)),
+                global_limit=int(environ.get(
+                    'ADMISSION_GLOBAL_LIMIT', 100)),
+                debounce=float(environ.get('ADMISSION_DEBOUNCE', 0)))
+        # Suggest related products from python -m tools.build_similar_products
+        similar_products_path = environ.get('SIMILAR_PRODUCTS_PATH')
+        if similar_products_path:
+            watsononlinestore.similar_products = shared.get(
+                ('similar_products', similar_products_path),
+                lambda: SimilarProducts(similar_products_path))
+        # Sampling profiles to PROFILE_DIR, toggled by SIGUSR2 or
+        # /admin/profile; slow messages are profiled automatically.
+        profile_dir = environ.get('PROFILE_DIR')
+        if profile_dir:
+            slow_message = environ.get('PROFILE_SLOW_MESSAGE')
+
+            def make_profiler():
+                profiler = profiling.Profiler(
+                    profile_dir,
+                    interval=float(environ.get(
+                        'PROFILE_INTERVAL', profiling.DEFAULT_INTERVAL)),
+                    slow_message=float(slow_message) if slow_message
+                    else None)
+                # Runs in each worker process too, for its own profiler.
+                profiling.install_signal(profiler)
+                return profiler
+            # It samples every thread, so one per process serves all
+            # tenants.
+            watsononlinestore.profiler = shared.get('profiler',
+                                                    make_profiler)
+        # tracemalloc diagnostics for /admin/memory; slows every allocation.
+        if environ.get('MEMORY_DIAGNOSTICS', 'false').lower() == 'true':
+            watsononlinestore.memory_tracker = memory.MemoryTracker(
+                watsononlinestore,
+                interval=float(environ.get(
+                    'MEMORY_SAMPLE_INTERVAL', memory.DEFAULT_INTERVAL)))
+        # Keep dialog state across restarts if SESSION_SNAPSHOT_PATH is set.
+        session_snapshot_path = environ.get('SESSION_SNAPSHOT_PATH')
+        if session_snapshot_path:
+            watsononlinestore.session_snapshots = SessionSnapshots(
+                session_snapshot_path,
+                interval=float(environ.get(
+                    'SESSION_SNAPSHOT_INTERVAL', 5)))
+        # Reload data/workspace.json and CONFIG_PATH when they change.
+        if environ.get('WATCH_CONFIG', 'false').lower() == 'true':
+            watsononlinestore.config_watcher = ConfigWatcher(
+                watsononlinestore,
+                config_path=environ.get('CONFIG_PATH'),
+                interval=float(environ.get('WATCH_CONFIG_INTERVAL', 2)))
         return watsononlinestore
 
 
 if __name__ == "__main__":
-    watsononlinestore = WatsonEnv.get_watson_online_store()
+    # Log records are written by a background thread; see logs.configure.
+    async_logging = logs.configure()
+    if async_logging:
+        atexit.register(async_logging.stop)
+
+    WatsonEnv.load_env()
+    worker_processes = int(os.environ.get('WORKER_PROCESSES', 1))
+    # With TENANTS_PATH, one process serves several Slack teams.
+    tenants_path = os.environ.get('TENANTS_PATH')
+    watsononlinestore = None
+    router = tenant_router = None
+    if tenants_path:
+        if worker_processes > 1:
+            raise Exception("WORKER_PROCESSES must be 1 when TENANTS_PATH "
+                            "is set.")
+        tenant_router = tenants.TenantRouter(
+            WatsonEnv.get_tenant_stores(tenants_path))
+    elif worker_processes > 1:
+        # Slack users are spread over that many bot processes, each
+        # building its own clients and writing its own local files.
+        tenants.check_separate_files(
+            [('wos-worker-%d' % index,
+              sharding.shard_environ(os.environ, index))
+             for index in range(worker_processes)])
+        router = sharding.ShardRouter(
+            WatsonEnv.get_shard_store, worker_processes,
+            idle_timeout=float(os.environ.get(
+                'WORKER_IDLE_TIMEOUT', sharding.DEFAULT_IDLE_TIMEOUT)))
+    else:
+        watsononlinestore = WatsonEnv.get_watson_online_store()
+
+    # Metrics (and other diagnostics) for operators, on localhost only
+    # unless ADMIN_HOST says otherwise.
+    admin_port = os.environ.get('ADMIN_PORT')
+    if admin_port:
+        admin_app = admin.AdminApp(os.environ.get('ADMIN_TOKEN'))
+        if router:
+            # Bot metrics are recorded in the workers, not in this process.
+            admin_app.route('/admin/metrics',
+                            lambda environ: router.metrics_snapshot())
+            admin_app.route('/admin/profile',
+                            lambda environ: router.profile(
+                                profiling.action_from(environ)))
+            admin_app.route('/admin/memory',
+                            lambda environ: router.memory_report(
+                                memory.top_from(environ)))
+        elif tenant_router:
+            admin_app.route('/admin/tenants',
+                            lambda environ: tenant_router.metrics_by_tenant())
+            admin_app.route('/admin/memory',
+                            lambda environ: dict(
+                                (name, memory.report(
+                                    wos, memory.top_from(environ)))
+                                for name, wos in
+                                tenant_router.tenants.items()))
+            # One profiler serves every tenant of the process.
+            profiler = list(tenant_router.tenants.values())[0].profiler
+            if profiler:
+                admin_app.route('/admin/profile',
+                                lambda environ: profiler.control(
+                                    profiling.action_from(environ)))
+        else:
+            admin_app.route('/admin/memory',
+                            lambda environ: memory.report(
+                                watsononlinestore, memory.top_from(environ)))
+            if watsononlinestore.profiler:
+                admin_app.route(
+                    '/admin/profile',
+                    lambda environ: watsononlinestore.profiler.control(
+                        profiling.action_from(environ)))
+        admin.serve_admin(admin_app,
+                          host=os.environ.get('ADMIN_HOST', '127.0.0.1'),
+                          port=int(admin_port))
 
-    watsononlinestore.run()
+    # RTM polls one websocket; the Events API receives HTTP webhooks and
+    # can run as several replicas behind a load balancer.
+    slack_ingestion = os.environ.get('SLACK_INGESTION', 'rtm').lower()
+    if slack_ingestion not in SLACK_INGESTION_MODES:
+        raise Exception("SLACK_INGESTION must be one of: %s" %
+                        ", ".join(SLACK_INGESTION_MODES))
+    if slack_ingestion == 'events':
+        signing_secret = os.environ.get('SLACK_SIGNING_SECRET')
+        if not signing_secret:
+            raise Exception("SLACK_SIGNING_SECRET is required when "
+                            "SLACK_INGESTION=events.")
+        slack_events.serve_events(router or tenant_router or watsononlinestore,
+                                  signing_secret,
+                                  port=int(os.environ.get('PORT', 3000)))
+    elif router:
+        # This process only reads RTM; the workers do the rest.
+        slack_client = WatsonEnv.get_slack_client(os.environ)
+        if slack_client is None:
+            raise Exception(MISSING_ENV_VARS)
+        router.run(slack_client)
+    elif tenant_router:
+        tenant_router.run()
+    else:
+        watsononlinestore.run()
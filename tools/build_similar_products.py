@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+"""Precompute the most similar products for every product in the catalog.
+
+Reads the JSON documents written by preprocess_ibm_store.py and writes the
+file the bot loads from SIMILAR_PRODUCTS_PATH. Install NumPy to build
+large catalogs quickly.
+
+Run from the repository root: python -m tools.build_similar_products
+"""
+import argparse
+import logging
+import os
+
+from watsononlinestore.catalog import similar
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'data')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--docs',
+                        default=os.path.join(DATA_DIR, 'ibm_store_docs'),
+                        help='directory of product documents')
+    parser.add_argument('--out',
+                        default=os.path.join(DATA_DIR,
+                                             'similar_products.bin'),
+                        help='file to write')
+    parser.add_argument('--top-k', type=int, default=similar.DEFAULT_TOP_K,
+                        help='similar products kept per product')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    similar.build(args.docs, args.out, k=args.top_k)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""Maintain the shopping cart docs in Cloudant.
+
+Shopping carts used to be embedded in customer docs as lists of
+'name: url' strings. The bot splits a cart into its own doc (and converts
+it) the first time it is used; run this to migrate every customer at once.
+
+Optionally archive cart entries older than a number of days into cold
+cart_archive docs, and report the size of the docs read on every turn.
+
+Run from the repository root: python -m tools.migrate_shopping_carts
+"""
+import argparse
+import json
+import os
+
+from cloudant.client import Cloudant
+from dotenv import load_dotenv
+
+from watsononlinestore.database.cloudant_online_store import \
+    CloudantOnlineStore
+
+DAY = 24 * 60 * 60
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--archive-older-than', type=float, metavar='DAYS',
+                        help='archive cart entries added before this')
+    parser.add_argument('--report', action='store_true',
+                        help='print the size of customer and cart docs')
+    args = parser.parse_args()
+
+    load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+    store = CloudantOnlineStore(
+        Cloudant(os.environ.get('CLOUDANT_USERNAME'),
+                 os.environ.get('CLOUDANT_PASSWORD'),
+                 url=os.environ.get('CLOUDANT_URL'),
+                 connect=True),
+        os.environ.get('CLOUDANT_DB_NAME'))
+    print("Migrated %d shopping carts." % store.migrate_shopping_carts())
+    if args.archive_older_than is not None:
+        print("Archived %d cart entries." % store.archive_shopping_carts(
+            args.archive_older_than * DAY))
+    if args.report:
+        print(json.dumps(store.hot_document_sizes(), indent=2,
+                         sort_keys=True))
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+"""Convert IBM Logo Store pages into compact JSON documents for Discovery.
+
+Reads the pages fetched by get_data_ibm_store.py (using its manifest.json)
+or any directory of store pages with Product:/Category: markers, such as
+data/ibm_store_html.
+
+Run from the repository root: python -m tools.preprocess_ibm_store
+"""
+import argparse
+import json
+import logging
+import os
+
+from watsononlinestore.catalog import preprocess
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'data')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages',
+                        default=os.path.join(DATA_DIR, 'ibm_store_html'),
+                        help='directory of product pages')
+    parser.add_argument('--out-dir',
+                        default=os.path.join(DATA_DIR, 'ibm_store_docs'),
+                        help='directory for the JSON documents')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='parser processes (default: one per CPU)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    jobs = preprocess.find_pages(args.pages)
+    counts = preprocess.preprocess(jobs, args.out_dir,
+                                   processes=args.processes)
+    print(json.dumps(counts, sort_keys=True))
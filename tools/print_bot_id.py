@@ -3,7 +3,6 @@ import logging
 import os
 from slackclient import SlackClient
 
-logging.basicConfig(level=logging.DEBUG)
 LOG = logging.getLogger(__name__)
 
 BOT_NAME = "wos"
@@ -11,6 +10,7 @@ BOT_NAME = "wos"
 slack_client = SlackClient(os.environ.get('SLACK_BOT_TOKEN'))
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
     api_call = slack_client.api_call("users.list")
     if api_call.get('ok'):
         # retrieve all users so we can find our bot
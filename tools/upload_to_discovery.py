@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""Upload the store documents to the Watson Discovery collection.
+
+Uses DISCOVERY_USERNAME, DISCOVERY_PASSWORD, DISCOVERY_ENVIRONMENT_ID and
+DISCOVERY_COLLECTION_ID from .env. Documents already in the collection
+with the same content are skipped, so an interrupted upload can simply be
+run again.
+
+Run from the repository root: python -m tools.upload_to_discovery
+"""
+import argparse
+import json
+import logging
+import os
+
+from dotenv import load_dotenv
+
+from watsononlinestore.catalog import uploader
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), '..')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--docs',
+                        default=os.path.join(ROOT_DIR, 'data',
+                                             'ibm_store_docs'),
+                        help='directory of .json or .html documents')
+    parser.add_argument('--checkpoint',
+                        default=os.path.join(ROOT_DIR,
+                                             'discovery_upload.json'),
+                        help='file recording what has been uploaded')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='most uploads in flight at the same time')
+    args = parser.parse_args()
+
+    load_dotenv(os.path.join(ROOT_DIR, '.env'))
+    logging.basicConfig(level=logging.INFO)
+    upload = uploader.Uploader(
+        os.environ.get('DISCOVERY_ENVIRONMENT_ID'),
+        os.environ.get('DISCOVERY_COLLECTION_ID'),
+        os.environ.get('DISCOVERY_USERNAME'),
+        os.environ.get('DISCOVERY_PASSWORD'),
+        args.checkpoint,
+        url=os.environ.get('DISCOVERY_URL', uploader.DISCOVERY_URL),
+        workers=args.workers)
+    counts = upload.upload(uploader.find_documents(args.docs))
+    print(json.dumps(counts, sort_keys=True))
@@ -0,0 +1,88 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Operator HTTP endpoints (metrics and diagnostics), served as JSON."""
+
+import hmac
+import json
+import logging
+import threading
+from wsgiref.simple_server import make_server
+
+from watsononlinestore.metrics import METRICS
+from watsononlinestore.slack_events import QuietHandler
+from watsononlinestore.slack_events import ThreadingWSGIServer
+
+LOG = logging.getLogger(__name__)
+
+
+def metrics_snapshot(environ):
+    return METRICS.snapshot()
+
+
+class AdminApp(object):
+
+    def __init__(self, token=None):
+        """
+        WSGI app for /admin/ endpoints.
+
+        :param token: If set, requests need "Authorization: Bearer <token>"
+        """
+        self.token = token
+        self.routes = {'/admin/metrics': metrics_snapshot}
+
+    def route(self, path, handler):
+        """
+        Serves handler(environ) at path. handler returns a JSON-encodable
+        value, or raises ValueError for a bad request.
+        """
+        self.routes[path] = handler
+
+    def _authorized(self, environ):
+        if not self.token:
+            return True
+        expected = 'Bearer ' + self.token
+        supplied = environ.get('HTTP_AUTHORIZATION', '')
+        return hmac.compare_digest(expected.encode('utf-8'),
+                                   supplied.encode('utf-8'))
+
+    def __call__(self, environ, start_response):
+        handler = self.routes.get(environ.get('PATH_INFO'))
+        if not self._authorized(environ):
+            status, result = '401 Unauthorized', {'error': 'unauthorized'}
+        elif handler is None:
+            status, result = '404 Not Found', {'error': 'not found'}
+        else:
+            try:
+                status, result = '200 OK', handler(environ)
+            except ValueError as e:
+                status, result = '400 Bad Request', {'error': str(e)}
+        body = json.dumps(result, sort_keys=True, default=str)
+        body = body.encode('utf-8')
+        start_response(status, [('Content-Type', 'application/json'),
+                                ('Content-Length', str(len(body)))])
+        return [body]
+
+
+def serve_admin(app, host='127.0.0.1', port=8081):
+    """
+    Serves app on a background thread.
+    Returns - the server; call shutdown() to stop it
+    """
+    server = make_server(host, port, app, server_class=ThreadingWSGIServer,
+                         handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, name='admin')
+    thread.daemon = True
+    thread.start()
+    LOG.info("Admin endpoints on http://{}:{}/admin/".format(
+        host, server.server_port))
+    return server
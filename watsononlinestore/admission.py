@@ -0,0 +1,221 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import logging
+import threading
+import time
+
+from watsononlinestore.metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+# Messages one user may have waiting; more are merged up to this many.
+DEFAULT_PER_USER_LIMIT = 3
+# Messages that may be waiting across all users.
+DEFAULT_GLOBAL_LIMIT = 100
+BUSY_MESSAGE = ("Sorry, I'm a little busy right now. Please give me a "
+                "moment and try again.")
+
+
+class PendingTurn(object):
+    """Messages from one user waiting to be handled as a single turn."""
+
+    def __init__(self, event, now):
+        self.events = [event]
+        self.first_at = now
+        self.last_at = now
+
+    def add(self, event, now):
+        self.events.append(event)
+        self.last_at = now
+
+    def event(self):
+        """
+        The waiting messages merged into one Slack event.
+        """
+        if len(self.events) == 1:
+            return self.events[0]
+        merged = dict(self.events[-1])
+        merged['text'] = '\n'.join(e['text'] for e in self.events)
+        return merged
+
+
+class AdmissionController(object):
+
+    def __init__(self, wos, per_user_limit=DEFAULT_PER_USER_LIMIT,
+                 global_limit=DEFAULT_GLOBAL_LIMIT, debounce=0.0,
+                 busy_message=BUSY_MESSAGE, clock=time.time):
+        """
+        Bounded inbound queue in front of WatsonOnlineStore.
+
+        Each user has at most one waiting turn; messages that arrive while
+        it waits are merged into it. Turns are served in arrival order,
+        one user at a time, so a user who floods the bot only delays
+        themselves. Over a limit, messages are dropped and the user is
+        told once that the bot is busy.
+
+        :param wos: WatsonOnlineStore that handles admitted turns
+        :param per_user_limit: Messages that may wait per user
+        :param global_limit: Messages that may wait in total
+        :param debounce: Seconds a turn waits for more messages from the
+                         same user before it is handled
+        """
+        self.wos = wos
+        self.per_user_limit = per_user_limit
+        self.global_limit = global_limit
+        self.debounce = debounce
+        self.busy_message = busy_message
+        self.clock = clock
+        # Waiting turns by user, oldest first.
+        self.pending = collections.OrderedDict()
+        self.depth = 0
+        # Users already told we are busy, until their queue drains.
+        self.notified = set()
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.worker = None
+        # User whose turn is being handled right now, if any.
+        self.running_user = None
+
+    def start(self):
+        with self.condition:
+            self.stopping = False
+        self.worker = threading.Thread(target=self._run, name='admission')
+        self.worker.daemon = True
+        self.worker.start()
+
+    def stop(self, timeout=None):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.worker:
+            self.worker.join(timeout)
+            self.worker = None
+
+    def offer(self, slack_output):
+        """
+        Queues the bot's messages in slack_output. Never blocks.
+        """
+        busy = []
+        for event in slack_output or []:
+            message, channel, user = self.wos.parse_slack_output([event])
+            if not (message and channel and user):
+                continue
+            with self.condition:
+                reason = self._admit(user, event)
+                if reason:
+                    METRICS.incr('admission.shed.' + reason)
+                    if user not in self.notified:
+                        self.notified.add(user)
+                        busy.append(channel)
+                self._export_gauges()
+                self.condition.notify_all()
+        for channel in busy:
+            self.wos.post_to_slack(self.busy_message, channel)
+
+    def withdraw(self, users, timeout=None):
+        """
+        Takes back the waiting turns of users, e.g. before their sessions
+        move to another process, and waits for any turn of theirs that is
+        already being handled.
+        Returns - the withdrawn Slack events, in arrival order
+        """
+        users = set(users)
+        deadline = None if timeout is None else self.clock() + timeout
+        events = []
+        with self.condition:
+            for user in [u for u in self.pending if u in users]:
+                turn = self.pending.pop(user)
+                self.depth -= len(turn.events)
+                self.notified.discard(user)
+                events.extend(turn.events)
+            self._export_gauges()
+            while self.running_user in users:
+                remaining = (None if deadline is None
+                             else deadline - self.clock())
+                if remaining is not None and remaining <= 0:
+                    LOG.warning("Turn for {} still running after {}s".format(
+                        self.running_user, timeout))
+                    break
+                self.condition.wait(remaining)
+        return events
+
+    def _admit(self, user, event):
+        """
+        Returns - None if event was queued, else why it was shed
+        """
+        turn = self.pending.get(user)
+        if turn and len(turn.events) >= self.per_user_limit:
+            return 'user'
+        if self.depth >= self.global_limit:
+            return 'global'
+        now = self.clock()
+        if turn:
+            turn.add(event, now)
+            METRICS.incr('admission.merged')
+        else:
+            self.pending[user] = PendingTurn(event, now)
+        self.depth += 1
+        return None
+
+    def _export_gauges(self):
+        METRICS.set_gauge('admission.queue_depth', self.depth)
+        METRICS.set_gauge('admission.users_waiting', len(self.pending))
+
+    def _next_ready(self):
+        """
+        Returns (user, 0) for the oldest turn that may be handled now, or
+        (None, seconds to wait) if none may.
+        """
+        now = self.clock()
+        wait = None
+        for user, turn in self.pending.items():
+            delay = turn.last_at + self.debounce - now
+            if delay <= 0:
+                return user, 0
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _take(self):
+        with self.condition:
+            user, wait = self._next_ready()
+            while user is None:
+                if self.stopping:
+                    return None
+                self.condition.wait(wait)
+                user, wait = self._next_ready()
+            turn = self.pending.pop(user)
+            self.depth -= len(turn.events)
+            self.notified.discard(user)
+            self.running_user = user
+            self._export_gauges()
+            return turn
+
+    def _done(self):
+        with self.condition:
+            self.running_user = None
+            self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            turn = self._take()
+            if turn is None:
+                return
+            METRICS.observe('admission.wait_seconds',
+                            self.clock() - turn.first_at)
+            try:
+                self.wos.handle_slack_output([turn.event()])
+            except Exception:
+                LOG.exception("Failed to handle Slack message")
+            finally:
+                self._done()
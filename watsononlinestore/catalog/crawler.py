@@ -0,0 +1,236 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Fetch store product pages for Discovery ingestion.
+
+Products come from a JSON list (data/ibm_store_products.json). Pages are
+fetched by a pool of threads and streamed to <product_id>.html. A
+manifest.json next to them records each page's ETag, Last-Modified and
+SHA-256, so later runs send conditional requests and leave unchanged
+files alone.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import queue
+    from urllib.error import HTTPError
+    from urllib.error import URLError
+    from urllib.request import Request
+    from urllib.request import urlopen
+except ImportError:  # Python 2
+    import Queue as queue
+    from urllib2 import HTTPError
+    from urllib2 import URLError
+    from urllib2 import Request
+    from urllib2 import urlopen
+
+LOG = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+CHUNK_SIZE = 16 * 1024
+USER_AGENT = 'watson-online-store-crawler'
+
+# Outcomes
+FETCHED = 'fetched'
+NOT_MODIFIED = 'not_modified'
+UNCHANGED = 'unchanged'
+FAILED = 'failed'
+
+
+def load_products(path):
+    """
+    Returns - list of product dicts with product_id, url, title, category
+    """
+    with open(path) as products_file:
+        products = json.load(products_file)
+    for product in products:
+        for field in ('product_id', 'url'):
+            if not product.get(field):
+                raise ValueError("product without %s: %r" % (field, product))
+    return products
+
+
+class RetryableError(Exception):
+    pass
+
+
+class Crawler(object):
+
+    def __init__(self, out_dir, workers=8, retries=3, retry_delay=1.0,
+                 timeout=30, save_every=50):
+        """
+        Parameters
+        ----------
+        out_dir - Directory for pages and the manifest
+        workers - Pages fetched at the same time
+        retries - Extra attempts for a page after a network error or 5xx
+        retry_delay - Seconds before the first retry; doubles each time
+        timeout - Socket timeout per request
+        save_every - Write the manifest after this many changed entries,
+                     so an interrupted crawl keeps what it fetched
+        """
+        self.out_dir = out_dir
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.save_every = save_every
+        self.manifest_path = os.path.join(out_dir, MANIFEST)
+        self.lock = threading.Lock()
+        self.manifest = {}
+        self.unsaved = 0
+
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as manifest_file:
+                self.manifest = json.load(manifest_file)
+
+    def _save_manifest(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.out_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=1,
+                      sort_keys=True)
+        os.rename(tmp_path, self.manifest_path)
+        self.unsaved = 0
+
+    def crawl(self, products):
+        """
+        Fetches every product page that changed since the last crawl.
+        Returns - {outcome: count}
+        """
+        if not os.path.isdir(self.out_dir):
+            os.makedirs(self.out_dir)
+        self._load_manifest()
+        work = queue.Queue()
+        for product in products:
+            work.put(product)
+        counts = dict((outcome, 0) for outcome in
+                      (FETCHED, NOT_MODIFIED, UNCHANGED, FAILED))
+
+        def worker():
+            while True:
+                try:
+                    product = work.get_nowait()
+                except queue.Empty:
+                    return
+                outcome = self.fetch(product)
+                with self.lock:
+                    counts[outcome] += 1
+
+        threads = [threading.Thread(target=worker, name='crawler-%d' % i)
+                   for i in range(min(self.workers, len(products)) or 1)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            with self.lock:
+                self._save_manifest()
+        return counts
+
+    def fetch(self, product):
+        """
+        Fetches one product page, retrying transient failures.
+        Returns - the outcome
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return self._fetch_once(product)
+            except RetryableError as e:
+                if attempt == self.retries:
+                    LOG.error("Giving up on {}: {}".format(product['url'], e))
+                    return FAILED
+                delay = self.retry_delay * 2 ** attempt
+                LOG.warning("Fetching {} failed ({}); retrying in "
+                            "{}s".format(product['url'], e, delay))
+                time.sleep(delay)
+            except HTTPError as e:
+                LOG.error("Fetching {} failed: {}".format(product['url'], e))
+                return FAILED
+
+    def _fetch_once(self, product):
+        with self.lock:
+            previous = dict(self.manifest.get(product['product_id'], {}))
+        file_name = '%s.html' % product['product_id']
+        path = os.path.join(self.out_dir, file_name)
+        headers = {'User-Agent': USER_AGENT}
+        if os.path.exists(path):
+            if previous.get('etag'):
+                headers['If-None-Match'] = previous['etag']
+            if previous.get('last_modified'):
+                headers['If-Modified-Since'] = previous['last_modified']
+        try:
+            response = urlopen(Request(product['url'], headers=headers),
+                               timeout=self.timeout)
+        except HTTPError as e:
+            if e.code == 304:
+                return NOT_MODIFIED
+            if e.code >= 500 or e.code == 429:
+                raise RetryableError('HTTP %d' % e.code)
+            raise
+        except (URLError, IOError) as e:
+            raise RetryableError(str(e))
+
+        try:
+            digest, tmp_path = self._stream(response)
+        except (URLError, IOError) as e:
+            raise RetryableError(str(e))
+        finally:
+            response.close()
+
+        entry = {'file': file_name,
+                 'url': product['url'],
+                 'title': product.get('title'),
+                 'category': product.get('category'),
+                 'etag': response.info().get('ETag'),
+                 'last_modified': response.info().get('Last-Modified'),
+                 'sha256': digest}
+        if digest == previous.get('sha256') and os.path.exists(path):
+            os.remove(tmp_path)
+            outcome = UNCHANGED
+        else:
+            os.rename(tmp_path, path)
+            outcome = FETCHED
+        with self.lock:
+            self.manifest[product['product_id']] = entry
+            self.unsaved += 1
+            if self.unsaved >= self.save_every:
+                self._save_manifest()
+        return outcome
+
+    def _stream(self, response):
+        """
+        Copies the response body to a temporary file, hashing as it goes.
+        Returns - (hex SHA-256, temporary file path)
+        """
+        sha = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.out_dir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as page_file:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    page_file.write(chunk)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return sha.hexdigest(), tmp_path
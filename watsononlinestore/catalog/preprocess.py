@@ -0,0 +1,274 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Turn store product pages into compact documents for Discovery.
+
+A raw product page is 30-40 KB, nearly all of it scripts, navigation and
+the upsell tab. Each page is streamed through an HTMLParser that keeps
+only the product ID, title, category, image URL and description, and
+written as <product_id>.json. Pages are parsed in parallel on a process
+pool, and documents with the same content are written once.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+
+try:
+    from html.parser import HTMLParser
+except ImportError:  # Python 2
+    from HTMLParser import HTMLParser
+
+try:
+    from html import unescape
+except ImportError:  # Python 2
+    unescape = HTMLParser().unescape
+
+from watsononlinestore.catalog import crawler
+
+LOG = logging.getLogger(__name__)
+
+CHUNK_SIZE = 16 * 1024
+MAX_TEXT = 2000
+PRODUCT_URL = "http://www.logostore-globalid.us/ProductDetail.aspx?pid="
+
+PRODUCT_ID_RE = re.compile(r'ProductDetail\.aspx\?pid=(\d+)')
+MARKER_RE = re.compile(r'^(Product|Category):(.*)$', re.MULTILINE)
+SPACE_RE = re.compile(r'[ \t\r\f\v]+')
+
+# Outcomes
+WRITTEN = 'written'
+UNCHANGED = 'unchanged'
+DUPLICATE = 'duplicate'
+FAILED = 'failed'
+
+
+class ProductPageParser(HTMLParser):
+    """Collects the product fields from a store page fed in chunks."""
+
+    SKIP = ('script', 'style')
+    BREAKS = ('br', 'p', 'li', 'div')
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.product_id = None
+        self.image_url = None
+        self.title = []
+        self.text = []
+        self.in_title = False
+        self.skip_depth = 0
+        # Table cell nesting inside the description cell, once found.
+        self.description_depth = None
+        self.description_done = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag in self.SKIP:
+            self.skip_depth += 1
+        elif tag == 'title':
+            self.in_title = True
+
+        if self.product_id is None:
+            for name in ('action', 'href'):
+                match = PRODUCT_ID_RE.search(attrs.get(name) or '')
+                if match:
+                    self.product_id = match.group(1)
+                    break
+
+        if (tag == 'a' and self.image_url is None and
+                'jqzoom' in (attrs.get('class') or '').split()):
+            self.image_url = attrs.get('href')
+
+        if self.description_depth is not None:
+            if tag == 'td':
+                self.description_depth += 1
+            elif tag in self.BREAKS:
+                self.text.append('\n')
+        elif (tag == 'td' and not self.description_done and
+                attrs.get('class') == 'ProductDetailText'):
+            self.description_depth = 0
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag in self.SKIP:
+            self.skip_depth -= 1
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag == 'title':
+            self.in_title = False
+        elif tag == 'td' and self.description_depth is not None:
+            if self.description_depth == 0:
+                self.description_depth = None
+                self.description_done = True
+            else:
+                self.description_depth -= 1
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title.append(data)
+        elif self.description_depth is not None and not self.skip_depth:
+            # Line breaks in the source are just spaces; BREAKS end lines.
+            self.text.append(data.replace('\n', ' '))
+
+    def handle_entityref(self, name):  # Python 2 only
+        self.handle_data(unescape('&%s;' % name))
+
+    def handle_charref(self, name):  # Python 2 only
+        self.handle_data(unescape('&#%s;' % name))
+
+    def document(self):
+        """
+        Returns - dict with the fields found. Title and category come from
+        the Product:/Category: markers in <title>, when present.
+        """
+        markers = dict((key.lower(), value.strip()) for key, value in
+                       MARKER_RE.findall(''.join(self.title)))
+        lines = (SPACE_RE.sub(' ', line).strip()
+                 for line in ''.join(self.text).splitlines())
+        text = '\n'.join(line for line in lines if line)
+        return {'product_id': self.product_id,
+                'title': markers.get('product'),
+                'category': markers.get('category'),
+                'image_url': self.image_url,
+                'text': text[:MAX_TEXT]}
+
+
+def extract(path, metadata=None):
+    """
+    Streams one page through the parser.
+
+    Parameters
+    ----------
+    path - HTML file
+    metadata - Optional dict (e.g. a crawler manifest entry) whose product_id,
+               url, title and category take precedence over the page
+    Returns - the compact document dict
+    """
+    parser = ProductPageParser()
+    with io.open(path, encoding='utf-8', errors='replace') as page:
+        while True:
+            chunk = page.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            parser.feed(chunk)
+    parser.close()
+
+    document = parser.document()
+    for field in ('product_id', 'url', 'title', 'category'):
+        if metadata and metadata.get(field):
+            document[field] = metadata[field]
+    if not document['product_id']:
+        raise ValueError("no product ID in %s" % path)
+    document.setdefault('url', PRODUCT_URL + document['product_id'])
+    return document
+
+
+def _extract_job(job):
+    path, metadata = job
+    try:
+        return path, extract(path, metadata), None
+    except Exception as e:
+        return path, None, str(e)
+
+
+def find_pages(pages_dir):
+    """
+    Lists the pages to process. A crawler manifest is used when there is
+    one; otherwise every .html file, relying on the markers in the page.
+    Returns - list of (path, metadata or None)
+    """
+    manifest_path = os.path.join(pages_dir, crawler.MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        return [(os.path.join(pages_dir, entry['file']),
+                 dict(entry, product_id=product_id))
+                for product_id, entry in sorted(manifest.items())]
+    return [(os.path.join(pages_dir, name), None)
+            for name in sorted(os.listdir(pages_dir))
+            if name.endswith('.html')]
+
+
+def content_hash(document):
+    """
+    Returns - SHA-256 of the document's content, ignoring its ID and URL
+    so the same product listed twice is only ingested once
+    """
+    content = dict((key, value) for key, value in document.items()
+                   if key not in ('product_id', 'url'))
+    data = json.dumps(content, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def write_document(out_dir, document):
+    """
+    Writes <product_id>.json unless it already holds the same document.
+    Returns - WRITTEN or UNCHANGED
+    """
+    path = os.path.join(out_dir, '%s.json' % document['product_id'])
+    data = json.dumps(document, indent=1, sort_keys=True) + '\n'
+    if os.path.exists(path):
+        with io.open(path, encoding='utf-8') as existing:
+            if existing.read() == data:
+                return UNCHANGED
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+    with io.open(fd, 'w', encoding='utf-8') as doc_file:
+        doc_file.write(data)
+    os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+    return WRITTEN
+
+
+def preprocess(jobs, out_dir, processes=None):
+    """
+    Extracts and writes a document for every page.
+
+    Parameters
+    ----------
+    jobs - list of (path, metadata or None), as from find_pages()
+    out_dir - Directory for the .json documents
+    processes - Pool size; defaults to the number of CPUs
+    Returns - {outcome: count}
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    counts = dict((outcome, 0) for outcome in
+                  (WRITTEN, UNCHANGED, DUPLICATE, FAILED))
+    seen = set()
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        # imap keeps the input order, so the first copy of a duplicate wins.
+        for path, document, error in pool.imap(_extract_job, jobs,
+                                               chunksize=4):
+            if error:
+                LOG.error("Skipping {}: {}".format(path, error))
+                counts[FAILED] += 1
+                continue
+            digest = content_hash(document)
+            if digest in seen:
+                LOG.debug("Skipping duplicate {}".format(path))
+                counts[DUPLICATE] += 1
+                continue
+            seen.add(digest)
+            counts[write_document(out_dir, document)] += 1
+    finally:
+        pool.close()
+        pool.join()
+    return counts
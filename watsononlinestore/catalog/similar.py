@@ -0,0 +1,334 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Precomputed "similar products" for the store catalog.
+
+Offline, every product document (see preprocess.py) becomes a TF-IDF
+vector of its title, category and description, and the top k most similar
+products by cosine similarity are found for each. NumPy is used when it is
+installed: the sparse TF-IDF matrix is multiplied by its transpose a block
+of rows at a time, touching only pairs of products that share a term.
+Without it a pure Python version gives the same results for small
+catalogs.
+
+The result is one binary file that the bot memory-maps, so a lookup after
+an item is added to the cart is a few array reads with no remote query:
+
+    magic        8 bytes  b'WOSSIM1\\0'
+    count, k     2 x uint32 (little-endian)
+    meta_size    uint32, then meta_size bytes of JSON
+                 [[product_id, title, url], ...] padded to 4 bytes
+    neighbors    count x k int32, row order as in meta; -1 pads a row
+    scores       count x k float32
+"""
+
+import collections
+import io
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+LOG = logging.getLogger(__name__)
+
+MAGIC = b'WOSSIM1\0'
+HEADER = struct.Struct('<8sIII')
+DEFAULT_TOP_K = 5
+# Terms kept in the vocabulary, by document frequency.
+MAX_FEATURES = 20000
+# Terms in more than this share of the products say little about any of
+# them, and would pair up nearly every product; they are left out.
+MAX_DF = 0.5
+# Rows of the similarity matrix computed at a time.
+BLOCK_ROWS = 512
+# Terms in more than this share of the products are multiplied as a dense
+# matrix rather than pair by pair.
+DENSE_SHARE = 1.0 / 16
+# The title says most about what a product is.
+TITLE_WEIGHT = 2
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+STOP_WORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in',
+    'is', 'it', 'of', 'on', 'or', 'the', 'this', 'to', 'with', 'your'))
+
+
+def tokenize(text):
+    return [token for token in TOKEN_RE.findall((text or '').lower())
+            if len(token) > 1 and token not in STOP_WORDS]
+
+
+def document_terms(document):
+    """
+    Returns - the terms of a product document, the title counted
+    TITLE_WEIGHT times
+    """
+    category = (document.get('category') or '').replace('/', ' ')
+    return (tokenize(document.get('title')) * TITLE_WEIGHT +
+            tokenize(category) + tokenize(document.get('text')))
+
+
+def load_documents(docs_dir):
+    """
+    Returns - the product documents in docs_dir, ordered by product ID
+    """
+    documents = []
+    for name in sorted(os.listdir(docs_dir)):
+        if name.endswith('.json'):
+            with io.open(os.path.join(docs_dir, name),
+                         encoding='utf-8') as doc_file:
+                documents.append(json.load(doc_file))
+    return documents
+
+
+def vocabulary(term_lists, max_features=MAX_FEATURES, max_df=MAX_DF):
+    """
+    Returns - (term -> column, idf list) for the max_features terms found
+    in the most documents, leaving out terms in more than max_df of them
+    """
+    df = collections.Counter()
+    for terms in term_lists:
+        df.update(set(terms))
+    count = len(term_lists)
+    # A term shared by just two documents is still worth keeping.
+    limit = max(2, max_df * count)
+    kept = sorted((term for term in df if df[term] <= limit),
+                  key=lambda term: (-df[term], term))[:max_features]
+    columns = dict((term, i) for i, term in enumerate(kept))
+    idf = [math.log((1.0 + count) / (1.0 + df[term])) + 1.0 for term in kept]
+    return columns, idf
+
+
+def _sparse_vectors(term_lists, columns, idf):
+    """
+    Returns - one L2-normalized {column: weight} dict per document
+    """
+    vectors = []
+    for terms in term_lists:
+        counts = collections.Counter(columns[t] for t in terms
+                                     if t in columns)
+        vector = dict((column, tf * idf[column])
+                      for column, tf in counts.items())
+        norm = math.sqrt(sum(w * w for w in vector.values()))
+        vectors.append(dict((c, w / norm) for c, w in vector.items())
+                       if norm else {})
+    return vectors
+
+
+def _top_k_python(term_lists, columns, idf, k):
+    vectors = _sparse_vectors(term_lists, columns, idf)
+    # Inverted index: only products sharing a term get a score.
+    postings = collections.defaultdict(list)
+    for row, vector in enumerate(vectors):
+        for column, weight in vector.items():
+            postings[column].append((row, weight))
+    neighbors, scores = [], []
+    for row, vector in enumerate(vectors):
+        totals = collections.defaultdict(float)
+        for column, weight in vector.items():
+            for other, other_weight in postings[column]:
+                if other != row:
+                    totals[other] += weight * other_weight
+        best = sorted(totals.items(), key=lambda item: (-item[1], item[0]))
+        best = [item for item in best if item[1] > 0][:k]
+        neighbors.append([other for other, _ in best] +
+                         [-1] * (k - len(best)))
+        scores.append([score for _, score in best] +
+                      [0.0] * (k - len(best)))
+    return neighbors, scores
+
+
+def _top_k_numpy(term_lists, columns, idf, k):
+    count = len(term_lists)
+    # The TF-IDF matrix in sparse form: one (row, column, weight) per term
+    # of each document, rows in order.
+    rows, cols, weights = [], [], []
+    for row, vector in enumerate(_sparse_vectors(term_lists, columns, idf)):
+        rows.extend([row] * len(vector))
+        cols.extend(vector.keys())
+        weights.extend(vector.values())
+    rows = numpy.asarray(rows, dtype=numpy.int32)
+    cols = numpy.asarray(cols, dtype=numpy.int32)
+    weights = numpy.asarray(weights, dtype=numpy.float32)
+    df = numpy.bincount(cols, minlength=len(idf))
+
+    # Common terms pair up so many products that a dense matrix product
+    # over just their columns is cheaper than visiting the pairs.
+    dense_columns = numpy.flatnonzero(df > DENSE_SHARE * count)
+    dense = numpy.zeros((count, len(dense_columns)), dtype=numpy.float32)
+    in_dense = numpy.full(len(idf), -1, dtype=numpy.int32)
+    in_dense[dense_columns] = numpy.arange(len(dense_columns))
+    is_dense = in_dense[cols] >= 0
+    dense[rows[is_dense], in_dense[cols[is_dense]]] = weights[is_dense]
+    rows, cols, weights = rows[~is_dense], cols[~is_dense], weights[~is_dense]
+
+    row_ptr = numpy.concatenate(([0], numpy.cumsum(
+        numpy.bincount(rows, minlength=count))))
+    # The rare terms by column: the documents holding each term.
+    by_col = numpy.argsort(cols, kind='stable')
+    post_rows, post_weights = rows[by_col], weights[by_col]
+    col_len = numpy.bincount(cols, minlength=len(idf))
+    col_ptr = numpy.concatenate(([0], numpy.cumsum(col_len)))[:-1]
+
+    neighbors = numpy.full((count, k), -1, dtype=numpy.int32)
+    scores = numpy.zeros((count, k), dtype=numpy.float32)
+    width = min(k, count - 1)
+    if width <= 0:
+        return neighbors, scores
+    for start in range(0, count, BLOCK_ROWS):
+        end = min(start + BLOCK_ROWS, count)
+        size = end - start
+        entries = slice(row_ptr[start], row_ptr[end])
+        block_cols = cols[entries]
+        lengths = col_len[block_cols]
+        # Pair every rare term of the block with every document holding
+        # it, and sum the products per (row, document).
+        firsts = numpy.repeat(col_ptr[block_cols] - numpy.cumsum(lengths) +
+                              lengths, lengths)
+        postings = firsts + numpy.arange(lengths.sum())
+        keys = (numpy.repeat(rows[entries] - start, lengths) * count +
+                post_rows[postings])
+        products = (numpy.repeat(weights[entries], lengths) *
+                    post_weights[postings])
+        block = dense[start:end].dot(dense.T).astype(numpy.float64)
+        block += numpy.bincount(keys, weights=products,
+                                minlength=size * count).reshape(size, count)
+        local = numpy.arange(size)
+        block[local, local + start] = -1  # not similar to itself
+        # Partition for the best k, then order just those k by score
+        # (and by row on ties, like the pure Python version).
+        best = numpy.argpartition(-block, width - 1, axis=1)[:, :width]
+        best_scores = block[local[:, None], best]
+        order = numpy.lexsort((best, -best_scores), axis=1)
+        best = numpy.take_along_axis(best, order, axis=1)
+        best_scores = numpy.take_along_axis(best_scores, order, axis=1)
+        best[best_scores <= 0] = -1
+        best_scores[best_scores <= 0] = 0
+        neighbors[start:end, :width] = best
+        scores[start:end, :width] = best_scores
+    return neighbors, scores
+
+
+def top_k_similar(documents, k=DEFAULT_TOP_K, max_features=MAX_FEATURES):
+    """
+    Finds the k products most similar to each product.
+
+    Parameters
+    ----------
+    documents - product documents, as from load_documents()
+    k - neighbors per product
+    max_features - vocabulary size
+    Returns - (neighbors, scores), row i holding the indexes of documents
+              most like documents[i] (-1 where there are fewer than k)
+              and their cosine similarity, best first
+    """
+    term_lists = [document_terms(document) for document in documents]
+    columns, idf = vocabulary(term_lists, max_features)
+    if numpy is not None:
+        neighbors, scores = _top_k_numpy(term_lists, columns, idf, k)
+        return neighbors.tolist(), scores.tolist()
+    return _top_k_python(term_lists, columns, idf, k)
+
+
+def write_similar(path, documents, neighbors, scores):
+    """
+    Writes the neighbor table in the format described above, atomically.
+    """
+    k = len(neighbors[0]) if neighbors else 0
+    meta = json.dumps([[d['product_id'], d.get('title') or '',
+                        d.get('url') or ''] for d in documents],
+                      separators=(',', ':')).encode('utf-8')
+    meta += b' ' * (-len(meta) % 4)
+    flat_neighbors = [n for row in neighbors for n in row]
+    flat_scores = [s for row in scores for s in row]
+    out_dir = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+    with io.open(fd, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, len(documents), k, len(meta)))
+        out.write(meta)
+        out.write(struct.pack('<%di' % len(flat_neighbors),
+                              *flat_neighbors))
+        out.write(struct.pack('<%df' % len(flat_scores), *flat_scores))
+    os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+
+
+def build(docs_dir, path, k=DEFAULT_TOP_K):
+    """
+    Builds the similar products file for the documents in docs_dir.
+    Returns - the number of products
+    """
+    documents = load_documents(docs_dir)
+    neighbors, scores = top_k_similar(documents, k)
+    write_similar(path, documents, neighbors, scores)
+    LOG.info("Wrote {} products with {} neighbors each to {}".format(
+        len(documents), k, path))
+    return len(documents)
+
+
+class SimilarProducts(object):
+
+    def __init__(self, path):
+        """
+        Read-only view of a file written by build(). The neighbor table is
+        memory-mapped, not loaded, so it costs little memory per process.
+
+        :param path: File written by build()
+        """
+        with open(path, 'rb') as similar_file:
+            self.data = mmap.mmap(similar_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        magic, self.count, self.k, meta_size = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError("%s is not a similar products file" % path)
+        meta = self.data[HEADER.size:HEADER.size + meta_size]
+        self.products = json.loads(meta.decode('utf-8'))
+        self.rows = dict((product[0], row)
+                         for row, product in enumerate(self.products))
+        self.neighbors_offset = HEADER.size + meta_size
+        self.scores_offset = self.neighbors_offset + 4 * self.count * self.k
+        self.row = struct.Struct('<%di' % self.k)
+        self.row_scores = struct.Struct('<%df' % self.k)
+
+    def close(self):
+        self.data.close()
+
+    def similar(self, product_id, count=3):
+        """
+        Returns - up to count dicts with product_id, name, url and score
+        for the products most like product_id, best first
+        """
+        row = self.rows.get(product_id)
+        if row is None:
+            return []
+        offset = 4 * row * self.k
+        neighbors = self.row.unpack_from(self.data,
+                                         self.neighbors_offset + offset)
+        scores = self.row_scores.unpack_from(self.data,
+                                             self.scores_offset + offset)
+        similar = []
+        for neighbor, score in zip(neighbors[:count], scores):
+            if neighbor < 0:
+                break
+            product_id, name, url = self.products[neighbor]
+            similar.append({'product_id': product_id, 'name': name,
+                            'url': url, 'score': score})
+        return similar
@@ -0,0 +1,321 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Upload documents to a Watson Discovery collection.
+
+Documents are sent by a pool of threads with their file name (without
+extension) as the document ID, so uploading again updates the document
+instead of adding a copy. A checkpoint file records the SHA-256 of every
+document the collection has accepted; documents that have not changed are
+skipped, and an interrupted run picks up where it stopped.
+
+Discovery answers 429 when too many documents are in flight. The number
+of concurrent uploads then halves (and the pool waits out Retry-After),
+and grows back by one after each run of successful uploads.
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+try:
+    import queue
+    from urllib.error import HTTPError
+    from urllib.error import URLError
+    from urllib.parse import quote
+    from urllib.request import Request
+    from urllib.request import urlopen
+except ImportError:  # Python 2
+    import Queue as queue
+    from urllib import quote
+    from urllib2 import HTTPError
+    from urllib2 import URLError
+    from urllib2 import Request
+    from urllib2 import urlopen
+
+LOG = logging.getLogger(__name__)
+
+DISCOVERY_URL = 'https://gateway.watsonplatform.net/discovery/api'
+DISCOVERY_VERSION = '2016-11-07'
+DOCUMENT_TYPES = ('.json', '.html')
+
+# Outcomes
+UPLOADED = 'uploaded'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+class RetryableError(Exception):
+    pass
+
+
+class Checkpoint(object):
+
+    def __init__(self, path, save_every=20):
+        """
+        Document hashes the collection already has, kept in a JSON file.
+
+        :param path: Checkpoint file
+        :param save_every: Write the file after this many new entries
+        """
+        self.path = path
+        self.save_every = save_every
+        self.lock = threading.Lock()
+        self.hashes = {}
+        self.unsaved = 0
+        if os.path.exists(path):
+            with open(path) as checkpoint_file:
+                self.hashes = json.load(checkpoint_file)
+
+    def is_current(self, document_id, digest):
+        with self.lock:
+            return self.hashes.get(document_id) == digest
+
+    def record(self, document_id, digest):
+        with self.lock:
+            self.hashes[document_id] = digest
+            self.unsaved += 1
+            if self.unsaved >= self.save_every:
+                self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as checkpoint_file:
+            json.dump(self.hashes, checkpoint_file, indent=1,
+                      sort_keys=True)
+        os.rename(tmp_path, self.path)
+        self.unsaved = 0
+
+
+class AdaptiveThrottle(object):
+
+    def __init__(self, max_concurrency, recover_after=10, clock=time.time):
+        """
+        Limits uploads in flight; backs off on 429, recovers on success.
+
+        :param max_concurrency: Upper bound (the number of workers)
+        :param recover_after: Successes before the limit grows by one
+        """
+        self.max_concurrency = max_concurrency
+        self.recover_after = recover_after
+        self.clock = clock
+        self.limit = max_concurrency
+        self.active = 0
+        self.successes = 0
+        self.paused_until = 0
+        self.condition = threading.Condition()
+
+    def _try_acquire(self):
+        if self.paused_until > self.clock() or self.active >= self.limit:
+            return False
+        self.active += 1
+        return True
+
+    def try_acquire(self):
+        """
+        Takes a slot without waiting.
+        Returns - True if the caller may upload; it must release() after
+        """
+        with self.condition:
+            return self._try_acquire()
+
+    def acquire(self):
+        """Waits for a slot, and for any Retry-After pause to end."""
+        with self.condition:
+            while not self._try_acquire():
+                wait = self.paused_until - self.clock()
+                self.condition.wait(wait if wait > 0 else None)
+
+    def release(self, throttled=False, retry_after=None):
+        """
+        :param throttled: The call was answered with 429
+        :param retry_after: Seconds the service asked to wait
+        """
+        with self.condition:
+            self.active -= 1
+            if throttled:
+                self.successes = 0
+                if self.limit > 1:
+                    self.limit = max(1, self.limit // 2)
+                    LOG.info("Throttled; {} uploads at a time".format(
+                        self.limit))
+                if retry_after:
+                    self.paused_until = max(self.paused_until,
+                                            self.clock() + retry_after)
+            else:
+                self.successes += 1
+                if (self.successes >= self.recover_after and
+                        self.limit < self.max_concurrency):
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+def _multipart(file_name, data, mime_type):
+    boundary = uuid.uuid4().hex
+    body = b''.join([
+        ('--%s\r\n' % boundary).encode('ascii'),
+        ('Content-Disposition: form-data; name="file"; filename="%s"\r\n'
+         % file_name).encode('utf-8'),
+        ('Content-Type: %s\r\n\r\n' % mime_type).encode('ascii'),
+        data,
+        ('\r\n--%s--\r\n' % boundary).encode('ascii')])
+    return body, 'multipart/form-data; boundary=%s' % boundary
+
+
+def find_documents(docs_dir):
+    """
+    Returns - sorted list of document paths in docs_dir
+    """
+    return [os.path.join(docs_dir, name)
+            for name in sorted(os.listdir(docs_dir))
+            if os.path.splitext(name)[1] in DOCUMENT_TYPES]
+
+
+class Uploader(object):
+
+    def __init__(self, environment_id, collection_id, username, password,
+                 checkpoint_path, url=DISCOVERY_URL,
+                 version=DISCOVERY_VERSION, workers=4, retries=5,
+                 retry_delay=1.0, timeout=60):
+        """
+        Parameters
+        ----------
+        environment_id, collection_id - The collection to upload to
+        username, password - Discovery service credentials
+        checkpoint_path - File recording what has been uploaded
+        url - Discovery API base URL
+        workers - Upper bound on uploads in flight
+        retries - Extra attempts after a 429, 5xx or network error
+        retry_delay - Seconds before the first retry; doubles each time
+        timeout - Socket timeout per request
+        """
+        self.documents_url = '%s/v1/environments/%s/collections/%s/documents' \
+            % (url.rstrip('/'), environment_id, collection_id)
+        self.version = version
+        credentials = ('%s:%s' % (username, password)).encode('utf-8')
+        self.authorization = 'Basic ' + \
+            base64.b64encode(credentials).decode('ascii')
+        self.checkpoint = Checkpoint(checkpoint_path)
+        self.workers = workers
+        self.throttle = AdaptiveThrottle(workers)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+
+    def upload(self, paths):
+        """
+        Uploads every document that changed since it was last uploaded.
+        Returns - {outcome: count}
+        """
+        work = queue.Queue()
+        for path in paths:
+            work.put(path)
+        counts = dict((outcome, 0) for outcome in
+                      (UPLOADED, SKIPPED, FAILED))
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    path = work.get_nowait()
+                except queue.Empty:
+                    return
+                outcome = self.upload_document(path)
+                with lock:
+                    counts[outcome] += 1
+
+        threads = [threading.Thread(target=worker, name='uploader-%d' % i)
+                   for i in range(min(self.workers, len(paths)) or 1)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.checkpoint.save()
+        return counts
+
+    def upload_document(self, path):
+        """
+        Uploads one document, retrying throttling and transient failures.
+        Returns - the outcome
+        """
+        file_name = os.path.basename(path)
+        document_id = os.path.splitext(file_name)[0]
+        with open(path, 'rb') as document_file:
+            data = document_file.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if self.checkpoint.is_current(document_id, digest):
+            return SKIPPED
+
+        for attempt in range(self.retries + 1):
+            try:
+                self._post(document_id, file_name, data)
+            except RetryableError as e:
+                if attempt == self.retries:
+                    LOG.error("Giving up on {}: {}".format(path, e))
+                    return FAILED
+                delay = self.retry_delay * 2 ** attempt
+                LOG.warning("Uploading {} failed ({}); retrying in "
+                            "{}s".format(path, e, delay))
+                time.sleep(delay)
+            except HTTPError as e:
+                LOG.error("Uploading {} failed: {}".format(path, e))
+                return FAILED
+            else:
+                self.checkpoint.record(document_id, digest)
+                return UPLOADED
+
+    def _post(self, document_id, file_name, data):
+        mime_type = mimetypes.guess_type(file_name)[0] or 'text/html'
+        body, content_type = _multipart(file_name, data, mime_type)
+        request = Request(
+            '%s/%s?version=%s' % (self.documents_url, quote(document_id),
+                                  self.version),
+            data=body,
+            headers={'Content-Type': content_type,
+                     'Authorization': self.authorization,
+                     'Accept': 'application/json'})
+
+        self.throttle.acquire()
+        throttled = False
+        retry_after = None
+        try:
+            urlopen(request, timeout=self.timeout).close()
+        except HTTPError as e:
+            if e.code == 429:
+                throttled = True
+                try:
+                    retry_after = float(e.headers.get('Retry-After'))
+                except (TypeError, ValueError):
+                    pass
+                raise RetryableError('HTTP 429')
+            if e.code >= 500:
+                raise RetryableError('HTTP %d' % e.code)
+            raise
+        except (URLError, IOError) as e:
+            raise RetryableError(str(e))
+        finally:
+            self.throttle.release(throttled, retry_after)
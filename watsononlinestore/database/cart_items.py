@@ -0,0 +1,140 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Structured shopping cart entries.
+
+A stored cart is a dict keyed by product ID, so adding, removing and
+incrementing an item are O(1) dict operations:
+
+    {'206347': {'name': 'Applique Crew Sweatshirt', 'qty': 2,
+                'added': 1500000000.0}}
+
+To keep documents compact, 'url' is only stored when it differs from the
+store's product URL for that ID. Callers work with plain item dicts:
+
+    {'product_id': '206347', 'name': 'Applique Crew Sweatshirt',
+     'url': 'http://...pid=206347', 'quantity': 2}
+
+Carts written before this format were lists of 'name: url\\n' strings;
+`migrate_cart` converts them.
+"""
+
+import hashlib
+import re
+import time
+
+PRODUCT_URL = "http://www.logostore-globalid.us/ProductDetail.aspx?pid="
+
+_PID_RE = re.compile(r'[?&]pid=([^&\s]+)')
+
+
+def product_url(product_id):
+    return PRODUCT_URL + product_id
+
+
+def new_item(product_id, name, url=None, quantity=1):
+    return {'product_id': product_id,
+            'name': name,
+            'url': product_url(product_id) if url is None else url,
+            'quantity': quantity}
+
+
+def is_legacy(cart):
+    return isinstance(cart, list)
+
+
+def add_item(cart, item, quantity=1, now=None):
+    """Add quantity of item to a stored cart, incrementing if present."""
+    entry = cart.get(item['product_id'])
+    if entry:
+        entry['qty'] += quantity
+        return entry
+    entry = {'name': item['name'], 'qty': quantity,
+             'added': now if now is not None else time.time()}
+    url = item.get('url')
+    if url is not None and url != product_url(item['product_id']):
+        entry['url'] = url
+    cart[item['product_id']] = entry
+    return entry
+
+
+def remove_item(cart, product_id, quantity=None):
+    """Remove an item, or only quantity of it.
+
+    :return: True if the cart changed
+    """
+    entry = cart.get(product_id)
+    if not entry:
+        return False
+    if quantity is not None and entry['qty'] > quantity:
+        entry['qty'] -= quantity
+    else:
+        del cart[product_id]
+    return True
+
+
+def is_applied(marker, journal_entry):
+    """Whether a cart whose journal marker ({'id': journal_id, 'seq': n}
+    or None) already includes journal_entry ((journal_id, seq) or None).
+    """
+    if not (marker and journal_entry):
+        return False
+    journal_id, seq = journal_entry
+    return marker.get('id') == journal_id and marker.get('seq', 0) >= seq
+
+
+def journal_marker(journal_entry):
+    journal_id, seq = journal_entry
+    return {'id': journal_id, 'seq': seq}
+
+
+def list_items(cart):
+    """Return the cart as item dicts, in the order they were added."""
+    if is_legacy(cart):
+        cart = migrate_cart(cart)
+    ordered = sorted(cart.items(), key=lambda kv: kv[1].get('added', 0))
+    return [new_item(pid, entry['name'], entry.get('url'), entry['qty'])
+            for pid, entry in ordered]
+
+
+def from_items(items, now=None):
+    """Build a stored cart from a list of item dicts."""
+    now = now if now is not None else time.time()
+    cart = {}
+    for offset, item in enumerate(items):
+        # Spread the timestamps so the original order survives.
+        add_item(cart, item, item.get('quantity', 1), now + offset * 1e-6)
+    return cart
+
+
+def parse_legacy_item(text):
+    """Parse a legacy 'name: url\\n' cart string into an item dict."""
+    text = text.strip()
+    name, sep, url = text.rpartition(': ')
+    if not sep or not url.startswith('http'):
+        name, url = text, ''
+    match = _PID_RE.search(url)
+    if match:
+        product_id = match.group(1)
+    else:
+        product_id = 'legacy-' + hashlib.sha1(
+            text.encode('utf-8')).hexdigest()[:12]
+    return new_item(product_id, name, url)
+
+
+def migrate_cart(legacy_cart, now=None):
+    """Convert a legacy list of strings to a stored cart.
+
+    Duplicate strings become one entry with a higher quantity.
+    """
+    return from_items([parse_legacy_item(text) for text in legacy_cart],
+                      now)
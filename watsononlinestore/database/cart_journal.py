@@ -0,0 +1,390 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import json
+import logging
+import os
+import threading
+import uuid
+
+from watsononlinestore.database import cart_items
+from watsononlinestore.database.online_store import OnlineStore
+
+LOG = logging.getLogger(__name__)
+
+ADD = 'add'
+DELETE = 'delete'
+
+
+class CartJournal(object):
+
+    def __init__(self, path, sync_interval=0.05):
+        """
+        Creates a new append-only journal of shopping cart mutations.
+        Parameters
+        ----------
+        path - Journal file. The journal's ID and applied checkpoint are kept
+               in path.checkpoint
+        sync_interval - How often the idle syncer checks for close()
+        """
+        self.path = path
+        self.checkpoint_path = path + '.checkpoint'
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        # Held for a whole fsync so the file is not swapped out under it;
+        # taken before self.lock.
+        self.sync_lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)
+        self.synced_seq = 0
+        self.pending_entries = collections.OrderedDict()
+        self.next_seq = 1
+        # Identifies this journal's seqs to the backend, which records the
+        # last one applied to each cart.
+        self.journal_id = None
+        self.journal_file = None
+        self.dirty = threading.Event()
+        self.closed = threading.Event()
+        self.syncer = None
+
+    def open(self):
+        """
+        Opens the journal, replaying entries that were not yet applied.
+        Returns - the list of replayed entries
+        """
+        self.journal_id, applied = self._read_checkpoint()
+        last_seq = applied
+        if os.path.exists(self.path):
+            with open(self.path) as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn write from a crash; nothing after it was
+                        # acknowledged as durable.
+                        LOG.warning("Ignoring truncated journal entry in "
+                                    "{}".format(self.path))
+                        break
+                    last_seq = max(last_seq, entry['seq'])
+                    if entry['seq'] > applied:
+                        self.pending_entries[entry['seq']] = entry
+        self.next_seq = last_seq + 1
+        # Start from a compacted file, which also drops any torn tail.
+        with self.sync_lock, self.lock:
+            self._rewrite()
+        self.closed.clear()
+        self.syncer = threading.Thread(target=self._sync_loop,
+                                       name='cart-journal-sync')
+        self.syncer.daemon = True
+        self.syncer.start()
+        if self.pending_entries:
+            LOG.info("Replaying {} unflushed cart journal entries".format(
+                len(self.pending_entries)))
+        return list(self.pending_entries.values())
+
+    def close(self):
+        self.closed.set()
+        self.dirty.set()
+        if self.syncer:
+            self.syncer.join()
+            self.syncer = None
+        with self.sync_lock, self.lock:
+            if self.journal_file:
+                self.journal_file.flush()
+                os.fsync(self.journal_file.fileno())
+                self.journal_file.close()
+                self.journal_file = None
+                self._mark_synced(self.next_seq - 1)
+
+    def append(self, op, customer_str, **fields):
+        """
+        Appends a cart mutation and returns once it is on disk. Appends
+        from concurrent turns share one fsync (group commit): entries
+        written while an fsync is in progress are synced together by the
+        next one. Raises ValueError if the journal is not open, like a
+        write to a closed file.
+        Returns - the journal entry
+        """
+        with self.lock:
+            if self.journal_file is None:
+                raise ValueError("Cart journal {} is closed".format(
+                    self.path))
+            entry = dict(fields, seq=self.next_seq, op=op,
+                         customer=customer_str)
+            self.next_seq += 1
+            self.journal_file.write(json.dumps(entry) + '\n')
+            self.pending_entries[entry['seq']] = entry
+            self.dirty.set()
+            while (self.synced_seq < entry['seq'] and
+                   self.journal_file is not None):
+                self.synced.wait(self.sync_interval)
+        return entry
+
+    def pending(self, customer_str=None):
+        """
+        Returns unapplied entries in journal order, optionally for one
+        customer only.
+        """
+        with self.lock:
+            entries = list(self.pending_entries.values())
+        if customer_str is None:
+            return entries
+        return [e for e in entries if e['customer'] == customer_str]
+
+    def mark_applied(self, entry):
+        """
+        Records that entry (and every entry before it) reached the backend.
+        """
+        with self.lock:
+            for seq in list(self.pending_entries):
+                if seq > entry['seq']:
+                    break
+                del self.pending_entries[seq]
+            self._write_checkpoint(entry['seq'])
+
+    def compact(self):
+        """
+        Rewrites the journal so it only holds unapplied entries.
+        """
+        with self.sync_lock, self.lock:
+            self._rewrite()
+
+    def _rewrite(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as tmp_file:
+            for entry in self.pending_entries.values():
+                tmp_file.write(json.dumps(entry) + '\n')
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        if self.journal_file:
+            self.journal_file.close()
+        os.rename(tmp_path, self.path)
+        self.journal_file = open(self.path, 'a')
+        # Everything still pending was just fsynced in the new file.
+        self._mark_synced(self.next_seq - 1)
+
+    def _mark_synced(self, seq):
+        self.synced_seq = max(self.synced_seq, seq)
+        self.synced.notify_all()
+
+    def sync(self):
+        """
+        Makes every entry appended so far durable. Appends keep going while
+        the fsync runs.
+        """
+        with self.sync_lock:
+            with self.lock:
+                if self.journal_file is None:
+                    return
+                self.journal_file.flush()
+                covered = self.next_seq - 1
+                fd = self.journal_file.fileno()
+            os.fsync(fd)
+            with self.lock:
+                self._mark_synced(covered)
+
+    def _sync_loop(self):
+        while not self.closed.is_set():
+            if self.dirty.wait(self.sync_interval):
+                self.dirty.clear()
+                if not self.closed.is_set():
+                    self.sync()
+
+    def _read_checkpoint(self):
+        """
+        Returns - (journal_id, last applied seq). A new journal, or one
+        whose checkpoint was lost, gets a new ID so its seqs are not
+        mistaken for those of an earlier journal.
+        """
+        try:
+            with open(self.checkpoint_path) as checkpoint_file:
+                fields = checkpoint_file.read().split()
+        except (IOError, OSError):
+            fields = []
+        try:
+            if len(fields) == 2:
+                return fields[0], int(fields[1])
+        except ValueError:
+            pass
+        journal_id = uuid.uuid4().hex
+        self._write_checkpoint(0, journal_id)
+        return journal_id, 0
+
+    def _write_checkpoint(self, seq, journal_id=None):
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            checkpoint_file.write('%s %d' % (journal_id or self.journal_id,
+                                             seq))
+        os.rename(tmp_path, self.checkpoint_path)
+
+
+class WriteBehindOnlineStore(OnlineStore):
+
+    def __init__(self, backend, journal, retry_delay=0.5,
+                 max_retry_delay=30.0, compact_every=500):
+        """
+        Wraps an OnlineStore so cart mutations are acknowledged as soon as
+        they are journaled and applied to the backend in the background.
+        Parameters
+        ----------
+        backend - The OnlineStore that owns the data (e.g. Cloudant)
+        journal - CartJournal for unapplied mutations
+        retry_delay - First delay in seconds after a failed apply
+        max_retry_delay - Upper bound for the exponential retry delay
+        compact_every - Compact the journal after this many applied entries
+        """
+        self.backend = backend
+        self.journal = journal
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.compact_every = compact_every
+        self.applied_since_compact = 0
+        # Held while an entry is being applied so that reads never see an
+        # entry both in the backend and in the overlay (or in neither).
+        self.apply_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.flusher = None
+
+    def init(self):
+        self.backend.init()
+        self.journal.open()
+        self.stopping.clear()
+        self.flusher = threading.Thread(target=self._flush_loop,
+                                        name='cart-journal-flush')
+        self.flusher.daemon = True
+        self.flusher.start()
+        self.wakeup.set()
+
+    def stop(self, timeout=None):
+        """
+        Stops the flusher after it applies what it can within timeout, then
+        syncs and closes the journal and stops the backend. Entries that
+        were not applied are replayed by the next init().
+        """
+        self.stopping.set()
+        self.wakeup.set()
+        if self.flusher:
+            self.flusher.join(timeout)
+            if self.flusher.is_alive():
+                LOG.warning("Cart journal flush did not finish; {} entries "
+                            "will be replayed on restart".format(
+                                len(self.journal.pending())))
+            self.flusher = None
+        self.journal.close()
+        self.backend.stop(timeout)
+
+    # User
+
+    def add_customer_obj(self, customer):
+        return self.backend.add_customer_obj(customer)
+
+    def find_customer(self, customer_str):
+        return self.backend.find_customer(customer_str)
+
+    def archive_shopping_cart(self, customer_str, max_age, now=None):
+        return self.backend.archive_shopping_cart(customer_str, max_age, now)
+
+    def hot_document_sizes(self):
+        return self.backend.hot_document_sizes()
+
+    def list_shopping_cart(self, customer_str):
+        """
+        Gets shopping cart for customer, including mutations that were not
+        yet applied to the backend.
+        """
+        with self.apply_lock:
+            cart = self.backend.list_shopping_cart(customer_str)
+            entries = self.journal.pending(customer_str)
+        if cart is None:
+            return None
+        if entries:
+            cart = self.overlay(cart, entries)
+        return cart
+
+    @staticmethod
+    def overlay(cart, entries):
+        stored = cart_items.from_items(cart)
+        for entry in entries:
+            if entry['op'] == ADD:
+                cart_items.add_item(stored, entry['item'], entry['quantity'])
+            else:
+                cart_items.remove_item(stored, entry['product_id'],
+                                       entry['quantity'])
+        return cart_items.list_items(stored)
+
+    def add_to_shopping_cart(self, customer_str, item, quantity=1):
+        self.journal.append(ADD, customer_str, item=item, quantity=quantity)
+        self.wakeup.set()
+        return 1
+
+    def delete_item_shopping_cart(self, customer_str, product_id,
+                                  quantity=None):
+        cart = self.list_shopping_cart(customer_str) or []
+        if not any(item['product_id'] == product_id for item in cart):
+            return 0
+        self.journal.append(DELETE, customer_str, product_id=product_id,
+                            quantity=quantity)
+        self.wakeup.set()
+        return 1
+
+    # Background flush
+
+    def _apply(self, entry):
+        journal_entry = (self.journal.journal_id, entry['seq'])
+        if entry['op'] == ADD:
+            self.backend.add_to_shopping_cart(
+                entry['customer'], entry['item'], entry['quantity'],
+                journal_entry=journal_entry)
+        else:
+            self.backend.delete_item_shopping_cart(
+                entry['customer'], entry['product_id'], entry['quantity'],
+                journal_entry=journal_entry)
+
+    def flush(self):
+        """
+        Applies pending entries in order until one fails.
+        Returns - True if the journal is now empty
+        """
+        for entry in self.journal.pending():
+            with self.apply_lock:
+                # A crash between the backend write and the checkpoint
+                # replays this entry on restart; the backend recognizes
+                # its seq and skips it.
+                self._apply(entry)
+                self.journal.mark_applied(entry)
+            self.applied_since_compact += 1
+        if self.applied_since_compact >= self.compact_every:
+            self.journal.compact()
+            self.applied_since_compact = 0
+        return not self.journal.pending()
+
+    def _flush_loop(self):
+        delay = self.retry_delay
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            try:
+                self.flush()
+                delay = self.retry_delay
+            except Exception:
+                LOG.exception("Cart journal flush failed; retrying in "
+                              "{:.1f}s".format(delay))
+                if self.stopping.wait(delay):
+                    return
+                delay = min(delay * 2, self.max_retry_delay)
+                self.wakeup.set()
+                continue
+            # Entries journaled during that flush set wakeup; apply them
+            # before stopping.
+            if self.stopping.is_set() and not self.wakeup.is_set():
+                return
@@ -0,0 +1,315 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""In-process customer and cart cache kept coherent by the _changes feed.
+
+CachingOnlineStore serves find_customer and list_shopping_cart from
+memory. Its own writes drop the entries they change; writes by other bot
+replicas, admin tools or the cart archiver arrive on the database's
+_changes feed, which ChangesFeed long-polls from a background thread,
+and drop the entries for those document IDs. The feed's position is
+saved in a checkpoint file, so a restart resumes where it stopped.
+
+Entries are dropped rather than updated from the feed: a change may be
+older than what a concurrent read has just fetched.
+"""
+
+import base64
+import collections
+import json
+import logging
+import os
+import tempfile
+import threading
+
+try:
+    from urllib.parse import quote
+    from urllib.request import Request
+    from urllib.request import urlopen
+except ImportError:  # Python 2
+    from urllib import quote
+    from urllib2 import Request
+    from urllib2 import urlopen
+
+from watsononlinestore.database.online_store import OnlineStore
+from watsononlinestore.metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+# Cart doc IDs are this and the email; see cloudant_online_store.cart_doc_id
+CART_ID_PREFIX = 'cart:'
+# Customers whose identity and cart are cached.
+DEFAULT_MAX_ENTRIES = 10000
+# Seconds a long poll waits for changes before returning empty.
+DEFAULT_POLL_TIMEOUT = 30
+MAX_RETRY_DELAY = 60.0
+
+
+class ChangesFeed(object):
+
+    def __init__(self, url, db_name, username, password, checkpoint_path,
+                 on_change=None, poll_timeout=DEFAULT_POLL_TIMEOUT,
+                 retry_delay=1.0):
+        """
+        Long-polls a CouchDB/Cloudant database's _changes feed.
+
+        Parameters
+        ----------
+        url - Cloudant account URL
+        db_name - The database to follow
+        username, password - Cloudant credentials
+        checkpoint_path - File keeping the last seq handled; without it
+                          the feed starts from now
+        on_change - Called with the ID of each changed document
+        poll_timeout - Seconds the server may hold a poll open
+        retry_delay - Seconds before retrying a failed poll; doubles up
+                      to MAX_RETRY_DELAY
+        """
+        self.changes_url = '%s/%s/_changes' % (url.rstrip('/'),
+                                               quote(db_name, safe=''))
+        credentials = ('%s:%s' % (username, password)).encode('utf-8')
+        self.authorization = 'Basic ' + \
+            base64.b64encode(credentials).decode('ascii')
+        self.checkpoint_path = checkpoint_path
+        self.on_change = on_change
+        self.poll_timeout = poll_timeout
+        self.retry_delay = retry_delay
+        self.since = self._load_checkpoint()
+        self.stopping = threading.Event()
+        self.poller = None
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return 'now'
+        with open(self.checkpoint_path) as checkpoint_file:
+            return json.load(checkpoint_file)['since']
+
+    def _save_checkpoint(self):
+        directory = os.path.dirname(os.path.abspath(self.checkpoint_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as checkpoint_file:
+            json.dump({'since': self.since}, checkpoint_file)
+        os.rename(tmp_path, self.checkpoint_path)
+
+    def start(self):
+        self.stopping.clear()
+        self.poller = threading.Thread(target=self._poll_loop,
+                                       name='changes-feed')
+        self.poller.daemon = True
+        self.poller.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops after the poll in progress, which may take up to
+        poll_timeout seconds to return.
+        """
+        self.stopping.set()
+        if self.poller:
+            self.poller.join(timeout)
+            self.poller = None
+
+    def poll(self):
+        """
+        Waits up to poll_timeout for changes after the checkpoint and
+        hands their document IDs to on_change.
+        Returns - the number of changes
+        """
+        url = '%s?feed=longpoll&since=%s&timeout=%d' % (
+            self.changes_url, quote(str(self.since), safe=''),
+            self.poll_timeout * 1000)
+        request = Request(url, headers={'Authorization': self.authorization,
+                                        'Accept': 'application/json'})
+        response = urlopen(request, timeout=self.poll_timeout + 30)
+        try:
+            changes = json.loads(response.read().decode('utf-8'))
+        finally:
+            response.close()
+        results = changes.get('results', [])
+        for change in results:
+            self.on_change(change['id'])
+        METRICS.incr('changes.received', len(results))
+        if changes.get('last_seq') not in (None, self.since):
+            self.since = changes['last_seq']
+            self._save_checkpoint()
+        return len(results)
+
+    def _poll_loop(self):
+        delay = self.retry_delay
+        while not self.stopping.is_set():
+            try:
+                self.poll()
+                delay = self.retry_delay
+            except Exception:
+                METRICS.incr('changes.errors')
+                LOG.exception("Changes feed poll failed; retrying in "
+                              "{:.1f}s".format(delay))
+                if self.stopping.wait(delay):
+                    return
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+
+
+class CachingOnlineStore(OnlineStore):
+
+    def __init__(self, backend, feed=None, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        Wraps an OnlineStore with an in-process cache of customers and
+        carts.
+        Parameters
+        ----------
+        backend - The OnlineStore that owns the data (e.g. Cloudant)
+        feed - ChangesFeed of the backend's database, started and stopped
+               with the store. Without one, only this process may write.
+        max_entries - Customers cached; the least recently used go first
+        """
+        self.backend = backend
+        self.feed = feed
+        if feed:
+            feed.on_change = self.invalidate_doc
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.customers = collections.OrderedDict()
+        self.carts = collections.OrderedDict()
+        # Doc IDs (assigned by the database) of the cached customers.
+        self.customer_ids = {}
+        # Backend reads in progress by customer, and the customers whose
+        # entries were dropped during one: what those reads fetched may
+        # be stale, so it is not cached.
+        self.reading = collections.defaultdict(int)
+        self.stale = set()
+
+    def init(self):
+        self.backend.init()
+        if self.feed:
+            self.feed.start()
+
+    def stop(self, timeout=None):
+        if self.feed:
+            self.feed.stop(timeout)
+        self.backend.stop(timeout)
+
+    # Cache
+
+    def _cached(self, entries, customer_str, fetch):
+        """
+        Returns - the cached entry for customer_str, else what fetch()
+                  returns, which is cached unless it is None
+        """
+        with self.lock:
+            if customer_str in entries:
+                # Most recently used last.
+                entries[customer_str] = entries.pop(customer_str)
+                METRICS.incr('store_cache.hits')
+                return entries[customer_str]
+            METRICS.incr('store_cache.misses')
+            self.reading[customer_str] += 1
+        value = None
+        try:
+            value = fetch()
+        finally:
+            with self.lock:
+                self.reading[customer_str] -= 1
+                stale = customer_str in self.stale
+                if not self.reading[customer_str]:
+                    del self.reading[customer_str]
+                    self.stale.discard(customer_str)
+                if value is not None and not stale:
+                    entries[customer_str] = value
+                    if entries is self.customers and value.get('_id'):
+                        self.customer_ids[value['_id']] = customer_str
+                    while len(entries) > self.max_entries:
+                        self._forget(entries, *entries.popitem(last=False))
+        return value
+
+    def _forget(self, entries, customer_str, value):
+        if entries is self.customers:
+            self.customer_ids.pop(value.get('_id'), None)
+
+    def invalidate(self, customer_str):
+        """
+        Drops the cached customer and cart for customer_str.
+        """
+        with self.lock:
+            if customer_str in self.reading:
+                self.stale.add(customer_str)
+            for entries in (self.customers, self.carts):
+                if customer_str in entries:
+                    self._forget(entries, customer_str,
+                                 entries.pop(customer_str))
+
+    def invalidate_doc(self, doc_id):
+        """
+        Drops the cached entries for a changed document.
+        """
+        if doc_id.startswith(CART_ID_PREFIX):
+            customer_str = doc_id[len(CART_ID_PREFIX):]
+        else:
+            with self.lock:
+                customer_str = self.customer_ids.get(doc_id)
+        if customer_str is not None:
+            METRICS.incr('store_cache.invalidations')
+            self.invalidate(customer_str)
+
+    # User
+
+    def add_customer_obj(self, customer):
+        try:
+            return self.backend.add_customer_obj(customer)
+        finally:
+            self.invalidate(customer.email)
+
+    def find_customer(self, customer_str):
+        """
+        Finds the customer, from the cache if possible. Customers that
+        are not found are not cached: another replica may create them.
+        """
+        def fetch():
+            customer = self.backend.find_customer(customer_str)
+            return None if customer is None else dict(customer)
+        customer = self._cached(self.customers, customer_str, fetch)
+        return None if customer is None else dict(customer)
+
+    def list_shopping_cart(self, customer_str):
+        """
+        Gets shopping cart for customer, from the cache if possible.
+        Unknown customers are not cached.
+        """
+        cart = self._cached(
+            self.carts, customer_str,
+            lambda: self.backend.list_shopping_cart(customer_str))
+        return None if cart is None else [dict(item) for item in cart]
+
+    def add_to_shopping_cart(self, customer_str, item, quantity=1,
+                             journal_entry=None):
+        try:
+            return self.backend.add_to_shopping_cart(
+                customer_str, item, quantity, journal_entry=journal_entry)
+        finally:
+            self.invalidate(customer_str)
+
+    def delete_item_shopping_cart(self, customer_str, product_id,
+                                  quantity=None, journal_entry=None):
+        try:
+            return self.backend.delete_item_shopping_cart(
+                customer_str, product_id, quantity,
+                journal_entry=journal_entry)
+        finally:
+            self.invalidate(customer_str)
+
+    def archive_shopping_cart(self, customer_str, max_age, now=None):
+        try:
+            return self.backend.archive_shopping_cart(customer_str, max_age,
+                                                      now)
+        finally:
+            self.invalidate(customer_str)
+
+    def hot_document_sizes(self):
+        return self.backend.hot_document_sizes()
@@ -10,14 +10,39 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import json
 import logging
+import time
+
+from cloudant.document import Document
 from cloudant.query import Query
+from requests.exceptions import HTTPError
+
+from watsononlinestore.database import cart_items
+from watsononlinestore.database.online_store import OnlineStore
 
-logging.basicConfig(level=logging.DEBUG)
 LOG = logging.getLogger(__name__)
 
+# Identity lookups only need these fields. Customer docs written before
+# carts had their own docs may still embed a large 'shopping_cart'.
+CUSTOMER_FIELDS = ['_id', '_rev', 'type', 'email', 'first_name', 'last_name']
+
+
+def cart_doc_id(customer_str):
+    """Carts live in their own doc with an ID derived from the customer."""
+    return 'cart:' + customer_str
+
 
-class CloudantOnlineStore(object):
+def cart_archive_doc_id(customer_str, timestamp):
+    return 'cart_archive:%s:%d' % (customer_str, timestamp * 1000)
+
+
+def _has_status(error, status_code):
+    return (error.response is not None and
+            error.response.status_code == status_code)
+
+
+class CloudantOnlineStore(OnlineStore):
 
     def __init__(self, client, db_name):
         """
@@ -50,33 +75,43 @@ class CloudantOnlineStore(object):
     def add_customer_obj(self, customer):
         """
         Adds a new customer to Cloudant if a customer with the specified ID
-        does not already exist.
+        does not already exist. The customer's shopping cart is stored in a
+        separate cart doc.
 
         Parameters
         ----------
         email - The ID of the customer (typically the email address)
         first_name - First name of the customer
         last_name - Last name of the customer
-        purchase_history - Array of purchase_id
-        favorites - Array of strings for favorite purchases
+        shopping_cart - Array of cart item dicts
         """
         customer_doc = {
             'type': 'customer',
             'email': customer.email,
             'first_name': customer.first_name,
             'last_name': customer.last_name,
-            'shopping_cart': customer.shopping_cart
         }
-        return self.add_doc_if_not_exists(customer_doc, 'email')
+        doc = self.add_doc_if_not_exists(customer_doc, 'email')
+        try:
+            self.client.connect()
+            db = self.client[self.db_name]
+            if self._fetch_doc(db, cart_doc_id(customer.email)) is None:
+                cart = cart_items.from_items(customer.shopping_cart or [])
+                self._create_cart_doc(db, customer.email, cart)
+        finally:
+            self.client.disconnect()
+        return doc
 
     def find_customer(self, customer_str):
         """
         Finds the customer based on the specified customerStr in Cloudant.
+        Only the identity fields are fetched, never the shopping cart.
         Parameters
         ----------
         customer_str - The customer specified by the user
         """
-        return self.find_doc('customer', 'email', customer_str)
+        return self.find_doc('customer', 'email', customer_str,
+                             fields=CUSTOMER_FIELDS)
 
     def list_shopping_cart(self, customer_str):
         """
@@ -84,28 +119,42 @@ class CloudantOnlineStore(object):
         Parameters
         ----------
         customer_str - The customer specified by the user
-        Returns - shopping cart as a list
+        Returns - shopping cart as a list of item dicts
         """
-        doc = self.find_customer(customer_str)
-        if doc:
-            return doc['shopping_cart']
-        return doc  # None
+        try:
+            self.client.connect()
+            doc = self._cart_doc(self.client[self.db_name], customer_str)
+            if doc is None:
+                return None
+            return cart_items.list_items(doc['shopping_cart'])
+        finally:
+            self.client.disconnect()
 
-    def add_to_shopping_cart(self, customer_str, item):
+    def add_to_shopping_cart(self, customer_str, item, quantity=1,
+                             journal_entry=None):
         """
         Adds item to shopping cart for customer.
         Parameters
         ----------
         customer_str - The customer specified by the user
-        item - string representing item to add
+        item - item dict with product_id, name and url
+        quantity - How many to add
+        journal_entry - Optional (journal_id, seq) being applied; it is
+                        saved in the cart doc with the change
         """
-        user_doc = self.find_doc(
-            'customer', 'email', customer_str)
         try:
             self.client.connect()
-            current_doc = self.client[self.db_name][user_doc['_id']]
+            current_doc = self._cart_doc(self.client[self.db_name],
+                                         customer_str)
             if current_doc:
-                current_doc['shopping_cart'].append(item)
+                if cart_items.is_applied(current_doc.get('journal'),
+                                         journal_entry):
+                    return 1
+                cart_items.add_item(current_doc['shopping_cart'], item,
+                                    quantity)
+                if journal_entry:
+                    current_doc['journal'] = cart_items.journal_marker(
+                        journal_entry)
                 current_doc.save()
                 return 1
             return 0
@@ -113,22 +162,30 @@ class CloudantOnlineStore(object):
         finally:
             self.client.disconnect()
 
-    def delete_item_shopping_cart(self, customer_str, item):
+    def delete_item_shopping_cart(self, customer_str, product_id,
+                                  quantity=None, journal_entry=None):
         """
         Deletes item from shopping cart for customer.
         Parameters
         ----------
         customer_str - The customer specified by the user
-        item - string representing item to delete
+        product_id - Product ID of the item to delete
+        quantity - How many to remove; None removes the item entirely
+        journal_entry - Optional (journal_id, seq) being applied
         """
-        user_doc = self.find_doc(
-            'customer', 'email', customer_str)
         try:
             self.client.connect()
-            current_doc = self.client[self.db_name][user_doc['_id']]
+            current_doc = self._cart_doc(self.client[self.db_name],
+                                         customer_str)
             if current_doc:
-                if item in current_doc['shopping_cart']:
-                    current_doc['shopping_cart'].remove(item)
+                if cart_items.is_applied(current_doc.get('journal'),
+                                         journal_entry):
+                    return 1
+                if cart_items.remove_item(current_doc['shopping_cart'],
+                                          product_id, quantity):
+                    if journal_entry:
+                        current_doc['journal'] = cart_items.journal_marker(
+                            journal_entry)
                     current_doc.save()
                     return 1
             return 0
@@ -136,9 +193,175 @@ class CloudantOnlineStore(object):
         finally:
             self.client.disconnect()
 
+    def archive_shopping_cart(self, customer_str, max_age, now=None):
+        """
+        Moves cart entries that were added more than max_age seconds ago
+        into a new cold cart_archive doc, keeping the hot cart doc small.
+        Parameters
+        ----------
+        customer_str - The customer specified by the user
+        max_age - Age in seconds after which an entry is archived
+        Returns - the number of archived entries
+        """
+        now = now if now is not None else time.time()
+        try:
+            self.client.connect()
+            db = self.client[self.db_name]
+            current_doc = self._cart_doc(db, customer_str)
+            if not current_doc:
+                return 0
+            return self._archive_cart_doc(db, current_doc, now - max_age,
+                                          now)
+        finally:
+            self.client.disconnect()
+
+    def archive_shopping_carts(self, max_age, now=None):
+        """
+        Archives old entries from every cart doc (e.g. abandoned carts).
+        Returns - the number of archived entries
+        """
+        now = now if now is not None else time.time()
+        archived = 0
+        try:
+            self.client.connect()
+            db = self.client[self.db_name]
+            for current_doc in db:
+                if current_doc.get('type') == 'cart':
+                    archived += self._archive_cart_doc(
+                        db, current_doc, now - max_age, now)
+        finally:
+            self.client.disconnect()
+        LOG.info('Archived {} shopping cart entries.'.format(archived))
+        return archived
+
+    def hot_document_sizes(self):
+        """
+        Reports how big the customer and cart docs read on every turn are.
+        Returns - dict of doc type to count, total_bytes and max_bytes
+        """
+        report = dict((doc_type, {'count': 0, 'total_bytes': 0,
+                                  'max_bytes': 0})
+                      for doc_type in ('customer', 'cart'))
+        try:
+            self.client.connect()
+            for doc in self.client[self.db_name]:
+                sizes = report.get(doc.get('type'))
+                if sizes is None:
+                    continue
+                size = len(json.dumps(doc))
+                sizes['count'] += 1
+                sizes['total_bytes'] += size
+                sizes['max_bytes'] = max(sizes['max_bytes'], size)
+        finally:
+            self.client.disconnect()
+        return report
+
+    def migrate_shopping_carts(self):
+        """
+        Moves shopping carts that are still embedded in customer docs into
+        their own cart docs, converting legacy lists of strings.
+        Returns - the number of converted docs
+        """
+        migrated = 0
+        try:
+            self.client.connect()
+            db = self.client[self.db_name]
+            # Iterating the database pages through every document.
+            for current_doc in db:
+                if (current_doc.get('type') == 'customer' and
+                        'shopping_cart' in current_doc):
+                    self._split_customer_doc(db, current_doc)
+                    migrated += 1
+        finally:
+            self.client.disconnect()
+        LOG.info('Migrated {} shopping carts.'.format(migrated))
+        return migrated
+
+    # Cart docs
+
+    def _fetch_doc(self, db, doc_id):
+        doc = Document(db, doc_id)
+        try:
+            doc.fetch()
+        except HTTPError as e:
+            if _has_status(e, 404):
+                return None
+            raise
+        return doc
+
+    def _create_cart_doc(self, db, customer_str, cart):
+        return db.create_document({
+            '_id': cart_doc_id(customer_str),
+            'type': 'cart',
+            'email': customer_str,
+            'shopping_cart': cart
+        })
+
+    def _cart_doc(self, db, customer_str):
+        """
+        Gets the cart doc with a single fetch by ID. If there is none, this
+        is either an unknown customer (None) or a customer doc that still
+        embeds its cart, which is split out now.
+        """
+        doc = self._fetch_doc(db, cart_doc_id(customer_str))
+        if doc is not None:
+            return doc
+        customer_doc = self._query_doc(db, 'customer', 'email', customer_str)
+        if customer_doc is None:
+            return None
+        return self._split_customer_doc(
+            db, self._fetch_doc(db, customer_doc['_id']))
+
+    def _split_customer_doc(self, db, customer_doc):
+        cart = customer_doc.get('shopping_cart') or {}
+        if cart_items.is_legacy(cart):
+            cart = cart_items.migrate_cart(cart)
+        # Create the cart first: a crash in between leaves a duplicate
+        # cart in the customer doc, which the next migration drops.
+        doc_id = cart_doc_id(customer_doc['email'])
+        cart_doc = self._fetch_doc(db, doc_id)
+        if cart_doc is None:
+            try:
+                cart_doc = self._create_cart_doc(db, customer_doc['email'],
+                                                 cart)
+            except HTTPError as e:
+                if not _has_status(e, 409):
+                    raise
+                # Another replica split this customer first.
+                cart_doc = self._fetch_doc(db, doc_id)
+        while 'shopping_cart' in customer_doc:
+            del customer_doc['shopping_cart']
+            try:
+                customer_doc.save()
+            except HTTPError as e:
+                if not _has_status(e, 409):
+                    raise
+                # Changed since we read it, perhaps split already.
+                customer_doc.fetch()
+        return cart_doc
+
+    def _archive_cart_doc(self, db, cart_doc, cutoff, now):
+        cart = cart_doc['shopping_cart']
+        old = dict((pid, entry) for pid, entry in cart.items()
+                   if entry.get('added', 0) < cutoff)
+        if not old:
+            return 0
+        # Write the archive before trimming the cart so nothing is lost.
+        db.create_document({
+            '_id': cart_archive_doc_id(cart_doc['email'], now),
+            'type': 'cart_archive',
+            'email': cart_doc['email'],
+            'archived': now,
+            'shopping_cart': old
+        })
+        for pid in old:
+            del cart[pid]
+        cart_doc.save()
+        return len(old)
+
     # Cloudant Helper Methods
 
-    def find_doc(self, doc_type, property_name, property_value):
+    def find_doc(self, doc_type, property_name, property_value, fields=None):
         """
         Finds a doc based on the specified doc_type, property_name, and
         property_value.
@@ -149,22 +372,30 @@ class CloudantOnlineStore(object):
         property_name - The property name to search for
         property_value - The value that should match for the specified
                          property name
+        fields - Optional list of fields to return instead of the whole doc
         """
         try:
             self.client.connect()
-            db = self.client[self.db_name]
-            selector = {
-                '_id': {'$gt': 0},
-                'type': doc_type,
-                property_name: property_value
-            }
-            query = Query(db, selector=selector)
-            for doc in query()['docs']:
-                return doc
-            return None
+            return self._query_doc(self.client[self.db_name], doc_type,
+                                   property_name, property_value, fields)
         finally:
             self.client.disconnect()
 
+    def _query_doc(self, db, doc_type, property_name, property_value,
+                   fields=None):
+        selector = {
+            '_id': {'$gt': 0},
+            'type': doc_type,
+            property_name: property_value
+        }
+        if fields:
+            query = Query(db, selector=selector, fields=fields)
+        else:
+            query = Query(db, selector=selector)
+        for doc in query()['docs']:
+            return doc
+        return None
+
     def add_doc_if_not_exists(self, doc, unique_property_name):
         """
         Adds a new doc to Cloudant if a doc with the same value for
@@ -182,12 +413,12 @@ class CloudantOnlineStore(object):
         existing_doc = self.find_doc(
             doc_type, unique_property_name, property_value)
         if existing_doc is not None:
-            LOG.debug('Returning {} doc where {}={}'.format(
-                doc_type, unique_property_name, property_value))
+            LOG.debug('Returning %s doc where %s=%s', doc_type,
+                      unique_property_name, property_value)
             return existing_doc
         else:
-            LOG.debug('Creating {} doc where {}={}'.format(
-                doc_type, unique_property_name, property_value))
+            LOG.debug('Creating %s doc where %s=%s', doc_type,
+                      unique_property_name, property_value)
             try:
                 self.client.connect()
                 db = self.client[self.db_name]
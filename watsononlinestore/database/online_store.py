@@ -0,0 +1,126 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import abc
+
+# abc.ABC does not exist on Python 2; build the equivalent base class.
+ABC = abc.ABCMeta('ABC', (object,), {})
+
+
+class OnlineStore(ABC):
+    """Storage backend for customers and their shopping carts.
+
+    WatsonOnlineStore only talks to its store through these methods, so
+    any implementation (Cloudant, SQLite, ...) can be configured in run.py.
+    """
+
+    @abc.abstractmethod
+    def init(self):
+        """
+        Creates and initializes the database.
+        """
+
+    def stop(self, timeout=None):
+        """
+        Finishes outstanding writes and releases connections before the
+        process exits. Backends without either need not override this.
+        Parameters
+        ----------
+        timeout - Seconds to wait for outstanding writes (None waits)
+        """
+
+    @abc.abstractmethod
+    def add_customer_obj(self, customer):
+        """
+        Adds a new customer if a customer with the same email does not
+        already exist.
+        Parameters
+        ----------
+        customer - OnlineStoreCustomer to add
+        Returns - the stored customer as a dict
+        """
+
+    @abc.abstractmethod
+    def find_customer(self, customer_str):
+        """
+        Finds the customer based on the specified customer_str.
+        Parameters
+        ----------
+        customer_str - The customer specified by the user
+        Returns - the customer as a dict with email, first_name and
+                  last_name, or None if not found
+        """
+
+    @abc.abstractmethod
+    def list_shopping_cart(self, customer_str):
+        """
+        Gets shopping cart for customer.
+        Parameters
+        ----------
+        customer_str - The customer specified by the user
+        Returns - shopping cart as a list of item dicts (see cart_items) in
+                  the order they were added, or None if there is no customer
+        """
+
+    @abc.abstractmethod
+    def add_to_shopping_cart(self, customer_str, item, quantity=1,
+                             journal_entry=None):
+        """
+        Adds item to shopping cart for customer. Adding an item that is
+        already in the cart increments its quantity.
+        Parameters
+        ----------
+        customer_str - The customer specified by the user
+        item - item dict with product_id, name and url
+        quantity - How many to add
+        journal_entry - Optional (journal_id, seq) of the cart journal entry
+                        being applied. It is recorded with the cart in the
+                        same write, and the call does nothing if the cart
+                        already recorded that seq or a later one, so
+                        replaying a journal is idempotent.
+        Returns - 1 if the item was added, otherwise 0
+        """
+
+    @abc.abstractmethod
+    def delete_item_shopping_cart(self, customer_str, product_id,
+                                  quantity=None, journal_entry=None):
+        """
+        Deletes item from shopping cart for customer.
+        Parameters
+        ----------
+        customer_str - The customer specified by the user
+        product_id - Product ID of the item to delete
+        quantity - How many to remove; None removes the item entirely
+        journal_entry - Optional (journal_id, seq); see add_to_shopping_cart
+        Returns - 1 if the item was deleted, otherwise 0
+        """
+
+    @abc.abstractmethod
+    def archive_shopping_cart(self, customer_str, max_age, now=None):
+        """
+        Moves cart entries that were added more than max_age seconds ago
+        out of the cart that is read on every turn into cold storage.
+        Parameters
+        ----------
+        customer_str - The customer specified by the user
+        max_age - Age in seconds after which an entry is archived
+        now - Current time, for tests
+        Returns - the number of archived entries
+        """
+
+    @abc.abstractmethod
+    def hot_document_sizes(self):
+        """
+        Reports the size of the customer and cart records that are read on
+        every turn.
+        Returns - dict of record type to count, total_bytes and max_bytes
+        """
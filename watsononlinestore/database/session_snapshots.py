@@ -0,0 +1,156 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS session (
+        user_id TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        updated REAL NOT NULL
+    )""",
+    """CREATE INDEX IF NOT EXISTS session_updated ON session (updated)""",
+)
+
+# Sessions untouched for this long are dropped when the store opens.
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+
+
+class SessionSnapshots(object):
+
+    def __init__(self, db_path, interval=5.0, max_age=DEFAULT_MAX_AGE):
+        """
+        Keeps the latest snapshot of each changed session and writes them
+        to SQLite in one transaction every interval seconds.
+        Parameters
+        ----------
+        db_path - Path of the SQLite database file (':memory:' for tests)
+        interval - Seconds between writes of changed sessions
+        max_age - Seconds after which an unchanged session is forgotten
+        """
+        self.db_path = db_path
+        self.interval = interval
+        self.max_age = max_age
+        self.conn = None
+        self.lock = threading.Lock()
+        # Encoded snapshots not yet written, by user ID.
+        self.dirty = {}
+        self.stopping = threading.Event()
+        self.writer = None
+
+    def _connection(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_path,
+                                        check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+        return self.conn
+
+    def init(self):
+        """
+        Creates the table and drops sessions older than max_age.
+        """
+        with self.lock:
+            conn = self._connection()
+            with conn:
+                for statement in SCHEMA:
+                    conn.execute(statement)
+                cursor = conn.execute('DELETE FROM session WHERE updated < ?',
+                                      (time.time() - self.max_age,))
+        if cursor.rowcount:
+            LOG.info("Dropped {} expired session snapshots".format(
+                cursor.rowcount))
+
+    def start(self):
+        self.stopping.clear()
+        self.writer = threading.Thread(target=self._write_loop,
+                                       name='session-snapshots')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def stop(self, timeout=None):
+        """
+        Writes what is pending and stops the writer.
+        """
+        self.stopping.set()
+        if self.writer:
+            self.writer.join(timeout)
+            self.writer = None
+        self.flush()
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def put(self, user_id, data):
+        """
+        Records the latest state of a session, to be written later.
+        Parameters
+        ----------
+        user_id - Slack user ID
+        data - Session.export() output; encoded now, so later changes to
+               the session do not affect this snapshot
+        """
+        encoded = json.dumps(data, separators=(',', ':'))
+        with self.lock:
+            self.dirty[user_id] = encoded
+
+    def load(self, user_id):
+        """
+        Returns - the latest snapshot of the user's session, or None
+        """
+        with self.lock:
+            encoded = self.dirty.get(user_id)
+            if encoded is None:
+                row = self._connection().execute(
+                    'SELECT data FROM session WHERE user_id = ?',
+                    (user_id,)).fetchone()
+                encoded = row[0] if row else None
+        return json.loads(encoded) if encoded is not None else None
+
+    def flush(self):
+        """
+        Writes every pending snapshot in one transaction.
+        Returns - the number of sessions written
+        """
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+            if not dirty:
+                return 0
+            now = time.time()
+            try:
+                conn = self._connection()
+                with conn:
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO session (user_id, data, '
+                        'updated) VALUES (?, ?, ?)',
+                        [(user_id, encoded, now)
+                         for user_id, encoded in dirty.items()])
+            except sqlite3.Error:
+                # Keep them for the next attempt, unless newer ones came.
+                for user_id, encoded in dirty.items():
+                    self.dirty.setdefault(user_id, encoded)
+                raise
+        return len(dirty)
+
+    def _write_loop(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.flush()
+            except sqlite3.Error:
+                LOG.exception("Writing session snapshots failed")
@@ -0,0 +1,328 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import sqlite3
+import threading
+import time
+
+from watsononlinestore.database import cart_items
+from watsononlinestore.database.online_store import OnlineStore
+
+LOG = logging.getLogger(__name__)
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS customer (
+        id INTEGER PRIMARY KEY,
+        email TEXT NOT NULL UNIQUE,
+        first_name TEXT,
+        last_name TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS cart_item (
+        customer_id INTEGER NOT NULL REFERENCES customer(id),
+        product_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        url TEXT,
+        quantity INTEGER NOT NULL,
+        added REAL NOT NULL,
+        PRIMARY KEY (customer_id, product_id)
+    )""",
+    """CREATE INDEX IF NOT EXISTS cart_item_added
+        ON cart_item (customer_id, added)""",
+    """CREATE TABLE IF NOT EXISTS cart_item_archive (
+        customer_id INTEGER NOT NULL REFERENCES customer(id),
+        product_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        url TEXT,
+        quantity INTEGER NOT NULL,
+        added REAL NOT NULL,
+        archived REAL NOT NULL
+    )""",
+    """CREATE INDEX IF NOT EXISTS cart_item_archive_customer
+        ON cart_item_archive (customer_id, archived)""",
+    # Last cart journal entry applied to each customer's cart.
+    """CREATE TABLE IF NOT EXISTS cart_journal_applied (
+        customer_id INTEGER PRIMARY KEY REFERENCES customer(id),
+        journal_id TEXT NOT NULL,
+        seq INTEGER NOT NULL
+    )""",
+)
+
+# Approximate size of each customer record and of each customer's cart.
+HOT_RECORD_SIZES = {
+    'customer': "SELECT LENGTH(email) + IFNULL(LENGTH(first_name), 0) + "
+                "IFNULL(LENGTH(last_name), 0) + 8 AS size FROM customer",
+    'cart': "SELECT SUM(LENGTH(product_id) + LENGTH(name) + "
+            "IFNULL(LENGTH(url), 0) + 24) AS size FROM cart_item "
+            "GROUP BY customer_id",
+}
+
+
+class SQLiteOnlineStore(OnlineStore):
+
+    def __init__(self, db_path):
+        """
+        Creates a new instance of SQLiteOnlineStore.
+        Parameters
+        ----------
+        db_path - Path of the SQLite database file (':memory:' for tests)
+        """
+        self.db_path = db_path
+        self.conn = None
+        # One connection is shared by the bot and any background threads.
+        self.lock = threading.Lock()
+
+    def _connection(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_path,
+                                        check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row
+            # WAL lets readers proceed while a cart update commits, and
+            # NORMAL sync is durable across application crashes.
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('PRAGMA foreign_keys=ON')
+        return self.conn
+
+    def init(self):
+        """
+        Creates and initializes the database.
+        """
+        LOG.info('Initializing SQLite database {}...'.format(self.db_path))
+        with self.lock:
+            conn = self._connection()
+            with conn:
+                for statement in SCHEMA:
+                    conn.execute(statement)
+                self._migrate_legacy_cart(conn)
+
+    def _migrate_legacy_cart(self, conn):
+        """
+        Moves rows from the old free-text shopping_cart table to cart_item.
+        """
+        legacy = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name = 'shopping_cart'").fetchone()
+        if not legacy:
+            return
+        rows = conn.execute('SELECT customer_id, item FROM shopping_cart '
+                            'ORDER BY id').fetchall()
+        now = time.time()
+        for offset, (customer_id, text) in enumerate(rows):
+            item = cart_items.parse_legacy_item(text)
+            self._add_item(conn, customer_id, item, 1, now + offset * 1e-6)
+        conn.execute('DROP TABLE shopping_cart')
+        LOG.info('Migrated {} shopping cart rows.'.format(len(rows)))
+
+    def stop(self, timeout=None):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    # User
+
+    def add_customer_obj(self, customer):
+        """
+        Adds a new customer if a customer with the same email does not
+        already exist.
+        Parameters
+        ----------
+        customer - OnlineStoreCustomer to add
+        """
+        with self.lock:
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    'INSERT OR IGNORE INTO customer '
+                    '(email, first_name, last_name) VALUES (?, ?, ?)',
+                    (customer.email, customer.first_name,
+                     customer.last_name))
+                customer_id = self._customer_id(conn, customer.email)
+                for item in customer.shopping_cart or []:
+                    self._add_item(conn, customer_id, item,
+                                   item.get('quantity', 1), time.time())
+        return self.find_customer(customer.email)
+
+    def find_customer(self, customer_str):
+        """
+        Finds the customer based on the specified customer_str.
+        Parameters
+        ----------
+        customer_str - The customer specified by the user
+        """
+        with self.lock:
+            row = self._connection().execute(
+                'SELECT email, first_name, last_name FROM customer '
+                'WHERE email = ?', (customer_str,)).fetchone()
+        if row is None:
+            return None
+        customer = dict(zip(row.keys(), row))
+        customer['type'] = 'customer'
+        return customer
+
+    def _customer_id(self, conn, customer_str):
+        row = conn.execute('SELECT id FROM customer WHERE email = ?',
+                           (customer_str,)).fetchone()
+        return row[0] if row else None
+
+    def list_shopping_cart(self, customer_str):
+        """
+        Gets shopping cart for customer.
+        Parameters
+        ----------
+        customer_str - The customer specified by the user
+        Returns - shopping cart as a list of item dicts
+        """
+        with self.lock:
+            conn = self._connection()
+            customer_id = self._customer_id(conn, customer_str)
+            if customer_id is None:
+                return None
+            rows = conn.execute(
+                'SELECT product_id, name, url, quantity FROM cart_item '
+                'WHERE customer_id = ? ORDER BY added',
+                (customer_id,)).fetchall()
+        return [cart_items.new_item(*row) for row in rows]
+
+    def _add_item(self, conn, customer_id, item, quantity, added):
+        cursor = conn.execute(
+            'UPDATE cart_item SET quantity = quantity + ? '
+            'WHERE customer_id = ? AND product_id = ?',
+            (quantity, customer_id, item['product_id']))
+        if not cursor.rowcount:
+            conn.execute(
+                'INSERT INTO cart_item (customer_id, product_id, name, url, '
+                'quantity, added) VALUES (?, ?, ?, ?, ?, ?)',
+                (customer_id, item['product_id'], item['name'],
+                 item.get('url'), quantity, added))
+
+    def _claim_journal_entry(self, conn, customer_id, journal_entry):
+        """
+        Records journal_entry as applied, in the caller's transaction.
+        Returns - False if it was applied before
+        """
+        if journal_entry is None:
+            return True
+        row = conn.execute(
+            'SELECT journal_id, seq FROM cart_journal_applied '
+            'WHERE customer_id = ?', (customer_id,)).fetchone()
+        marker = {'id': row[0], 'seq': row[1]} if row else None
+        if cart_items.is_applied(marker, journal_entry):
+            return False
+        conn.execute(
+            'INSERT OR REPLACE INTO cart_journal_applied '
+            '(customer_id, journal_id, seq) VALUES (?, ?, ?)',
+            (customer_id,) + tuple(journal_entry))
+        return True
+
+    def add_to_shopping_cart(self, customer_str, item, quantity=1,
+                             journal_entry=None):
+        """
+        Adds item to shopping cart for customer.
+        Parameters
+        ----------
+        customer_str - The customer specified by the user
+        item - item dict with product_id, name and url
+        quantity - How many to add
+        journal_entry - Optional (journal_id, seq) being applied
+        """
+        with self.lock:
+            conn = self._connection()
+            with conn:
+                customer_id = self._customer_id(conn, customer_str)
+                if customer_id is None:
+                    return 0
+                if self._claim_journal_entry(conn, customer_id,
+                                             journal_entry):
+                    self._add_item(conn, customer_id, item, quantity,
+                                   time.time())
+                return 1
+
+    def delete_item_shopping_cart(self, customer_str, product_id,
+                                  quantity=None, journal_entry=None):
+        """
+        Deletes item from shopping cart for customer.
+        Parameters
+        ----------
+        customer_str - The customer specified by the user
+        product_id - Product ID of the item to delete
+        quantity - How many to remove; None removes the item entirely
+        journal_entry - Optional (journal_id, seq) being applied
+        """
+        with self.lock:
+            conn = self._connection()
+            with conn:
+                customer_id = self._customer_id(conn, customer_str)
+                if customer_id is None:
+                    return 0
+                if not self._claim_journal_entry(conn, customer_id,
+                                                 journal_entry):
+                    return 1
+                key = (customer_id, product_id)
+                if quantity is not None:
+                    cursor = conn.execute(
+                        'UPDATE cart_item SET quantity = quantity - ? '
+                        'WHERE customer_id = ? AND product_id = ? '
+                        'AND quantity > ?', (quantity,) + key + (quantity,))
+                    if cursor.rowcount:
+                        return 1
+                cursor = conn.execute(
+                    'DELETE FROM cart_item '
+                    'WHERE customer_id = ? AND product_id = ?', key)
+                return 1 if cursor.rowcount else 0
+
+    def archive_shopping_cart(self, customer_str, max_age, now=None):
+        """
+        Moves cart entries older than max_age seconds to cart_item_archive.
+        Parameters
+        ----------
+        customer_str - The customer specified by the user
+        max_age - Age in seconds after which an entry is archived
+        """
+        now = now if now is not None else time.time()
+        with self.lock:
+            conn = self._connection()
+            with conn:
+                customer_id = self._customer_id(conn, customer_str)
+                if customer_id is None:
+                    return 0
+                args = (customer_id, now - max_age)
+                conn.execute(
+                    'INSERT INTO cart_item_archive (customer_id, product_id, '
+                    'name, url, quantity, added, archived) '
+                    'SELECT customer_id, product_id, name, url, quantity, '
+                    'added, ? FROM cart_item '
+                    'WHERE customer_id = ? AND added < ?', (now,) + args)
+                cursor = conn.execute(
+                    'DELETE FROM cart_item WHERE customer_id = ? '
+                    'AND added < ?', args)
+                return cursor.rowcount
+
+    def hot_document_sizes(self):
+        """
+        Reports counts and approximate sizes of customer records and carts.
+        """
+        report = {}
+        with self.lock:
+            conn = self._connection()
+            for record_type, sizes in HOT_RECORD_SIZES.items():
+                count, total, largest = conn.execute(
+                    'SELECT COUNT(*), IFNULL(SUM(size), 0), '
+                    'IFNULL(MAX(size), 0) FROM (%s)' % sizes).fetchone()
+                report[record_type] = {'count': count,
+                                       'total_bytes': total,
+                                       'max_bytes': largest}
+        return report
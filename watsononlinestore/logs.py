@@ -0,0 +1,215 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Logging setup for the bot process.
+
+Modules only create loggers; run.py calls configure() once. Records on
+the message path are cheap unless they are written:
+
+- Payloads are logged as %-style arguments wrapped in Payload, so they
+  are neither formatted nor truncated when the level is disabled, and a
+  written one is cut to a bounded size.
+- Records carry a category (extra={'category': ...}). SamplingFilter
+  passes only a fraction of the records in a noisy category.
+- Records are put on a bounded queue and written by a background thread,
+  so the message loop never waits for the stream. When the queue is full
+  records are dropped and counted rather than blocking.
+"""
+
+import logging
+import os
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+try:
+    from logging.handlers import QueueHandler
+    from logging.handlers import QueueListener
+except ImportError:  # Python 2
+    QueueHandler = QueueListener = None
+
+from watsononlinestore.metrics import METRICS
+
+FORMAT = '%(asctime)s %(levelname)s %(name)s [%(category)s] %(message)s'
+# Characters of a payload kept in a log line.
+DEFAULT_TRUNCATE = 1000
+# Records that may wait for the writer thread.
+DEFAULT_QUEUE_SIZE = 10000
+
+LOG = logging.getLogger(__name__)
+
+
+class Payload(object):
+    """Log argument formatted only when the record is written, truncated.
+    """
+
+    __slots__ = ('value', 'limit')
+
+    # Applies to every Payload; configure() sets it from LOG_TRUNCATE.
+    default_limit = DEFAULT_TRUNCATE
+
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        text = str(self.value)
+        limit = self.limit or Payload.default_limit
+        if len(text) <= limit:
+            return text
+        return '%s... (%d more chars)' % (text[:limit], len(text) - limit)
+
+
+def category(name):
+    """
+    Returns - the extra= dict that puts a record in category name
+    """
+    return {'category': name}
+
+
+class SamplingFilter(logging.Filter):
+
+    def __init__(self, rates):
+        """
+        Passes the given fraction of records per category, spread evenly
+        (0.1 passes every tenth). Other records and warnings always pass.
+
+        :param rates: {category: fraction between 0 and 1}
+        """
+        logging.Filter.__init__(self)
+        self.rates = rates
+        self.credit = dict((name, 0.0) for name in rates)
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if not hasattr(record, 'category'):
+            record.category = '-'
+        rate = self.rates.get(record.category)
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        with self.lock:
+            self.credit[record.category] += rate
+            if self.credit[record.category] >= 1.0:
+                self.credit[record.category] -= 1.0
+                return True
+        METRICS.incr('log.sampled_out')
+        return False
+
+
+def parse_rates(spec):
+    """
+    Returns - {category: fraction} from "name=0.1,other=0.5"
+    """
+    rates = {}
+    for item in (spec or '').split(','):
+        if item.strip():
+            name, _, rate = item.partition('=')
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+if QueueHandler is not None:
+    class DroppingQueueHandler(QueueHandler):
+        """Never blocks the caller: records that do not fit are dropped."""
+
+        def enqueue(self, record):
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                METRICS.incr('log.dropped')
+
+
+# AsyncLogging instances whose writer thread is running.
+_RUNNING = set()
+
+
+class AsyncLogging(object):
+
+    def __init__(self, handler, filters=(), queue_size=DEFAULT_QUEUE_SIZE):
+        """
+        Routes records through a bounded queue to handler, which a
+        background thread writes. The thread is restarted in a forked
+        child (sharding workers), since threads do not survive a fork.
+
+        :param handler: Handler that does the writing
+        :param filters: Filters applied before a record is queued
+        """
+        self.handler = handler
+        self.filters = filters
+        self.queue_size = queue_size
+        self.logger = None
+        self.queue_handler = None
+        self.listener = None
+
+    def start(self, logger):
+        self.logger = logger
+        self.queue_handler = DroppingQueueHandler(
+            queue.Queue(self.queue_size))
+        for record_filter in self.filters:
+            self.queue_handler.addFilter(record_filter)
+        self.listener = QueueListener(self.queue_handler.queue, self.handler)
+        self.listener.start()
+        logger.addHandler(self.queue_handler)
+        _RUNNING.add(self)
+
+    def stop(self):
+        """Writes the records still queued and detaches from the logger."""
+        _RUNNING.discard(self)
+        if self.listener:
+            self.logger.removeHandler(self.queue_handler)
+            self.listener.stop()
+            self.listener = None
+
+    def _restart_in_child(self):
+        self.logger.removeHandler(self.queue_handler)
+        self.start(self.logger)
+
+
+def _restart_after_fork():
+    for async_logging in list(_RUNNING):
+        async_logging._restart_in_child()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def configure(level=None, sample_rates=None, truncate=None, stream=None,
+              environ=os.environ):
+    """
+    Sets up logging for the bot process, from LOG_LEVEL (default INFO),
+    LOG_SAMPLE ("category=fraction,...") and LOG_TRUNCATE unless given.
+    Returns - the AsyncLogging, or None where QueueHandler is missing
+              (Python 2) and records are written directly
+    """
+    level = level or environ.get('LOG_LEVEL', 'INFO').upper()
+    if sample_rates is None:
+        sample_rates = parse_rates(environ.get('LOG_SAMPLE'))
+    Payload.default_limit = int(truncate or environ.get(
+        'LOG_TRUNCATE', DEFAULT_TRUNCATE))
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    sampling = SamplingFilter(sample_rates)
+    root = logging.getLogger()
+    root.setLevel(level)
+    if QueueHandler is None:
+        handler.addFilter(sampling)
+        root.addHandler(handler)
+        return None
+    async_logging = AsyncLogging(handler, filters=[sampling])
+    async_logging.start(root)
+    return async_logging
@@ -0,0 +1,252 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Where the bot's memory goes.
+
+report() attributes memory to sessions and to the subsystems holding it
+(dialog context, customer and cart, cached Discovery results, and the
+admission and Slack outbox buffers), by walking the objects. With a
+MemoryTracker running, it also has tracemalloc's view: memory traced per
+module, the source lines that grew since tracking started, and the
+traced total sampled over time, to tell a leak from a busy hour.
+"""
+
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    from urllib.parse import parse_qs
+except ImportError:  # Python 2
+    from urlparse import parse_qs
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+from watsononlinestore.metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+# Session attributes and the subsystem they are reported under.
+SESSION_SUBSYSTEMS = (('context', 'context'),
+                      ('customer', 'customer'),
+                      ('response_tuple', 'cached_results'),
+                      ('result_cursor', 'cached_results'))
+DEFAULT_TOP = 10
+DEFAULT_INTERVAL = 60.0
+# Samples of the traced total kept for growth over time.
+HISTORY = 1440
+
+
+def deep_size(obj, seen=None):
+    """
+    Returns - bytes of obj and everything it refers to through
+              containers and instance attributes, counting each object
+              in seen only once
+    """
+    if seen is None:
+        seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            # list() copies without running Python code, so a dict that
+            # another thread changes can not fail the walk.
+            for key, value in list(obj.items()):
+                stack.append(key)
+                stack.append(value)
+        elif isinstance(obj, (list, tuple, set, frozenset,
+                              collections.deque)):
+            stack.extend(list(obj))
+        elif hasattr(obj, '__dict__') and not isinstance(obj, type):
+            stack.append(obj.__dict__)
+        for slot in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, slot):
+                stack.append(getattr(obj, slot))
+    return size
+
+
+def session_usage(session, seen=None):
+    """
+    Returns - {subsystem: bytes} for one Session
+    """
+    usage = collections.defaultdict(int)
+    for name, subsystem in SESSION_SUBSYSTEMS:
+        usage[subsystem] += deep_size(getattr(session, name, None), seen)
+    return dict(usage)
+
+
+def _buffer_size(component, attribute):
+    if component is None:
+        return 0
+    with component.condition:
+        return deep_size(getattr(component, attribute))
+
+
+def session_report(wos, top=DEFAULT_TOP):
+    """
+    Memory held in wos's sessions and message buffers. An object shared
+    by several sessions is counted for the first one only.
+    Returns - {'sessions': count, 'bytes': {subsystem: bytes},
+               'top': the top sessions by bytes, largest first}
+    """
+    seen = set()
+    totals = dict((subsystem, 0) for _, subsystem in SESSION_SUBSYSTEMS)
+    rows = []
+    for user, session in list(wos.sessions.items()):
+        usage = session_usage(session, seen)
+        for subsystem, size in usage.items():
+            totals[subsystem] += size
+        usage['bytes'] = sum(usage.values())
+        usage['user'] = user
+        rows.append(usage)
+    totals['admission'] = _buffer_size(getattr(wos, 'admission', None),
+                                       'pending')
+    totals['slack_outbox'] = _buffer_size(getattr(wos, 'slack_outbox', None),
+                                          'channels')
+    rows.sort(key=lambda row: row['bytes'], reverse=True)
+    return {'sessions': len(rows), 'bytes': totals, 'top': rows[:top]}
+
+
+class MemoryTracker(object):
+
+    def __init__(self, wos, interval=DEFAULT_INTERVAL, frames=1,
+                 history=HISTORY):
+        """
+        Traces allocations with tracemalloc and samples the traced total
+        every interval seconds. Tracing costs time and memory on every
+        allocation, so this is a diagnostics mode, off by default.
+
+        :param wos: WatsonOnlineStore whose sessions are counted
+        :param frames: Stack frames stored per allocation
+        :param history: Samples kept
+        """
+        self.wos = wos
+        self.interval = interval
+        self.frames = frames
+        self.history = collections.deque(maxlen=history)
+        self.baseline = None
+        # Whether this tracker started tracemalloc (and so stops it):
+        # the trackers of several tenants share the process's tracing.
+        self.started_tracing = False
+        self.stopping = threading.Event()
+        self.sampler = None
+
+    @staticmethod
+    def _snapshot():
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>')))
+
+    def start(self):
+        if tracemalloc is None:
+            LOG.warning("tracemalloc is not available; memory is only "
+                        "reported by session")
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.started_tracing = True
+        self.baseline = self._snapshot()
+        self.sample()
+        self.stopping.clear()
+        self.sampler = threading.Thread(target=self._sample_loop,
+                                        name='memory-tracker')
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.sampler:
+            self.sampler.join()
+            self.sampler = None
+            if self.started_tracing:
+                tracemalloc.stop()
+                self.started_tracing = False
+
+    def _sample_loop(self):
+        while not self.stopping.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        traced, _ = tracemalloc.get_traced_memory()
+        self.history.append({'time': time.time(), 'traced': traced,
+                             'sessions': len(self.wos.sessions)})
+        METRICS.set_gauge('memory.traced_bytes', traced)
+
+    def growth(self):
+        """
+        Returns - bytes gained between the first and latest samples, per
+                  hour, and the latest traced bytes per session; None
+                  with fewer than two samples
+        """
+        if len(self.history) < 2:
+            return None
+        first, last = self.history[0], self.history[-1]
+        hours = (last['time'] - first['time']) / 3600.0
+        grown = last['traced'] - first['traced']
+        return {'bytes': grown,
+                'bytes_per_hour': grown / hours if hours else None,
+                'traced_per_session': (float(last['traced']) /
+                                       last['sessions']
+                                       if last['sessions'] else None)}
+
+    def report(self, top=DEFAULT_TOP):
+        """
+        Returns - traced memory now and at its peak, the top modules by
+                  traced bytes, the top source lines by growth since
+                  start(), the growth and the recent samples
+        """
+        if self.baseline is None:
+            return None
+        traced, peak = tracemalloc.get_traced_memory()
+        snapshot = self._snapshot()
+        modules = [{'module': stat.traceback[0].filename,
+                    'bytes': stat.size, 'blocks': stat.count}
+                   for stat in snapshot.statistics('filename')[:top]]
+        grown = [{'where': '%s:%d' % (stat.traceback[0].filename,
+                                      stat.traceback[0].lineno),
+                  'bytes': stat.size_diff, 'blocks': stat.count_diff}
+                 for stat in snapshot.compare_to(self.baseline,
+                                                 'lineno')[:top]]
+        return {'traced': traced, 'peak': peak, 'modules': modules,
+                'grown_since_start': grown, 'growth': self.growth(),
+                'history': list(self.history)[-top:]}
+
+
+def top_from(environ):
+    """
+    Returns - the number of entries asked for, e.g. /admin/memory?top=20
+    """
+    query = parse_qs(environ.get('QUERY_STRING', ''))
+    return int(query.get('top', [DEFAULT_TOP])[0])
+
+
+def report(wos, top=DEFAULT_TOP):
+    """
+    Returns - session and subsystem usage, and tracemalloc's report if
+              wos has a MemoryTracker
+    """
+    tracker = getattr(wos, 'memory_tracker', None)
+    return {'pid': os.getpid(),
+            'sessions': session_report(wos, top),
+            'tracemalloc': tracker.report(top) if tracker else None}
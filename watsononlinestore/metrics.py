@@ -0,0 +1,161 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import contextlib
+import threading
+import time
+
+# Keep this many recent samples per timing for percentiles.
+SAMPLE_WINDOW = 1000
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def scope(name):
+    """
+    While active, metrics recorded in this thread are also recorded as
+    "tenant.<name>.<metric>", so one process hosting several tenants
+    reports each one's own. A name of None adds nothing.
+    """
+    previous = getattr(_local, 'scope', None)
+    _local.scope = name
+    try:
+        yield
+    finally:
+        _local.scope = previous
+
+
+def _names(name):
+    current = getattr(_local, 'scope', None)
+    if current is None:
+        return (name,)
+    return (name, 'tenant.%s.%s' % (current, name))
+
+
+class Timing(object):
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = collections.deque(maxlen=SAMPLE_WINDOW)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        index = min(int(fraction * len(ordered)), len(ordered) - 1)
+        return ordered[index]
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.percentile(0.50),
+                'p95': self.percentile(0.95),
+                'max': self.max}
+
+
+class Metrics(object):
+    """In-process counters, gauges and timings.
+
+    snapshot() returns everything as a plain dict for logging or export.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(int)
+        self.gauges = {}
+        self.timings = collections.defaultdict(Timing)
+
+    def incr(self, name, value=1):
+        with self.lock:
+            for scoped in _names(name):
+                self.counters[scoped] += value
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            for scoped in _names(name):
+                self.gauges[scoped] = value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            for scoped in _names(name):
+                self.timings[scoped].observe(seconds)
+
+    def percentile(self, name, fraction, min_samples=1):
+        """
+        Returns - the timing's recent percentile, or None with fewer than
+                  min_samples samples
+        """
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None or len(timing.samples) < min_samples:
+                return None
+            return timing.percentile(fraction)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'gauges': dict(self.gauges),
+                    'timings': dict((name, timing.summary())
+                                    for name, timing in self.timings.items())}
+
+
+def merge_snapshots(snapshots):
+    """
+    Combines snapshots from several processes into one. Counters and
+    gauges are summed. Timing counts are summed and means weighted by
+    count; the raw samples stay in each process, so p50, p95 and max are
+    the highest of any process, an upper bound on the overall value.
+    """
+    merged = {'counters': collections.defaultdict(int),
+              'gauges': collections.defaultdict(int),
+              'timings': {}}
+    for snapshot in snapshots:
+        for name, value in snapshot['counters'].items():
+            merged['counters'][name] += value
+        for name, value in snapshot['gauges'].items():
+            merged['gauges'][name] += value
+        for name, summary in snapshot['timings'].items():
+            total = merged['timings'].setdefault(
+                name, {'count': 0, 'mean': 0.0, 'p50': 0.0, 'p95': 0.0,
+                       'max': 0.0})
+            count = total['count'] + summary['count']
+            if count:
+                total['mean'] = ((total['mean'] * total['count'] +
+                                  summary['mean'] * summary['count']) / count)
+            total['count'] = count
+            for key in ('p50', 'p95', 'max'):
+                total[key] = max(total[key], summary[key])
+    merged['counters'] = dict(merged['counters'])
+    merged['gauges'] = dict(merged['gauges'])
+    return merged
+
+
+# Process-wide registry used by the bot.
+METRICS = Metrics()
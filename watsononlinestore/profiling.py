@@ -0,0 +1,229 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Sampling profiler for the running bot.
+
+A background thread records the stack of every other thread at a fixed
+interval, so the profiled code runs at full speed. Profiles are written
+in the folded format ("thread;file:function;... count" per line) read by
+flamegraph.pl, speedscope and similar tools.
+
+Profiler can be started and stopped on demand (SIGUSR2, or the
+/admin/profile endpoint), and can also capture each message that takes
+longer than a threshold.
+"""
+
+import collections
+import contextlib
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+try:
+    from urllib.parse import parse_qs
+except ImportError:  # Python 2
+    from urlparse import parse_qs
+
+from watsononlinestore.metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+# Seconds between samples.
+DEFAULT_INTERVAL = 0.005
+# Deepest stack recorded; deeper frames are cut off at the root.
+MAX_DEPTH = 100
+
+ACTIONS = ('status', 'start', 'stop', 'toggle')
+
+
+def fold(frame, thread_name):
+    """
+    Returns - the stack ending in frame as "thread;file:function;..."
+    """
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        code = frame.f_code
+        names.append('%s:%s' % (os.path.basename(code.co_filename),
+                                code.co_name))
+        frame = frame.f_back
+    names.append(thread_name)
+    names.reverse()
+    return ';'.join(names)
+
+
+def write_folded(stacks, path):
+    """
+    Writes {folded stack: samples} to path, one "stack count" per line.
+    """
+    with open(path, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write('%s %d\n' % (stack, count))
+    return path
+
+
+class SamplingProfiler(object):
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        """
+        Samples the stacks of all other threads every interval seconds
+        between start() and stop().
+        """
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.started_at = None
+        self.thread = None
+        self.stopping = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.started_at = time.time()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name='profiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Returns - {folded stack: samples} recorded since start()
+        """
+        if self.thread:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+        return self.stacks
+
+    def _run(self):
+        own = threading.current_thread().ident
+        while not self.stopping.wait(self.interval):
+            self.sample(skip=own)
+
+    def sample(self, skip=None):
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident != skip:
+                self.stacks[fold(frame, names.get(ident, str(ident)))] += 1
+        self.samples += 1
+
+
+class Profiler(object):
+
+    def __init__(self, directory, interval=DEFAULT_INTERVAL,
+                 slow_message=None):
+        """
+        On-demand and slow-message profiles for one bot process, written
+        to directory.
+
+        :param interval: Seconds between samples
+        :param slow_message: If set, messages taking at least this many
+                             seconds are profiled and written
+        """
+        self.directory = directory
+        self.interval = interval
+        self.slow_message = slow_message
+        self.lock = threading.Lock()
+        self.on_demand = SamplingProfiler(interval)
+        self.last_path = None
+
+    def _path(self, kind, label=None):
+        name = '%s-%s-%d' % (kind, time.strftime('%Y%m%d-%H%M%S'),
+                             os.getpid())
+        if label:
+            name += '-' + label
+        return os.path.join(self.directory, name + '.folded')
+
+    def status(self):
+        return {'running': self.on_demand.running,
+                'pid': os.getpid(),
+                'last_path': self.last_path}
+
+    def start(self):
+        with self.lock:
+            if not self.on_demand.running:
+                self.on_demand.start()
+                LOG.info("Profiling started")
+        return self.status()
+
+    def stop(self):
+        """
+        Stops the on-demand profile and writes it.
+        Returns - the status, with the profile's path in last_path
+        """
+        with self.lock:
+            if self.on_demand.running:
+                stacks = self.on_demand.stop()
+                self.last_path = write_folded(stacks, self._path('profile'))
+                LOG.info("Profile of %d samples written to %s",
+                         self.on_demand.samples, self.last_path)
+        return self.status()
+
+    def toggle(self):
+        if self.on_demand.running:
+            return self.stop()
+        return self.start()
+
+    def control(self, action):
+        """
+        Runs one of ACTIONS.
+        Returns - the status
+        """
+        if action not in ACTIONS:
+            raise ValueError("action must be one of: %s" % ", ".join(ACTIONS))
+        return getattr(self, action)()
+
+    @contextlib.contextmanager
+    def message(self, label):
+        """
+        Profiles the block if slow_message is set, and writes the profile
+        if the block took at least slow_message seconds.
+        """
+        if self.slow_message is None:
+            yield
+            return
+        sampler = SamplingProfiler(self.interval)
+        sampler.start()
+        try:
+            yield
+        finally:
+            stacks = sampler.stop()
+            seconds = time.time() - sampler.started_at
+            if seconds >= self.slow_message:
+                METRICS.incr('profile.slow_messages')
+                path = write_folded(stacks, self._path('message', label))
+                LOG.warning("Message took %.2fs; profile written to %s",
+                            seconds, path)
+
+
+def action_from(environ):
+    """
+    Returns - the action in the request's query string, e.g.
+              /admin/profile?action=start (default status)
+    """
+    query = parse_qs(environ.get('QUERY_STRING', ''))
+    return query.get('action', ['status'])[0]
+
+
+def install_signal(profiler, signum=getattr(signal, 'SIGUSR2', None)):
+    """
+    Toggles profiler's on-demand profile on signum. Forked sharding
+    workers inherit the handler, so each one can be signalled directly.
+    """
+    if signum is not None:
+        signal.signal(signum, lambda signum, frame: profiler.toggle())
@@ -0,0 +1,213 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Product cards and cart listings rendered for Slack.
+
+The same products come back in search after search, and a cart is listed
+far more often than it changes. Renderer keeps each product's card (its
+fields dug out of the Discovery result and escaped for Slack) by product,
+and each user's last cart listing, so only what changed is rendered
+again. Result lists can also be shown as a Block Kit attachment with an
+image thumbnail per product.
+"""
+
+import collections
+import threading
+
+from watsononlinestore.metrics import METRICS
+
+# Products whose cards are kept; the least recently used go first.
+DEFAULT_MAX_CARDS = 10000
+# Users whose last cart listing is kept.
+DEFAULT_MAX_CARTS = 1000
+
+
+def slack_encode(input_text):
+    """Slack does not like <, &, >. That's all."""
+
+    if not input_text:
+        return input_text
+
+    args = [('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;')]
+    for from_to in args:
+        input_text = input_text.replace(*from_to)
+
+    return input_text
+
+
+def slack_decode(input_text):
+    """The text slack_encode was given."""
+
+    if not input_text:
+        return input_text
+
+    args = [('&gt;', '>'), ('&lt;', '<'), ('&amp;', '&')]
+    for from_to in args:
+        input_text = input_text.replace(*from_to)
+
+    return input_text
+
+
+def product_card(product_id, name, url, image):
+    """
+    Returns - the product's fields escaped for Slack, as kept in a
+              session's search results
+    """
+    return {'product_id': product_id,
+            'name': slack_encode(name),
+            'url': slack_encode(url),
+            'image': slack_encode(image)}
+
+
+def cart_line(item):
+    """
+    Returns - one item of a cart listing, without its number
+    """
+    if item['quantity'] > 1:
+        return '%s (x%d): %s\n' % (item['name'], item['quantity'],
+                                   item['url'])
+    return '%s: %s\n' % (item['name'], item['url'])
+
+
+def result_listing(entries):
+    """
+    Returns - numbered search results (see product_card, with a
+              cart_number) as text for the dialog
+    """
+    return ''.join(['\n%s) %s\n%s' % (entry['cart_number'], entry['name'],
+                                      entry['image'])
+                    for entry in entries])
+
+
+def result_block(entry):
+    """
+    Returns - a Block Kit section for one numbered search result, with
+              the product's image as its thumbnail
+    """
+    if entry['url']:
+        link = '<%s|%s>' % (entry['url'], entry['name'])
+    else:
+        link = entry['name']
+    block = {'type': 'section',
+             'text': {'type': 'mrkdwn',
+                      'text': '*%s)* %s' % (entry['cart_number'], link)}}
+    if entry['image']:
+        block['accessory'] = {
+            'type': 'image',
+            'image_url': slack_decode(entry['image']),
+            'alt_text': slack_decode(entry['name']) or entry['product_id']
+            or 'product'}
+    return block
+
+
+def result_attachments(entries):
+    """
+    Returns - the numbered search results as Slack attachments, or None
+              if there are none
+    """
+    if not entries:
+        return None
+    return [{'fallback': result_listing(entries).strip(),
+             'blocks': [result_block(entry) for entry in entries]}]
+
+
+class CartListing(object):
+    """The rendered listing of one cart and the items it shows."""
+
+    __slots__ = ('items', 'ends', 'text')
+
+    def __init__(self):
+        self.items = []
+        # Length of text through each item.
+        self.ends = []
+        self.text = ''
+
+
+class Renderer(object):
+
+    def __init__(self, max_cards=DEFAULT_MAX_CARDS,
+                 max_carts=DEFAULT_MAX_CARTS):
+        """
+        Caches product cards and cart listings for one bot.
+
+        :param max_cards: Products whose cards are kept
+        :param max_carts: Users whose cart listings are kept
+        """
+        self.max_cards = max_cards
+        self.max_carts = max_carts
+        self.lock = threading.Lock()
+        # {key: (source, card)}; source is what the card was made from.
+        self.cards = collections.OrderedDict()
+        self.carts = collections.OrderedDict()
+
+    @staticmethod
+    def _touch(entries, key, value, limit):
+        entries[key] = value
+        while len(entries) > limit:
+            entries.popitem(last=False)
+
+    def card(self, key, source, make):
+        """
+        Returns - the card made from source for the product key, made by
+                  make() unless the cached one was made from an equal
+                  source. Cards are shared; callers must copy them.
+        """
+        with self.lock:
+            cached = self.cards.pop(key, None)
+            if cached is not None and cached[0] == source:
+                self.cards[key] = cached
+                METRICS.incr('render.card_hits')
+                return cached[1]
+        METRICS.incr('render.card_misses')
+        card = make()
+        with self.lock:
+            self._touch(self.cards, key, (source, card), self.max_cards)
+        return card
+
+    def cart_listing(self, key, items):
+        """
+        Renders a numbered cart listing for the user key. Items are
+        compared with those of the user's last listing, and only the
+        items from the first one that changed are rendered again:
+        adding an item renders just that item, and an unchanged cart
+        renders nothing.
+
+        :param items: The cart, as item dicts (see cart_items)
+        """
+        with self.lock:
+            listing = self.carts.pop(key, None) or CartListing()
+        old = listing.items
+        if old == items:
+            METRICS.incr('render.cart_hits')
+        else:
+            same = 0
+            limit = min(len(old), len(items))
+            while same < limit and old[same] == items[same]:
+                same += 1
+            METRICS.incr('render.cart_renders')
+            parts = [listing.text[:listing.ends[same - 1]] if same else '']
+            ends = listing.ends[:same]
+            end = len(parts[0])
+            for number in range(same, len(items)):
+                part = '%d) %s' % (number + 1, cart_line(items[number]))
+                parts.append(part)
+                end += len(part)
+                ends.append(end)
+            # Copies, so a caller changing its items later can not make
+            # the listing look current.
+            listing.items = old[:same] + [dict(item)
+                                          for item in items[same:]]
+            listing.ends = ends
+            listing.text = ''.join(parts)
+        with self.lock:
+            self._touch(self.carts, key, listing, self.max_carts)
+        return listing.text
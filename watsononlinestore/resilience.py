@@ -0,0 +1,235 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Deadlines, hedged requests and circuit breakers for remote calls.
+
+The Watson SDK clients take no timeout, so each call runs on its own
+daemon thread and the caller stops waiting at the deadline. A call that
+is abandoned keeps running in the background until the SDK returns.
+"""
+
+import logging
+import threading
+import time
+
+from watsononlinestore.metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+# Circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Hedge only once this many latencies are known.
+MIN_HEDGE_SAMPLES = 20
+
+
+class ServiceUnavailable(Exception):
+    """A call failed, timed out or was refused by an open breaker."""
+
+
+class DeadlineExceeded(ServiceUnavailable):
+    pass
+
+
+class CircuitOpen(ServiceUnavailable):
+    pass
+
+
+class LatencyBudget(object):
+
+    def __init__(self, seconds, clock=time.time):
+        """
+        Time left for all remote calls made while handling one message.
+        """
+        self.clock = clock
+        self.deadline = clock() + seconds
+
+    def remaining(self):
+        return max(self.deadline - self.clock(), 0.0)
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0,
+                 slow_call=None, clock=time.time):
+        """
+        Opens after failure_threshold failures in a row, then lets one
+        trial call through every reset_timeout seconds until one succeeds.
+
+        :param slow_call: Calls slower than this many seconds count as
+                          failures even if they succeed
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call = slow_call
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def _set_state(self, state):
+        if state != self.state:
+            LOG.warning("Circuit breaker {} is now {}".format(
+                self.name, state))
+            self.state = state
+        METRICS.set_gauge('breaker.%s.open' % self.name,
+                          int(state != CLOSED))
+
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if (self.state == OPEN and
+                    self.clock() - self.opened_at >= self.reset_timeout):
+                # Let a single trial call through.
+                self._set_state(HALF_OPEN)
+                return True
+            return False
+
+    def record(self, ok, seconds=0.0):
+        if ok and self.slow_call is not None and seconds > self.slow_call:
+            ok = False
+        with self.lock:
+            if ok:
+                self.failures = 0
+                self._set_state(CLOSED)
+                return
+            self.failures += 1
+            if (self.state == HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                self.opened_at = self.clock()
+                self._set_state(OPEN)
+
+
+class _Attempt(object):
+
+    def __init__(self, func, kwargs, condition):
+        self.result = None
+        self.error = None
+        self.finished = False
+        self.thread = threading.Thread(
+            target=self._run, args=(func, kwargs, condition))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, func, kwargs, condition):
+        try:
+            self.result = func(**kwargs)
+        except Exception as e:
+            self.error = e
+        with condition:
+            self.finished = True
+            condition.notify_all()
+
+
+class ResilientCaller(object):
+
+    def __init__(self, name, timeout=10.0, min_timeout=1.0, hedge=True,
+                 breaker=None, fallback=None, clock=time.time):
+        """
+        Calls a remote service with a deadline, a hedged second attempt
+        and a circuit breaker.
+
+        :param name: Service name used for metrics
+        :param timeout: Most seconds a single call may take
+        :param min_timeout: Fewest seconds a call gets, even when the
+                            message's budget is nearly spent
+        :param hedge: Start a second attempt once the first is slower than
+                      the service's p95 (only for idempotent calls)
+        :param fallback: Called with the call's kwargs in place of a call
+                         that fails; without one ServiceUnavailable is
+                         raised
+        """
+        self.name = name
+        self.timeout = timeout
+        self.min_timeout = min_timeout
+        self.hedge = hedge
+        self.breaker = breaker or CircuitBreaker(name)
+        self.fallback = fallback
+        self.clock = clock
+
+    def hedge_delay(self):
+        """
+        Seconds to wait for the first attempt before starting another.
+        """
+        if not self.hedge:
+            return None
+        return METRICS.percentile('%s.seconds' % self.name, 0.95,
+                                  min_samples=MIN_HEDGE_SAMPLES)
+
+    def call(self, func, budget=None, **kwargs):
+        """
+        Returns - func(**kwargs), or the fallback's result if it fails
+        """
+        try:
+            return self._call(func, budget, kwargs)
+        except ServiceUnavailable as e:
+            LOG.warning("{} unavailable: {}".format(self.name, e))
+            if self.fallback is None:
+                raise
+            METRICS.incr('%s.fallback' % self.name)
+            return self.fallback(**kwargs)
+
+    def _call(self, func, budget, kwargs):
+        if not self.breaker.allow():
+            METRICS.incr('%s.short_circuit' % self.name)
+            raise CircuitOpen('circuit breaker is open')
+        timeout = self.timeout
+        if budget is not None:
+            timeout = max(min(timeout, budget.remaining()), self.min_timeout)
+        started = self.clock()
+        deadline = started + timeout
+        delay = self.hedge_delay()
+        hedge_at = started + delay if delay is not None else None
+
+        condition = threading.Condition()
+        attempts = [_Attempt(func, kwargs, condition)]
+        with condition:
+            while True:
+                done = [a for a in attempts if a.finished]
+                winner = next((a for a in done if a.error is None), None)
+                if winner:
+                    break
+                now = self.clock()
+                failed = len(done) == len(attempts)
+                if len(attempts) == 1 and now < deadline and (
+                        failed or (hedge_at is not None and now >= hedge_at)):
+                    # Retry a quick failure, or hedge a slow first attempt.
+                    METRICS.incr('%s.%s' % (self.name,
+                                            'retried' if failed else
+                                            'hedged'))
+                    attempts.append(_Attempt(func, kwargs, condition))
+                    continue
+                if failed or now >= deadline:
+                    break
+                wake = deadline
+                if len(attempts) == 1 and hedge_at is not None:
+                    wake = min(wake, hedge_at)
+                condition.wait(max(wake - now, 0.001))
+
+        seconds = self.clock() - started
+        if winner:
+            METRICS.observe('%s.seconds' % self.name, seconds)
+            self.breaker.record(True, seconds)
+            return winner.result
+        self.breaker.record(False)
+        if failed:
+            METRICS.incr('%s.errors' % self.name)
+            error = done[-1].error
+            raise ServiceUnavailable('%s: %r' % (self.name, error))
+        METRICS.incr('%s.timeouts' % self.name)
+        raise DeadlineExceeded('%s: no response in %.1fs' % (self.name,
+                                                             timeout))
@@ -0,0 +1,296 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Settings that can change while the bot runs.
+
+WatsonOnlineStore reads its tunables from a RuntimeConfig. A ConfigWatcher
+polls data/workspace.json and an optional JSON config file and swaps in a
+new RuntimeConfig; turns already in progress keep the config they started
+with. A changed workspace.json becomes a new Conversation workspace, which
+is swapped in once trained; the old one is deleted after a drain period.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from watsononlinestore.metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+# Keys a config file may set, and their types.
+TUNABLES = {
+    'workspace_id': str,
+    'discovery_score_filter': float,
+    'latency_budget': float,
+}
+# Parts of workspace.json that update_workspace accepts.
+WORKSPACE_SECTIONS = ('description', 'language', 'intents', 'entities',
+                      'dialog_nodes', 'counterexamples', 'metadata')
+# Workspace statuses reported by get_workspace.
+AVAILABLE = 'Available'
+FAILED = 'Failed'
+# Seconds a new workspace may train before the reload is abandoned.
+DEFAULT_TRAINING_TIMEOUT = 600
+# Seconds between training status checks.
+TRAINING_POLL_INTERVAL = 2.0
+# Seconds a replaced workspace is kept for turns that still use it.
+DEFAULT_DRAIN_SECONDS = 60
+# Key that identifies an element of each list section.
+SECTION_KEYS = {
+    'intents': 'intent',
+    'entities': 'entity',
+    'dialog_nodes': 'dialog_node',
+    'counterexamples': 'text',
+}
+
+
+class RuntimeConfig(object):
+    """An immutable set of tunables. Use replace() to change one."""
+
+    def __init__(self, workspace_id=None, discovery_score_filter=0.0,
+                 latency_budget=15.0):
+        self.workspace_id = workspace_id
+        self.discovery_score_filter = discovery_score_filter
+        self.latency_budget = latency_budget
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in TUNABLES)
+
+    def replace(self, **changes):
+        values = self.as_dict()
+        values.update(changes)
+        return RuntimeConfig(**values)
+
+
+def parse_config(text, base):
+    """
+    Returns - base updated with the tunables in the JSON text
+    Raises ValueError for unknown keys or values of the wrong type.
+    """
+    settings = json.loads(text)
+    if not isinstance(settings, dict):
+        raise ValueError("config must be a JSON object")
+    changes = {}
+    for name, value in settings.items():
+        if name not in TUNABLES:
+            raise ValueError("unknown setting %r" % name)
+        try:
+            changes[name] = TUNABLES[name](value)
+        except (TypeError, ValueError):
+            raise ValueError("bad value for %s: %r" % (name, value))
+    return base.replace(**changes)
+
+
+def diff_workspace(old, new):
+    """
+    Compares two workspace.json documents.
+    Returns - {section: summary} for each section that changed; list
+              sections are summarized as added/removed/changed counts
+    """
+    changes = {}
+    for section in WORKSPACE_SECTIONS:
+        before, after = old.get(section), new.get(section)
+        if before == after:
+            continue
+        key = SECTION_KEYS.get(section)
+        if key is None or not isinstance(before, list):
+            changes[section] = 'changed'
+            continue
+        before = dict((item.get(key), item) for item in before)
+        after = dict((item.get(key), item) for item in after or [])
+        changes[section] = {
+            'added': len(set(after) - set(before)),
+            'removed': len(set(before) - set(after)),
+            'changed': sum(1 for k in set(before) & set(after)
+                           if before[k] != after[k])}
+    return changes
+
+
+class ConfigWatcher(object):
+
+    def __init__(self, wos, workspace_path='data/workspace.json',
+                 config_path=None, interval=2.0,
+                 training_timeout=DEFAULT_TRAINING_TIMEOUT,
+                 drain_seconds=DEFAULT_DRAIN_SECONDS):
+        """
+        Watches the workspace and config files and reloads on change.
+
+        :param wos: WatsonOnlineStore whose config is swapped
+        :param workspace_path: Conversation workspace JSON, or None
+        :param config_path: JSON object of TUNABLES, or None
+        :param interval: Seconds between checks for changes
+        :param training_timeout: Seconds a new workspace may train
+        :param drain_seconds: Seconds before a replaced workspace is deleted
+        """
+        self.wos = wos
+        self.workspace_path = workspace_path
+        self.config_path = config_path
+        self.interval = interval
+        self.training_timeout = training_timeout
+        self.drain_seconds = drain_seconds
+        # (delete at, workspace ID) of replaced workspaces, oldest first.
+        self.retired = []
+        self.stamps = {}
+        self.workspace = None
+        # Settings missing from the config file keep these values.
+        self.base_config = None
+        self.stopping = threading.Event()
+        self.watcher = None
+
+    @staticmethod
+    def _stamp(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def _changed(self, path):
+        if not path:
+            return False
+        stamp = self._stamp(path)
+        if stamp is None or stamp == self.stamps.get(path):
+            return False
+        self.stamps[path] = stamp
+        return True
+
+    def start(self):
+        self.base_config = self.wos.config
+        # What is on disk now is what the bot started with.
+        for path in (self.workspace_path, self.config_path):
+            if path:
+                self.stamps[path] = self._stamp(path)
+        if self.workspace_path and self.stamps[self.workspace_path]:
+            with open(self.workspace_path) as workspace_file:
+                self.workspace = json.load(workspace_file)
+        if self.config_path and self.stamps[self.config_path]:
+            self._reload_config()
+        self.stopping.clear()
+        self.watcher = threading.Thread(target=self._watch_loop,
+                                        name='config-watcher')
+        self.watcher.daemon = True
+        self.watcher.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.watcher:
+            self.watcher.join()
+            self.watcher = None
+        # No turns are left to finish on them.
+        self._delete_retired(float('inf'))
+
+    def check(self):
+        """
+        Reloads whatever changed since the last check, and deletes
+        replaced workspaces whose drain period is over.
+        Returns - True if anything was reloaded
+        """
+        self._delete_retired(time.time())
+        reloaded = False
+        if self._changed(self.workspace_path):
+            reloaded = self._reload(self._reload_workspace) or reloaded
+        if self._changed(self.config_path):
+            reloaded = self._reload(self._reload_config) or reloaded
+        return reloaded
+
+    def _reload(self, reload_func):
+        started = time.time()
+        try:
+            reload_func()
+        except Exception:
+            # Keep running on the current config until the file is fixed.
+            LOG.exception("Reload failed; keeping the current config")
+            METRICS.incr('config.reload_errors')
+            return False
+        METRICS.observe('config.reload_seconds', time.time() - started)
+        METRICS.incr('config.reloads')
+        return True
+
+    def _reload_workspace(self):
+        with open(self.workspace_path) as workspace_file:
+            workspace = json.load(workspace_file)
+        changes = diff_workspace(self.workspace or {}, workspace)
+        if not changes:
+            self.workspace = workspace
+            return
+        client = self.wos.conversation_client
+        old_id = self.wos.config.workspace_id
+        LOG.info("Replacing workspace {}: {}".format(old_id, changes))
+        # Turns keep using the old workspace while the new one trains.
+        old = client.get_workspace(old_id)
+        sections = dict((section, workspace.get(section))
+                        for section in WORKSPACE_SECTIONS)
+        created = client.create_workspace(
+            old['name'],
+            sections.pop('description') or old.get('description'),
+            sections.pop('language'),
+            **sections)
+        new_id = created['workspace_id']
+        try:
+            self._wait_until_trained(new_id)
+        except Exception:
+            self._delete_workspace(new_id)
+            raise
+        # One reference assignment: each turn sees the old or new workspace.
+        self.wos.config = self.wos.config.replace(workspace_id=new_id)
+        if self.base_config.workspace_id == old_id:
+            self.base_config = self.base_config.replace(workspace_id=new_id)
+        self.retired.append((time.time() + self.drain_seconds, old_id))
+        self.workspace = workspace
+        LOG.info("Workspace {} replaced {}, which is deleted in {}s; update "
+                 "WORKSPACE_ID if it is set".format(new_id, old_id,
+                                                    self.drain_seconds))
+
+    def _wait_until_trained(self, workspace_id):
+        deadline = time.time() + self.training_timeout
+        while True:
+            status = self.wos.conversation_client.get_workspace(
+                workspace_id)['status']
+            if status == AVAILABLE:
+                return
+            if status == FAILED:
+                raise Exception("Workspace %s failed to train" %
+                                workspace_id)
+            if time.time() >= deadline:
+                raise Exception("Workspace %s is still %s after %ss" %
+                                (workspace_id, status,
+                                 self.training_timeout))
+            if self.stopping.wait(TRAINING_POLL_INTERVAL):
+                raise Exception("Stopped while workspace %s trained" %
+                                workspace_id)
+
+    def _delete_workspace(self, workspace_id):
+        try:
+            self.wos.conversation_client.delete_workspace(workspace_id)
+        except Exception:
+            LOG.exception("Deleting workspace {} failed".format(
+                workspace_id))
+        else:
+            LOG.info("Deleted workspace {}".format(workspace_id))
+
+    def _delete_retired(self, now):
+        while self.retired and self.retired[0][0] <= now:
+            self._delete_workspace(self.retired.pop(0)[1])
+
+    def _reload_config(self):
+        with open(self.config_path) as config_file:
+            config = parse_config(config_file.read(), self.base_config)
+        LOG.info("Loaded {}: {}".format(self.config_path, config.as_dict()))
+        # One reference assignment: each turn sees the old or new config.
+        self.wos.config = config
+
+    def _watch_loop(self):
+        while not self.stopping.wait(self.interval):
+            self.check()
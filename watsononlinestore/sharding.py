@@ -0,0 +1,427 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Spread Slack users over several bot worker processes.
+
+Each event is routed by consistent hashing on its Slack user ID, so every
+message from one user reaches the same worker, and that worker alone holds
+the user's Session. When a worker is added or removed, only the users
+whose owner changes are moved, and their sessions are handed over before
+any of their new events are routed.
+"""
+
+import bisect
+import collections
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from watsononlinestore import memory
+from watsononlinestore import metrics
+from watsononlinestore.metrics import METRICS
+from watsononlinestore import profiling
+from watsononlinestore import tenants
+
+LOG = logging.getLogger(__name__)
+
+# Points per worker on the ring; more points give a more even spread.
+DEFAULT_REPLICAS = 100
+HANDOVER_TIMEOUT = 30
+# Users idle this many seconds are forgotten, sessions and all.
+DEFAULT_IDLE_TIMEOUT = 24 * 3600
+REPORT_TIMEOUT = 5
+
+# Worker commands
+EVENT = 'event'
+EXPORT = 'export'
+IMPORT = 'import'
+DROP = 'drop'
+REPORT_METRICS = 'metrics'
+PROFILE = 'profile'
+REPORT_MEMORY = 'memory'
+STOP = 'stop'
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+
+    def __init__(self, nodes=(), replicas=DEFAULT_REPLICAS):
+        """
+        Consistent hash ring mapping keys to nodes.
+
+        :param nodes: Initial node names
+        :param replicas: Points on the ring per node
+        """
+        self.replicas = replicas
+        self.points = []
+        self.owners = {}
+        for node in nodes:
+            self.add(node)
+
+    @property
+    def nodes(self):
+        return sorted(set(self.owners.values()))
+
+    def add(self, node):
+        for i in range(self.replicas):
+            point = _hash('%s#%d' % (node, i))
+            bisect.insort(self.points, point)
+            self.owners[point] = node
+
+    def remove(self, node):
+        self.points = [p for p in self.points if self.owners[p] != node]
+        self.owners = dict((p, self.owners[p]) for p in self.points)
+
+    def node_for(self, key):
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, _hash(key)) % len(self.points)
+        return self.owners[self.points[index]]
+
+
+def shard_environ(environ, index):
+    """
+    The settings for worker index. Each local file the bot writes (see
+    tenants.files_written) gets the worker's number added to its name, so
+    no two workers append to one journal or save one checkpoint.
+    Raises ValueError for the SQLite store: its carts must stay readable
+    by whichever worker a user moves to.
+    Returns - a copy of environ
+    """
+    environ = dict(environ)
+    for setting, path in tenants.files_written(environ).items():
+        if setting == 'SQLITE_DB_PATH':
+            raise ValueError("STORE_BACKEND=sqlite serves one process; "
+                             "use Cloudant with several workers")
+        root, ext = os.path.splitext(path)
+        environ[setting] = '%s.%d%s' % (root, index, ext)
+    return environ
+
+
+def worker_main(wos_factory, index, inbox, replies):
+    """
+    Body of a worker process: serves events for the users it owns.
+
+    :param wos_factory: Callable returning a WatsonOnlineStore for the
+                        worker's number
+    :param index: The worker's number
+    :param inbox: Queue of (command, argument) tuples from the router
+    :param replies: Queue for (request ID, reply) answers to EXPORT,
+                    REPORT_METRICS, PROFILE and REPORT_MEMORY
+    """
+    wos = wos_factory(index)
+    wos.start_services()
+    while True:
+        command, argument = inbox.get()
+        if command == STOP:
+            wos.stop_services()
+            return
+        try:
+            if command == EVENT:
+                wos.process_slack_output([argument])
+            elif command == EXPORT:
+                handover_id, users = argument
+                replies.put((handover_id, export_users(wos, users)))
+            elif command == IMPORT:
+                wos.import_sessions(argument['sessions'])
+                if argument['events']:
+                    wos.process_slack_output(argument['events'])
+            elif command == DROP:
+                wos.export_sessions(argument)
+            elif command == REPORT_METRICS:
+                replies.put((argument, METRICS.snapshot()))
+            elif command == PROFILE:
+                request_id, action = argument
+                profiler = getattr(wos, 'profiler', None)
+                replies.put((request_id, profiler.control(action)
+                             if profiler else None))
+            elif command == REPORT_MEMORY:
+                request_id, top = argument
+                replies.put((request_id, memory.report(wos, top)))
+        except Exception:
+            LOG.exception("Worker failed to handle {}".format(command))
+            if command == EXPORT:
+                replies.put((argument[0], {'sessions': [], 'events': []}))
+            elif command in (PROFILE, REPORT_MEMORY):
+                replies.put((argument[0], None))
+
+
+def export_users(wos, users):
+    """
+    Everything the next owner of users needs: their sessions, and their
+    messages still waiting for admission. Events routed before the export
+    were offered already, because the inbox is FIFO, but admission may not
+    have handled them yet; they are taken back, and a turn in progress is
+    waited for, so nothing runs here against a session that has moved.
+    Returns - {'sessions': [...], 'events': [...]}
+    """
+    admission = getattr(wos, 'admission', None)
+    events = []
+    if admission:
+        events = admission.withdraw(users, timeout=HANDOVER_TIMEOUT / 2)
+    return {'sessions': wos.export_sessions(users), 'events': events}
+
+
+class Worker(object):
+
+    def __init__(self, name, index, wos_factory):
+        self.name = name
+        self.inbox = multiprocessing.Queue()
+        self.replies = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=worker_main,
+            args=(wos_factory, index, self.inbox, self.replies), name=name)
+        self.process.daemon = True
+
+    def send(self, command, argument=None):
+        self.inbox.put((command, argument))
+
+
+class ShardRouter(object):
+
+    def __init__(self, wos_factory, worker_count,
+                 replicas=DEFAULT_REPLICAS,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        """
+        Routes Slack events to worker processes by Slack user ID.
+
+        Has the process_slack_output/start_services interface of
+        WatsonOnlineStore, so it can stand in for it in front of the
+        Events API dispatcher.
+
+        :param wos_factory: Callable run in each worker with the
+                            worker's number (0, 1, ...; a worker added
+                            later gets the next one) to build its
+                            WatsonOnlineStore
+        :param worker_count: Number of worker processes
+        :param idle_timeout: Seconds without a message after which a user
+                             is forgotten and their session dropped
+        """
+        self.wos_factory = wos_factory
+        self.ring = HashRing(replicas=replicas)
+        self.workers = {}
+        # Users with a session and the worker holding it, and when each
+        # user was last seen, least recently first.
+        self.owners = {}
+        self.seen = collections.OrderedDict()
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.next_worker = 0
+        self.request_id = 0
+        self.initial_workers = worker_count
+        self.delay = 0.5  # second
+
+    def start_services(self):
+        for _ in range(self.initial_workers):
+            self.add_worker()
+
+    def stop_services(self):
+        with self.lock:
+            for worker in self.workers.values():
+                worker.send(STOP)
+            for worker in self.workers.values():
+                worker.process.join()
+            self.workers = {}
+
+    def _start_worker(self):
+        index = self.next_worker
+        self.next_worker += 1
+        name = 'wos-worker-%d' % index
+        worker = Worker(name, index, self.wos_factory)
+        worker.process.start()
+        self.workers[name] = worker
+        return name
+
+    def add_worker(self):
+        """
+        Starts a worker and moves the users it now owns over to it.
+        Returns - the new worker's name
+        """
+        with self.lock:
+            name = self._start_worker()
+            self.ring.add(name)
+            self._rebalance()
+        LOG.info("Started {}; {} workers".format(name, len(self.workers)))
+        return name
+
+    def remove_worker(self, name):
+        """
+        Hands a worker's users to the remaining workers and stops it.
+        """
+        with self.lock:
+            self.ring.remove(name)
+            self._rebalance()
+            worker = self.workers.pop(name)
+            worker.send(STOP)
+        worker.process.join()
+        LOG.info("Stopped {}; {} workers".format(name, len(self.workers)))
+
+    def _rebalance(self):
+        """
+        Moves sessions whose owner changed on the ring. Events for those
+        users are not routed until the handover is done, because the
+        caller holds the lock.
+        """
+        moves = {}
+        for user, owner in self.owners.items():
+            new_owner = self.ring.node_for(user)
+            if new_owner != owner:
+                moves.setdefault((owner, new_owner), []).append(user)
+        for (owner, new_owner), users in moves.items():
+            old = self.workers[owner]
+            handover = self._request(old, EXPORT, users, HANDOVER_TIMEOUT)
+            if handover is None:
+                # The ring has changed either way; the users start over on
+                # their new worker (restored from a snapshot if enabled).
+                LOG.error("No handover from {} within {}s; sessions of {} "
+                          "users are lost".format(owner, HANDOVER_TIMEOUT,
+                                                  len(users)))
+            else:
+                self.workers[new_owner].send(IMPORT, handover)
+                LOG.debug("Moved {} sessions and {} waiting messages from "
+                          "{} to {}".format(len(handover['sessions']),
+                                            len(handover['events']),
+                                            owner, new_owner))
+            for user in users:
+                self.owners[user] = new_owner
+
+    def _evict_idle(self, now):
+        """
+        Forgets users idle for idle_timeout, and has their workers drop
+        their sessions, so neither keeps every user ever seen. The caller
+        holds the lock.
+        """
+        idle = {}
+        while self.seen:
+            user, seen = next(iter(self.seen.items()))
+            if seen > now - self.idle_timeout:
+                break
+            del self.seen[user]
+            idle.setdefault(self.owners.pop(user), []).append(user)
+        for owner, users in idle.items():
+            self.workers[owner].send(DROP, users)
+            LOG.debug("Dropped {} idle sessions from {}".format(
+                len(users), owner))
+
+    def _request(self, worker, command, argument, timeout):
+        """
+        Sends command with a new request ID (in a tuple with argument, if
+        given) and waits for the worker's answer. The caller holds the
+        lock, so only one request reads a worker's replies at a time.
+        Returns - the answer, or None if the worker did not answer in time
+        """
+        self.request_id += 1
+        request_id = self.request_id
+        worker.send(command, request_id if argument is None
+                    else (request_id, argument))
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            try:
+                if remaining <= 0:
+                    raise queue.Empty()
+                reply_id, reply = worker.replies.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if reply_id == request_id:
+                return reply
+            LOG.warning("Dropping late reply {} from {}".format(
+                reply_id, worker.name))
+
+    def _ask_workers(self, command, argument=None, timeout=REPORT_TIMEOUT):
+        """
+        Returns - {worker name: answer}, None for a worker that did not
+                  answer in time
+        """
+        with self.lock:
+            return dict(
+                (name, self._request(worker, command, argument, timeout))
+                for name, worker in self.workers.items())
+
+    def metrics_snapshot(self):
+        """
+        Metrics of this process and every worker, merged (see
+        metrics.merge_snapshots), with each worker's own snapshot under
+        'workers'. A worker that does not answer in time is listed as None.
+        """
+        workers = self._ask_workers(REPORT_METRICS)
+        snapshot = metrics.merge_snapshots(
+            [METRICS.snapshot()] +
+            [s for s in workers.values() if s is not None])
+        snapshot['workers'] = workers
+        return snapshot
+
+    def profile(self, action):
+        """
+        Runs a profiling.Profiler action in every worker, where the bot's
+        messages are handled.
+        Returns - {'workers': {name: status}}; None for a worker without
+                  a profiler or that did not answer in time
+        """
+        if action not in profiling.ACTIONS:
+            raise ValueError("action must be one of: %s" %
+                             ", ".join(profiling.ACTIONS))
+        return {'workers': self._ask_workers(PROFILE, action)}
+
+    def memory_report(self, top=memory.DEFAULT_TOP):
+        """
+        Returns - {'workers': {name: memory.report}}, where the sessions
+                  are; None for a worker that did not answer in time
+        """
+        return {'workers': self._ask_workers(REPORT_MEMORY, top,
+                                             HANDOVER_TIMEOUT)}
+
+    def process_slack_output(self, slack_output):
+        """
+        Sends each event to the worker that owns its user.
+        """
+        now = time.time()
+        with self.lock:
+            for event in slack_output or []:
+                user = event.get('user') if isinstance(event, dict) else None
+                if not user:
+                    # Only user messages reach handle_message.
+                    continue
+                owner = self.ring.node_for(user)
+                self.owners[user] = owner
+                self.seen.pop(user, None)
+                self.seen[user] = now
+                self.workers[owner].send(EVENT, event)
+            self._evict_idle(now)
+
+    def run(self, slack_client):
+        """
+        Reads Slack RTM in this process and routes events to the workers.
+        """
+        self.start_services()
+        if slack_client.rtm_connect():
+            LOG.info("Watson Online Store bot is connected with {} "
+                     "workers".format(len(self.workers)))
+            try:
+                while True:
+                    self.process_slack_output(slack_client.rtm_read())
+                    time.sleep(self.delay)
+            finally:
+                self.stop_services()
+        else:
+            LOG.warning("Connection failed. Invalid Slack token or bot ID?")
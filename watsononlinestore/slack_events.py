@@ -0,0 +1,239 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Slack Events API ingestion: an alternative to RTM polling.
+
+Slack POSTs each event to our HTTP endpoint and expects a 2xx within three
+seconds. The WSGI app below only verifies the request signature and puts
+the event on an internal queue; an EventDispatcher thread feeds the queue
+to WatsonOnlineStore.process_slack_output, the same pipeline RTM uses.
+Because nothing is held per connection, several replicas can run behind a
+load balancer.
+"""
+
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+from wsgiref.simple_server import make_server
+from wsgiref.simple_server import WSGIRequestHandler
+from wsgiref.simple_server import WSGIServer
+
+try:
+    import queue
+    import socketserver
+except ImportError:  # Python 2
+    import Queue as queue
+    import SocketServer as socketserver
+
+from watsononlinestore.metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+# Slack signs requests with a timestamp; reject replays older than this.
+MAX_REQUEST_AGE = 60 * 5
+# Slack retries events it believes we missed; remember recent event IDs.
+SEEN_EVENT_IDS = 10000
+DEFAULT_QUEUE_SIZE = 1000
+SIGNATURE_VERSION = 'v0'
+
+
+def compute_signature(signing_secret, timestamp, body):
+    """Slack's v0 request signature for body sent at timestamp."""
+    base = ('%s:%s:' % (SIGNATURE_VERSION, timestamp)).encode('utf-8') + body
+    digest = hmac.new(signing_secret.encode('utf-8'), base,
+                      hashlib.sha256).hexdigest()
+    return '%s=%s' % (SIGNATURE_VERSION, digest)
+
+
+def verify_signature(signing_secret, timestamp, body, signature,
+                     now=None):
+    """Check a request's X-Slack-Signature and X-Slack-Request-Timestamp."""
+    if not (timestamp and signature):
+        return False
+    try:
+        age = abs((now or time.time()) - int(timestamp))
+    except ValueError:
+        return False
+    if age > MAX_REQUEST_AGE:
+        return False
+    expected = compute_signature(signing_secret, timestamp, body)
+    return hmac.compare_digest(expected.encode('utf-8'),
+                               signature.encode('utf-8'))
+
+
+class SlackEventsApp(object):
+
+    def __init__(self, signing_secret, event_queue, clock=time.time):
+        """
+        WSGI app that accepts Slack Events API requests.
+
+        :param signing_secret: The Slack app's signing secret
+        :param event_queue: Queue that receives each verified event dict
+        """
+        self.signing_secret = signing_secret
+        self.event_queue = event_queue
+        self.clock = clock
+        # Requests are served on many threads; Slack may retry an event
+        # while the first delivery is still being handled.
+        self.seen_lock = threading.Lock()
+        self.seen = collections.OrderedDict()
+
+    @staticmethod
+    def _respond(start_response, status, body=b'',
+                 content_type='text/plain'):
+        start_response(status, [('Content-Type', content_type),
+                                ('Content-Length', str(len(body)))])
+        return [body]
+
+    def _duplicate(self, event_id):
+        if not event_id:
+            return False
+        with self.seen_lock:
+            if event_id in self.seen:
+                return True
+            self.seen[event_id] = True
+            if len(self.seen) > SEEN_EVENT_IDS:
+                self.seen.popitem(last=False)
+        return False
+
+    def _forget(self, event_id):
+        with self.seen_lock:
+            self.seen.pop(event_id, None)
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') != 'POST':
+            return self._respond(start_response, '405 Method Not Allowed')
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        body = environ['wsgi.input'].read(length)
+
+        if not verify_signature(
+                self.signing_secret,
+                environ.get('HTTP_X_SLACK_REQUEST_TIMESTAMP'),
+                body,
+                environ.get('HTTP_X_SLACK_SIGNATURE'),
+                now=self.clock()):
+            METRICS.incr('slack_events.rejected')
+            return self._respond(start_response, '401 Unauthorized')
+
+        try:
+            payload = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return self._respond(start_response, '400 Bad Request')
+
+        if payload.get('type') == 'url_verification':
+            challenge = json.dumps({'challenge': payload.get('challenge')})
+            return self._respond(start_response, '200 OK',
+                                 challenge.encode('utf-8'),
+                                 'application/json')
+
+        event = payload.get('event')
+        if payload.get('type') != 'event_callback' or not event:
+            return self._respond(start_response, '200 OK')
+        if self._duplicate(payload.get('event_id')):
+            METRICS.incr('slack_events.duplicate')
+            return self._respond(start_response, '200 OK')
+        # The team is only on the envelope for some event types; one
+        # process may serve several teams (see tenants.TenantRouter).
+        if payload.get('team_id'):
+            event.setdefault('team', payload['team_id'])
+        try:
+            self.event_queue.put_nowait(event)
+        except queue.Full:
+            # Let Slack retry later rather than hold the request open.
+            METRICS.incr('slack_events.queue_full')
+            self._forget(payload.get('event_id'))
+            return self._respond(start_response, '503 Service Unavailable')
+        METRICS.incr('slack_events.accepted')
+        METRICS.set_gauge('slack_events.queue_depth',
+                          self.event_queue.qsize())
+        return self._respond(start_response, '200 OK')
+
+
+class EventDispatcher(object):
+
+    def __init__(self, wos, event_queue):
+        """
+        Feeds queued events to wos one at a time on a background thread.
+        """
+        self.wos = wos
+        self.event_queue = event_queue
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run,
+                                       name='slack-events-dispatch')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.event_queue.put(None)
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while True:
+            event = self.event_queue.get()
+            if event is None:
+                return
+            try:
+                self.wos.process_slack_output([event])
+            except Exception:
+                LOG.exception("Failed to handle Slack event")
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        LOG.debug("%s - " + format, self.address_string(), *args)
+
+
+def make_events_server(wos, signing_secret, host='0.0.0.0', port=3000,
+                       queue_size=DEFAULT_QUEUE_SIZE):
+    """
+    Builds the HTTP server and dispatcher for Events API mode.
+    Returns - (server, dispatcher); call dispatcher.start() and
+              server.serve_forever()
+    """
+    event_queue = queue.Queue(maxsize=queue_size)
+    app = SlackEventsApp(signing_secret, event_queue)
+    server = make_server(host, port, app, server_class=ThreadingWSGIServer,
+                         handler_class=QuietHandler)
+    return server, EventDispatcher(wos, event_queue)
+
+
+def serve_events(wos, signing_secret, host='0.0.0.0', port=3000):
+    """
+    Runs the bot in Events API mode until interrupted.
+    """
+    wos.start_services()
+    server, dispatcher = make_events_server(wos, signing_secret, host, port)
+    dispatcher.start()
+    LOG.info("Watson Online Store bot is listening for Slack events on "
+             "port {}".format(port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        dispatcher.stop()
+        wos.stop_services()
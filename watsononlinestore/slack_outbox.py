@@ -0,0 +1,343 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import json
+import logging
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# Slack allows about one message per second per channel, with short bursts.
+DEFAULT_RATE = 1.0
+DEFAULT_BURST = 3
+# Used when Slack says we are rate limited but sends no Retry-After.
+DEFAULT_RETRY_AFTER = 1.0
+# Merged messages stay under Slack's recommended message length.
+MAX_MESSAGE_CHARS = 4000
+MAX_ATTEMPTS = 3
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity, clock=time.time):
+        """
+        Allows rate events per second with bursts of up to capacity.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = float(capacity)
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """
+        Seconds until a token is available (0 if one is available now).
+        """
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class Placeholder(object):
+    """A posted message that a later chat.update replaces in place."""
+
+    def __init__(self, shown, attachments=()):
+        # Turn fragments that were posted along with the placeholder text.
+        self.shown = shown
+        self.attachments = list(attachments)
+        self.ts = None
+
+
+class OutboxMessage(object):
+
+    def __init__(self, channel, text, method='chat.postMessage',
+                 placeholder=None, urgent=False, attachments=None):
+        self.channel = channel
+        self.text = text
+        self.attachments = list(attachments or ())
+        self.method = method
+        self.placeholder = placeholder
+        # Urgent messages are sent even while the channel's turn is open.
+        self.urgent = urgent
+        self.attempts = 0
+
+
+class ChannelQueue(object):
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.messages = collections.deque()
+        # Slack's Retry-After pushes this into the future.
+        self.not_before = 0.0
+        # Fragments are held while a turn for this channel is in progress.
+        self.open_turns = 0
+        # Set when the current turn posted an acknowledgement to update.
+        self.placeholder = None
+
+    def ready(self):
+        return bool(self.messages) and (not self.open_turns or
+                                        self.messages[0].urgent)
+
+    def take_held(self):
+        """
+        Removes the plain posts held for the turn.
+        Returns - their texts and their attachments
+        """
+        held = [m for m in self.messages
+                if m.method == 'chat.postMessage' and not m.urgent]
+        for message in held:
+            self.messages.remove(message)
+        return ([m.text.rstrip('\n') for m in held],
+                [attachment for m in held for attachment in m.attachments])
+
+
+class SlackOutbox(object):
+
+    def __init__(self, slack_client, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                 clock=time.time):
+        """
+        Queues outbound Slack messages and posts them from a background
+        thread, merging queued fragments and honoring rate limits.
+
+        :param slack_client: SlackClient used for chat.postMessage
+        :param rate: Messages per second allowed per channel
+        :param burst: Messages that may be sent back-to-back per channel
+        """
+        self.slack_client = slack_client
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.channels = {}
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.sending = 0
+        self.worker = None
+
+    def _channel(self, channel):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = ChannelQueue(TokenBucket(self.rate, self.burst,
+                                             self.clock))
+            self.channels[channel] = queue
+        return queue
+
+    def start(self):
+        with self.condition:
+            self.stopping = False
+        self.worker = threading.Thread(target=self._run,
+                                       name='slack-outbox')
+        self.worker.daemon = True
+        self.worker.start()
+
+    def stop(self, timeout=None):
+        """
+        Sends what is queued (within timeout) and stops the worker.
+        """
+        self.flush(timeout)
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.worker:
+            self.worker.join(timeout)
+            self.worker = None
+
+    def post(self, channel, text, attachments=None):
+        """
+        Queues text (and a list of Slack attachments) for channel and
+        returns immediately.
+        """
+        with self.condition:
+            self._channel(channel).messages.append(
+                OutboxMessage(channel, text, attachments=attachments))
+            self.condition.notify_all()
+
+    def begin_turn(self, channel):
+        """
+        Holds messages for channel until end_turn, so that every fragment
+        of one turn goes out as a single post.
+        """
+        with self.condition:
+            self._channel(channel).open_turns += 1
+
+    def acknowledge(self, channel, text):
+        """
+        Posts what the open turn has said so far plus text right away. At
+        end_turn the message is updated in place with the whole turn.
+        """
+        with self.condition:
+            queue = self._channel(channel)
+            if queue.placeholder:
+                # A second acknowledgement in one turn: finish the first.
+                self._update_placeholder(queue, channel, urgent=True)
+            shown, attachments = queue.take_held()
+            queue.placeholder = Placeholder(shown, attachments)
+            queue.messages.append(OutboxMessage(
+                channel, '\n'.join(shown + [text]),
+                placeholder=queue.placeholder, urgent=True,
+                attachments=attachments))
+            self.condition.notify_all()
+
+    def end_turn(self, channel):
+        with self.condition:
+            queue = self._channel(channel)
+            queue.open_turns = max(queue.open_turns - 1, 0)
+            if queue.placeholder and not queue.open_turns:
+                self._update_placeholder(queue, channel)
+            self.condition.notify_all()
+
+    @staticmethod
+    def _update_placeholder(queue, channel, urgent=False):
+        placeholder, queue.placeholder = queue.placeholder, None
+        held, attachments = queue.take_held()
+        text = '\n'.join(placeholder.shown + held)
+        queue.messages.append(OutboxMessage(
+            channel, text, method='chat.update', placeholder=placeholder,
+            urgent=urgent, attachments=placeholder.attachments + attachments))
+
+    def pending(self):
+        with self.condition:
+            return sum(len(q.messages) for q in self.channels.values())
+
+    def flush(self, timeout=None):
+        """
+        Waits until every queued message is sent or dropped.
+        Returns - True if the outbox is empty
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.sending or any(q.ready()
+                                      for q in self.channels.values()):
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self.condition.wait(remaining)
+            return True
+
+    # Worker
+
+    def _next_ready(self):
+        """
+        Returns (channel queue, 0) for a channel that may send now, or
+        (None, seconds to wait) if none may.
+        """
+        now = self.clock()
+        wait = None
+        for queue in self.channels.values():
+            if not queue.ready():
+                continue
+            delay = max(queue.not_before - now, queue.bucket.wait_time())
+            if delay <= 0:
+                return queue, 0
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    @staticmethod
+    def _coalesce(queue):
+        """
+        Merges consecutive queued plain posts for a channel into one.
+        """
+        message = queue.messages.popleft()
+        if message.urgent or message.method != 'chat.postMessage':
+            return message
+        parts = [message.text]
+        size = len(message.text)
+        while queue.messages:
+            following = queue.messages[0]
+            if following.urgent or following.method != 'chat.postMessage':
+                break
+            text = following.text
+            if size + len(text) + 1 > MAX_MESSAGE_CHARS:
+                break
+            parts.append(queue.messages.popleft().text)
+            message.attachments.extend(following.attachments)
+            size += len(text) + 1
+        if len(parts) > 1:
+            message.text = '\n'.join(part.rstrip('\n') for part in parts)
+        return message
+
+    def _run(self):
+        while True:
+            with self.condition:
+                queue, wait = self._next_ready()
+                while queue is None:
+                    if self.stopping:
+                        return
+                    self.condition.wait(wait)
+                    queue, wait = self._next_ready()
+                message = self._coalesce(queue)
+                queue.bucket.consume()
+                self.sending += 1
+            try:
+                retry_after = self._send(message)
+            finally:
+                with self.condition:
+                    self.sending -= 1
+                    if retry_after is not None:
+                        queue.not_before = self.clock() + retry_after
+                        queue.messages.appendleft(message)
+                    self.condition.notify_all()
+
+    def _send(self, message):
+        """
+        Posts one message.
+        Returns - seconds to wait before retrying it, or None when done
+        """
+        message.attempts += 1
+        kwargs = {}
+        if message.method == 'chat.update':
+            if message.placeholder.ts is None:
+                # The placeholder never made it; post the update instead.
+                message.method = 'chat.postMessage'
+            else:
+                kwargs['ts'] = message.placeholder.ts
+        if message.attachments:
+            kwargs['attachments'] = json.dumps(message.attachments)
+        try:
+            response = self.slack_client.api_call(message.method,
+                                                  channel=message.channel,
+                                                  text=message.text,
+                                                  as_user=True,
+                                                  **kwargs)
+        except Exception:
+            LOG.exception("Slack {} failed".format(message.method))
+            response = None
+        if response and response.get('ok', True):
+            if message.method == 'chat.postMessage' and message.placeholder:
+                message.placeholder.ts = response.get('ts')
+            return None
+        if response and response.get('error') == 'ratelimited':
+            headers = response.get('headers') or {}
+            retry_after = float(headers.get('Retry-After',
+                                            DEFAULT_RETRY_AFTER))
+            LOG.warning("Slack rate limited channel {}; retrying in "
+                        "{}s".format(message.channel, retry_after))
+            return retry_after
+        if message.attempts < MAX_ATTEMPTS:
+            return DEFAULT_RETRY_AFTER * message.attempts
+        LOG.error("Dropping Slack message to {} after {} attempts: "
+                  "{}".format(message.channel, message.attempts, response))
+        return None
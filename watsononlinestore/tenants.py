@@ -0,0 +1,205 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Host several storefronts (Slack teams) in one bot process.
+
+A tenant file is a JSON object with a "tenants" list. Each tenant has a
+"name" and overrides any of the bot's environment settings for itself,
+such as SLACK_BOT_TOKEN, WORKSPACE_ID, DISCOVERY_COLLECTION_ID,
+CLOUDANT_DB_NAME or ADMISSION_GLOBAL_LIMIT:
+
+    {"tenants": [
+        {"name": "acme", "SLACK_BOT_TOKEN": "xoxb-...",
+         "WORKSPACE_ID": "...", "CLOUDANT_DB_NAME": "acme_store"}
+    ]}
+
+Each tenant gets its own WatsonOnlineStore, so its sessions, admission
+limits and latency budget are its own, and its metrics are also
+recorded as "tenant.<name>.<metric>". Service clients built from the
+same credentials are shared (see SharedResources).
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+
+from watsononlinestore.metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+# Tenant names appear in metric names.
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+# Defaults of the settings naming files a tenant writes (see run.py).
+DEFAULT_SQLITE_DB_PATH = 'watson_online_store.db'
+DEFAULT_CHANGES_CHECKPOINT_PATH = 'changes_checkpoint.json'
+
+
+def load_tenants(path):
+    """
+    Reads and checks a tenant file.
+    Returns - [(name, {setting: string value})] in file order
+    """
+    with open(path) as tenants_file:
+        config = json.load(tenants_file)
+    tenants = []
+    for tenant in config.get('tenants', []):
+        tenant = dict(tenant)
+        name = tenant.pop('name', None)
+        if not name or not NAME_PATTERN.match(name):
+            raise ValueError("Tenant name must be letters, digits, _ or -: "
+                             "%r" % name)
+        if name in dict(tenants):
+            raise ValueError("Tenant %s is listed twice" % name)
+        tenants.append((name, dict((key, str(value))
+                                   for key, value in tenant.items())))
+    if not tenants:
+        raise ValueError("%s lists no tenants" % path)
+    return tenants
+
+
+def files_written(environ):
+    """
+    Returns - {setting: path} of the local files a bot built from
+              environ writes
+    """
+    files = {}
+    store_cache = environ.get('STORE_CACHE', 'false').lower() == 'true'
+    if environ.get('STORE_BACKEND', 'cloudant').lower() == 'sqlite':
+        files['SQLITE_DB_PATH'] = environ.get('SQLITE_DB_PATH',
+                                              DEFAULT_SQLITE_DB_PATH)
+    elif store_cache:
+        files['CHANGES_CHECKPOINT_PATH'] = environ.get(
+            'CHANGES_CHECKPOINT_PATH', DEFAULT_CHANGES_CHECKPOINT_PATH)
+    for setting in ('CART_JOURNAL_PATH', 'SESSION_SNAPSHOT_PATH'):
+        if environ.get(setting):
+            files[setting] = environ[setting]
+    return files
+
+
+def check_separate_files(environs):
+    """
+    Raises ValueError if two tenants (or workers) would write the same
+    local file.
+
+    :param environs: [(name, environ)] of every tenant
+    """
+    owners = {}
+    for name, environ in environs:
+        for setting, path in sorted(files_written(environ).items()):
+            path = os.path.abspath(path)
+            if path in owners:
+                raise ValueError("%s and %s both write %s; set %s for "
+                                 "each" % (owners[path], name, path,
+                                           setting))
+            owners[path] = name
+
+
+class SharedResources(object):
+
+    def __init__(self):
+        """
+        Clients, connection pools and tables built once per process and
+        shared by every tenant that asks for the same key.
+        """
+        self.lock = threading.Lock()
+        self.resources = {}
+
+    def get(self, key, factory):
+        """
+        Returns - the resource for key, built by factory() the first time
+        """
+        with self.lock:
+            if key not in self.resources:
+                self.resources[key] = factory()
+            return self.resources[key]
+
+
+class TenantRouter(object):
+
+    def __init__(self, tenants):
+        """
+        Serves several tenants from one process.
+
+        Has the process_slack_output/start_services interface of
+        WatsonOnlineStore, so it can stand in for it in front of the
+        Events API dispatcher; events go to the tenant of their team.
+
+        :param tenants: {name: WatsonOnlineStore}
+        """
+        self.tenants = tenants
+        self.teams = {}
+
+    @staticmethod
+    def team_of(wos):
+        response = wos.slack_client.api_call('auth.test')
+        if isinstance(response, dict) and response.get('ok'):
+            return response.get('team_id')
+        return None
+
+    def start_services(self):
+        for name, wos in self.tenants.items():
+            team = self.team_of(wos)
+            if team:
+                self.teams[team] = wos
+            else:
+                LOG.error("Could not look up the Slack team of tenant {}; "
+                          "its events are dropped".format(name))
+            wos.start_services()
+
+    def stop_services(self):
+        for wos in self.tenants.values():
+            wos.stop_services()
+
+    def process_slack_output(self, slack_output):
+        """
+        Hands each event to the tenant serving its Slack team.
+        """
+        for event in slack_output or []:
+            team = event.get('team') if isinstance(event, dict) else None
+            wos = self.teams.get(team)
+            if wos is None:
+                METRICS.incr('tenants.unknown_team')
+                continue
+            wos.process_slack_output([event])
+
+    def run(self):
+        """
+        Reads Slack RTM for every tenant, each on its own thread.
+        """
+        threads = []
+        for name, wos in self.tenants.items():
+            thread = threading.Thread(target=wos.run, name='rtm-' + name)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        LOG.info("Serving {} tenants".format(len(threads)))
+        for thread in threads:
+            thread.join()
+
+    def metrics_by_tenant(self):
+        """
+        Returns - {tenant: {'counters', 'gauges', 'timings'}} from the
+                  "tenant.<name>." metrics of this process
+        """
+        snapshot = METRICS.snapshot()
+        tenants = dict((name, {'counters': {}, 'gauges': {}, 'timings': {}})
+                       for name in self.tenants)
+        for kind in ('counters', 'gauges', 'timings'):
+            for metric, value in snapshot[kind].items():
+                if not metric.startswith('tenant.'):
+                    continue
+                name, _, metric = metric[len('tenant.'):].partition('.')
+                if name in tenants:
+                    tenants[name][kind][metric] = value
+        return tenants
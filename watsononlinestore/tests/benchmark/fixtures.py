@@ -0,0 +1,131 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmark payloads built from the real data/ibm_store_html pages."""
+
+import io
+import os
+import re
+
+from watsononlinestore.database import cart_items
+from watsononlinestore import watson_online_store
+
+DATA_DIR = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', '..', '..', 'data', 'ibm_store_html'))
+
+_TAG_RE = re.compile(r'<[^>]+>')
+_SPACE_RE = re.compile(r'[ \t\r\f\v]+')
+
+
+def load_pages(data_dir=DATA_DIR):
+    """Return the raw HTML of every store page, sorted by file number."""
+    names = [n for n in os.listdir(data_dir) if n.endswith('.html')]
+    names.sort(key=lambda n: int(os.path.splitext(n)[0]))
+    pages = []
+    for name in names:
+        with io.open(os.path.join(data_dir, name), encoding='utf-8',
+                     errors='replace') as page_file:
+            pages.append(page_file.read())
+    return pages
+
+
+def html_to_text(html):
+    """Rough stand-in for the 'text' field Discovery extracts from HTML."""
+    return _SPACE_RE.sub(' ', _TAG_RE.sub(' ', html))
+
+
+def discovery_results(pages, count):
+    """Build `count` Discovery results by cycling over the store pages."""
+    texts = [html_to_text(page) for page in pages]
+    results = []
+    for i in range(count):
+        j = i % len(pages)
+        results.append({'id': 'doc-%d' % i,
+                        'score': 1.0 - (float(i) / (count + 1)),
+                        'html': pages[j],
+                        'text': texts[j]})
+    return results
+
+
+def discovery_response(pages, count):
+    results = discovery_results(pages, count)
+    return {'matching_results': len(results), 'results': results}
+
+
+def slack_batch(size, at_bot='<@UBOTID>'):
+    """A batch of RTM events where only the last one is for the bot."""
+    batch = [{'type': 'message', 'text': 'chatter %d' % i,
+              'channel': 'C%06d' % i, 'user': 'U%06d' % i}
+             for i in range(size - 1)]
+    batch.append({'type': 'message',
+                  'text': '%s Show Me Some Mugs' % at_bot,
+                  'channel': 'C000001', 'user': 'U000001'})
+    return batch
+
+
+def shopping_cart(size):
+    return [cart_items.new_item('%06d' % (100000 + i), 'Product %d' % i,
+                                quantity=1 + i % 3)
+            for i in range(size)]
+
+
+def context(size):
+    ctx = dict(('key_%d' % i, 'value %d' % i) for i in range(size))
+    ctx.update({'conversation_id': 'conv', 'system': {'dialog_stack': []}})
+    return ctx
+
+
+class FakeConversation(object):
+
+    def list_workspaces(self):
+        return {'workspaces': [{'workspace_id': 'bench',
+                                'name': 'watson-online-store'}]}
+
+
+class FakeDiscovery(object):
+    """Returns a fresh shallow copy so the score filter cannot mutate it."""
+
+    def __init__(self, response):
+        self.response = response
+
+    def query(self, environment_id, collection_id, query_options):
+        return dict(self.response)
+
+
+class FakeStore(object):
+
+    def __init__(self, cart):
+        self.cart = cart
+
+    def list_shopping_cart(self, customer_str):
+        return self.cart
+
+
+class ChangingStore(object):
+    """A cart whose last item is added and removed on alternate reads."""
+
+    def __init__(self, cart):
+        self.carts = [cart, cart + shopping_cart(1)]
+        self.reads = 0
+
+    def list_shopping_cart(self, customer_str):
+        self.reads += 1
+        return self.carts[self.reads % 2]
+
+
+def make_bot(discovery_client=None, store=None):
+    bot = watson_online_store.WatsonOnlineStore(
+        'UBOTID', None, FakeConversation(), discovery_client, store)
+    bot.customer = watson_online_store.OnlineStoreCustomer(
+        email='bench@example.com', first_name='Bench', last_name='Mark',
+        shopping_cart=[])
+    return bot
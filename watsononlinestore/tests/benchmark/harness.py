@@ -0,0 +1,142 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Minimal timing/allocation harness shared by the benchmark modules.
+
+Every benchmark is a zero-argument callable. `measure` reports the best
+per-call wall time over a few repeats and, where tracemalloc is available
+(Python 3), the peak and retained bytes allocated by a single call.
+"""
+
+import gc
+import json
+import logging
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+# Allowed slowdown/growth over the saved baseline before --check fails.
+DEFAULT_TOLERANCE = 1.5
+# Results below these floors are too noisy to compare meaningfully.
+MIN_COMPARABLE_US = 5.0
+MIN_COMPARABLE_BYTES = 4096
+
+
+def quiet_logging():
+    """Debug logging, if the caller enabled it, would dominate timings."""
+    logging.getLogger('watsononlinestore').setLevel(logging.WARNING)
+
+
+def _calls_per_repeat(func, min_time=0.05):
+    """Pick a loop count so each repeat runs for at least min_time."""
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= min_time or number >= 1000000:
+            return number
+        number *= 10
+
+
+def _allocations(func):
+    if tracemalloc is None:
+        return None, None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        result = func()
+        after, peak = tracemalloc.get_traced_memory()
+        del result
+    finally:
+        tracemalloc.stop()
+    return max(peak - before, 0), max(after - before, 0)
+
+
+def measure(name, func, repeat=5):
+    """Time and profile allocations of func.
+
+    :param name: Benchmark name used in reports and baselines
+    :param func: Zero-argument callable to measure
+    :param repeat: Number of timing repeats; the best one is reported
+    :return: dict with per_call_us, peak_bytes and retained_bytes
+    """
+    number = _calls_per_repeat(func)
+    timings = timeit.repeat(func, number=number, repeat=repeat)
+    per_call_us = min(timings) / number * 1e6
+    peak_bytes, retained_bytes = _allocations(func)
+    return {'name': name,
+            'calls': number,
+            'per_call_us': round(per_call_us, 3),
+            'peak_bytes': peak_bytes,
+            'retained_bytes': retained_bytes}
+
+
+def run_suite(benchmarks, repeat=5, out=None):
+    """Measure every (name, func) pair and optionally print a table."""
+    results = []
+    for name, func in benchmarks:
+        result = measure(name, func, repeat=repeat)
+        results.append(result)
+        if out:
+            out.write(format_result(result) + "\n")
+    return results
+
+
+def format_result(result):
+    peak = result['peak_bytes']
+    return "%-45s %12.2f us/call %12s peak bytes" % (
+        result['name'], result['per_call_us'],
+        '-' if peak is None else peak)
+
+
+def save_baseline(results, path):
+    baseline = dict((r['name'], {'per_call_us': r['per_call_us'],
+                                 'peak_bytes': r['peak_bytes']})
+                    for r in results)
+    with open(path, 'w') as baseline_file:
+        json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def check_regressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Compare results against a saved baseline.
+
+    :param results: List of dicts returned by `measure`
+    :param baseline: Mapping of name to saved per_call_us/peak_bytes
+    :param tolerance: Allowed ratio of current over baseline
+    :return: List of human readable regression descriptions (empty if OK)
+    """
+    regressions = []
+    for result in results:
+        saved = baseline.get(result['name'])
+        if not saved:
+            continue
+        checks = (('per_call_us', MIN_COMPARABLE_US),
+                  ('peak_bytes', MIN_COMPARABLE_BYTES))
+        for key, floor in checks:
+            current, previous = result.get(key), saved.get(key)
+            if current is None or previous is None:
+                continue
+            limit = max(previous, floor) * tolerance
+            if current > limit:
+                regressions.append(
+                    "%s: %s %.2f exceeds %.2f (baseline %.2f x %.2f)" % (
+                        result['name'], key, current, limit,
+                        previous, tolerance))
+    return regressions
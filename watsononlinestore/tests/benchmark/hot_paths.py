@@ -0,0 +1,147 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Micro-benchmarks for the code that runs on every Slack message.
+
+Run from the repository root:
+
+    python -m watsononlinestore.tests.benchmark.hot_paths
+    python -m watsononlinestore.tests.benchmark.hot_paths --save
+    python -m watsononlinestore.tests.benchmark.hot_paths --check
+
+--save records a local baseline and --check exits non-zero when any
+benchmark is slower or allocates more than the baseline allows.
+"""
+
+import argparse
+import sys
+
+from watsononlinestore.tests.benchmark import fixtures
+from watsononlinestore.tests.benchmark import harness
+from watsononlinestore import rendering
+from watsononlinestore import watson_online_store
+
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+
+# Result and cart sizes: a typical turn and a deliberately large one.
+RESULT_COUNTS = (10, 1000)
+CART_SIZES = (10, 1000)
+SLACK_BATCH_SIZES = (1, 100)
+CONTEXT_SIZES = (20, 2000)
+
+
+def hot_path_benchmarks(scale=1):
+    """Return (name, callable) pairs for every hot path.
+
+    :param scale: Divides the large sizes; tests use it to run quickly
+    """
+    pages = fixtures.load_pages()
+    benchmarks = []
+
+    def sized(sizes):
+        return sorted(set(max(1, size // scale) for size in sizes))
+
+    for count in sized(RESULT_COUNTS):
+        response = fixtures.discovery_response(pages, count)
+        wos = watson_online_store.WatsonOnlineStore
+        benchmarks.append((
+            'format_discovery_response[%d]' % count,
+            lambda r=response: wos.format_discovery_response(r)))
+        # The same results again, with their cards cached.
+        renderer = rendering.Renderer()
+        benchmarks.append((
+            'format_discovery_response[cached %d]' % count,
+            lambda r=response, c=renderer: wos.format_discovery_response(
+                r, c)))
+        entries = wos.format_discovery_response(response)
+        benchmarks.append((
+            'result_attachments[%d]' % count,
+            lambda e=entries: rendering.result_attachments(e)))
+
+        bot = fixtures.make_bot(discovery_client=fixtures.FakeDiscovery(
+            response))
+        bot.discovery_score_filter = 0.15
+        benchmarks.append((
+            'get_discovery_response[%d]' % count,
+            lambda b=bot: b.get_discovery_response('mugs')))
+
+    for size in sized(SLACK_BATCH_SIZES):
+        bot = fixtures.make_bot()
+        batch = fixtures.slack_batch(size)
+        benchmarks.append((
+            'parse_slack_output[%d]' % size,
+            lambda b=bot, o=batch: b.parse_slack_output(o)))
+
+    for size in sized(CONTEXT_SIZES):
+        bot = fixtures.make_bot()
+        ctx = fixtures.context(size)
+        update = bot.customer.get_customer_dict()
+        benchmarks.append((
+            'context_merge[%d]' % size,
+            lambda b=bot, c=ctx, u=update: b.context_merge(c, u)))
+
+    for size in sized(CART_SIZES):
+        bot = fixtures.make_bot(store=fixtures.FakeStore(
+            fixtures.shopping_cart(size)))
+        benchmarks.append((
+            'handle_list_shopping_cart[%d]' % size,
+            lambda b=bot: b.handle_list_shopping_cart()))
+
+        # Every listing differs from the last in its last item.
+        bot = fixtures.make_bot(store=fixtures.ChangingStore(
+            fixtures.shopping_cart(size)))
+        benchmarks.append((
+            'handle_list_shopping_cart[changed %d]' % size,
+            lambda b=bot: b.handle_list_shopping_cart()))
+
+        cart = fixtures.shopping_cart(size)
+        benchmarks.append((
+            'cart_listing[uncached %d]' % size,
+            lambda c=cart: rendering.Renderer().cart_listing('bench', c)))
+
+    return benchmarks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='baseline file (default: %(default)s)')
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('--check', action='store_true',
+                        help='fail if results regress past the baseline')
+    parser.add_argument('--tolerance', type=float,
+                        default=harness.DEFAULT_TOLERANCE,
+                        help='allowed ratio over baseline '
+                             '(default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    harness.quiet_logging()
+    results = harness.run_suite(hot_path_benchmarks(), repeat=args.repeat,
+                                out=sys.stdout)
+    if args.save:
+        harness.save_baseline(results, args.baseline)
+        print("Saved baseline to %s" % args.baseline)
+    if args.check:
+        regressions = harness.check_regressions(
+            results, harness.load_baseline(args.baseline), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            return 1
+        print("No regressions against %s" % args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Memory held per user session when many users are connected.
+
+Run from the repository root (Python 3, which has tracemalloc):
+
+    python -m watsononlinestore.tests.benchmark.session_memory
+    python -m watsononlinestore.tests.benchmark.session_memory --sessions 1000
+
+Each simulated session has a customer and the dialog context of a user
+who has searched once, built the way the bot builds them on a turn.
+"""
+
+import argparse
+import gc
+import json
+import sys
+
+from watsononlinestore.tests.benchmark import fixtures
+from watsononlinestore.tests.benchmark import harness
+
+DEFAULT_SESSIONS = 100000
+CONTEXT_JSON = json.dumps({
+    'conversation_id': 'conv-%08d',
+    'system': {'dialog_stack': [{'dialog_node': 'root'}],
+               'dialog_turn_counter': 2,
+               'dialog_request_counter': 2,
+               '_node_output_map': {'node_1_1498145843185': [0]},
+               'branch_exited': True,
+               'branch_exited_reason': 'completed'},
+    'discovery_string': '',
+    'get_input': 'yes'})
+
+
+class ReplayConversation(fixtures.FakeConversation):
+    """Replies like Conversation: a newly decoded context every turn."""
+
+    def __init__(self):
+        self.index = 0
+
+    def message(self, workspace_id, message_input, context):
+        return {'context': json.loads(CONTEXT_JSON % self.index),
+                'output': {'text': ['Hello']}}
+
+
+class NullSender(object):
+
+    def send_message(self, message, attachments=None):
+        pass
+
+
+def simulated_session(bot, index):
+    """One user's session after a greeting and a search."""
+    bot.session = bot.session_for('U%08d' % index)
+    bot.conversation_client.index = index
+    bot.handle_message('hello', NullSender())
+    bot.customer_from_db({'email': 'user%d@example.com' % index,
+                          'first_name': 'First%d' % index,
+                          'last_name': 'Last%d' % index})
+    bot.add_customer_to_context()
+    bot.context = bot.context_merge(
+        bot.context, {'discovery_result': '\n1) Mug %d' % index})
+    return bot.session
+
+
+def session_bytes(sessions=DEFAULT_SESSIONS):
+    """
+    Returns - average bytes retained per session, or None without
+    tracemalloc
+    """
+    if harness.tracemalloc is None:
+        return None
+    bot = fixtures.make_bot()
+    bot.conversation_client = ReplayConversation()
+    gc.collect()
+    harness.tracemalloc.start()
+    try:
+        before, _ = harness.tracemalloc.get_traced_memory()
+        for index in range(sessions):
+            simulated_session(bot, index)
+        gc.collect()
+        after, _ = harness.tracemalloc.get_traced_memory()
+    finally:
+        harness.tracemalloc.stop()
+    return (after - before) / float(sessions)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=DEFAULT_SESSIONS)
+    args = parser.parse_args(argv)
+
+    harness.quiet_logging()
+    per_session = session_bytes(args.sessions)
+    if per_session is None:
+        print("tracemalloc is not available on this Python")
+        return 1
+    print("%d sessions: %.0f bytes per session, %.1f MB in total" % (
+        args.sessions, per_session, per_session * args.sessions / 2 ** 20))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Soak test: memory must stop growing once every user has a session.
+
+Run from the repository root (Python 3, which has tracemalloc):
+
+    python -m watsononlinestore.tests.benchmark.soak
+    python -m watsononlinestore.tests.benchmark.soak --users 100 --rounds 50
+
+The same users keep talking to the bot, round after round. After the
+warm-up rounds, memory that is still retained is a leak; the run fails
+if it exceeds --max-growth bytes per user.
+"""
+
+import argparse
+import gc
+import sys
+
+from watsononlinestore import metrics
+from watsononlinestore.tests.benchmark import fixtures
+from watsononlinestore.tests.benchmark import harness
+from watsononlinestore.tests.benchmark import session_memory
+
+DEFAULT_USERS = 1000
+DEFAULT_ROUNDS = 20
+# At least; also until the metrics' sample windows are full.
+WARMUP_ROUNDS = 2
+# Retained bytes per user allowed after warm-up (allocator noise).
+DEFAULT_MAX_GROWTH = 64
+
+
+def warmup_rounds(users):
+    return max(WARMUP_ROUNDS, -(-metrics.SAMPLE_WINDOW // users))
+
+
+def growth_per_user(users=DEFAULT_USERS, rounds=DEFAULT_ROUNDS):
+    """
+    Returns - bytes per user retained by the rounds after warm-up, or None
+              without tracemalloc
+    """
+    if harness.tracemalloc is None:
+        return None
+    warmup = warmup_rounds(users)
+    bot = fixtures.make_bot()
+    bot.conversation_client = session_memory.ReplayConversation()
+    harness.tracemalloc.start()
+    try:
+        for round_number in range(rounds):
+            for index in range(users):
+                session_memory.simulated_session(bot, index)
+            if round_number == warmup - 1:
+                gc.collect()
+                warm, _ = harness.tracemalloc.get_traced_memory()
+        gc.collect()
+        end, _ = harness.tracemalloc.get_traced_memory()
+    finally:
+        harness.tracemalloc.stop()
+    return (end - warm) / float(users)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=DEFAULT_USERS)
+    parser.add_argument('--rounds', type=int, default=DEFAULT_ROUNDS)
+    parser.add_argument('--max-growth', type=float,
+                        default=DEFAULT_MAX_GROWTH)
+    args = parser.parse_args(argv)
+    if args.rounds <= warmup_rounds(args.users):
+        parser.error("--rounds must be more than %d for %d users" % (
+            warmup_rounds(args.users), args.users))
+
+    harness.quiet_logging()
+    growth = growth_per_user(args.users, args.rounds)
+    if growth is None:
+        print("tracemalloc is not available on this Python")
+        return 1
+    print("%d users, %d rounds: %.1f bytes per user retained after "
+          "warm-up" % (args.users, args.rounds, growth))
+    if growth > args.max_growth:
+        print("FAIL: more than %.0f bytes per user" % args.max_growth)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
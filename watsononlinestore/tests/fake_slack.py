@@ -0,0 +1,78 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A local stand-in for Slack: signs and posts Events API requests, and
+records the Web API calls the bot makes in reply."""
+
+import json
+import threading
+import time
+
+try:
+    from urllib.request import Request
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+except ImportError:  # Python 2
+    from urllib2 import Request
+    from urllib2 import urlopen
+    from urllib2 import HTTPError
+
+from watsononlinestore import slack_events
+
+SIGNING_SECRET = 'fake-signing-secret'
+
+
+class FakeSlackClient(object):
+    """Records api_call()s and answers like Slack's Web API."""
+
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def api_call(self, method, **kwargs):
+        with self.lock:
+            self.calls.append((method, kwargs))
+            ts = '%d.000000' % len(self.calls)
+        return {'ok': True, 'ts': ts, 'channel': kwargs.get('channel')}
+
+
+def event_payload(text, channel='C0FAKE', user='U0FAKE',
+                  event_id='Ev0001'):
+    return {'type': 'event_callback',
+            'event_id': event_id,
+            'event': {'type': 'message', 'text': text,
+                      'channel': channel, 'user': user}}
+
+
+def signed_headers(body, signing_secret=SIGNING_SECRET, timestamp=None):
+    timestamp = str(int(timestamp if timestamp is not None
+                        else time.time()))
+    return {'Content-Type': 'application/json',
+            'X-Slack-Request-Timestamp': timestamp,
+            'X-Slack-Signature': slack_events.compute_signature(
+                signing_secret, timestamp, body)}
+
+
+def post_event(url, payload, signing_secret=SIGNING_SECRET, timestamp=None):
+    """
+    POSTs payload to url the way Slack does.
+    Returns - (HTTP status, response body)
+    """
+    body = json.dumps(payload).encode('utf-8')
+    request = Request(url, data=body,
+                      headers=signed_headers(body, signing_secret,
+                                             timestamp))
+    try:
+        response = urlopen(request, timeout=5)
+    except HTTPError as e:
+        return e.code, e.read()
+    return response.getcode(), response.read()
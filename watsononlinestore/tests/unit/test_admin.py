@@ -0,0 +1,44 @@
+import json
+import unittest
+
+import mock
+
+from watsononlinestore import admin
+from watsononlinestore.metrics import METRICS
+
+
+class AdminAppTestCase(unittest.TestCase):
+
+    def call(self, app, path, token=None):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path}
+        if token:
+            environ['HTTP_AUTHORIZATION'] = 'Bearer ' + token
+        start_response = mock.Mock()
+        body = b''.join(app(environ, start_response))
+        return start_response.call_args[0][0], json.loads(body)
+
+    def test_metrics(self):
+        METRICS.incr('admin.test')
+        status, body = self.call(admin.AdminApp(), '/admin/metrics')
+
+        self.assertEqual('200 OK', status)
+        self.assertGreaterEqual(body['counters']['admin.test'], 1)
+
+    def test_token(self):
+        app = admin.AdminApp(token='s3cret')
+
+        self.assertEqual('401 Unauthorized',
+                         self.call(app, '/admin/metrics')[0])
+        self.assertEqual('401 Unauthorized',
+                         self.call(app, '/admin/metrics', 'wrong')[0])
+        self.assertEqual('200 OK',
+                         self.call(app, '/admin/metrics', 's3cret')[0])
+
+    def test_routes(self):
+        app = admin.AdminApp()
+        app.route('/admin/echo', lambda environ: {'path': environ[
+            'PATH_INFO']})
+
+        self.assertEqual(('200 OK', {'path': '/admin/echo'}),
+                         self.call(app, '/admin/echo'))
+        self.assertEqual('404 Not Found', self.call(app, '/admin/nope')[0])
@@ -0,0 +1,139 @@
+import threading
+import unittest
+
+import mock
+
+from watsononlinestore import admission
+from watsononlinestore.metrics import METRICS
+from watsononlinestore import watson_online_store
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def message(user, text, channel='D1'):
+    return {'type': 'message', 'channel': channel, 'user': user,
+            'text': text}
+
+
+class AdmissionControllerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        conv_client = mock.Mock()
+        conv_client.list_workspaces.return_value = {
+            'workspaces': [{'workspace_id': 'ws',
+                            'name': 'watson-online-store'}]}
+        self.wos = watson_online_store.WatsonOnlineStore(
+            'UBOTID', mock.Mock(), conv_client, None, mock.Mock())
+        self.wos.handle_slack_output = mock.Mock()
+        self.wos.post_to_slack = mock.Mock()
+        self.clock = FakeClock()
+        self.admission = admission.AdmissionController(
+            self.wos, per_user_limit=2, global_limit=3, clock=self.clock)
+        self.wos.admission = self.admission
+
+    def take_all(self):
+        turns = []
+        while self.admission.pending:
+            turns.append(self.admission._take().event())
+        return turns
+
+    def test_messages_from_one_user_are_merged(self):
+        self.wos.process_slack_output([message('U1', 'show me'),
+                                       message('U1', 'mugs')])
+
+        self.assertEqual(2, self.admission.depth)
+        self.assertEqual([message('U1', 'show me\nmugs')], self.take_all())
+        self.assertEqual(0, self.admission.depth)
+        self.assertEqual(0, METRICS.snapshot()['gauges'][
+            'admission.queue_depth'])
+
+    def test_users_are_served_in_arrival_order(self):
+        self.wos.process_slack_output([message('U1', 'a'),
+                                       message('U2', 'b'),
+                                       message('U1', 'c')])
+
+        self.assertEqual(['a\nc', 'b'],
+                         [e['text'] for e in self.take_all()])
+
+    def test_ignores_messages_not_for_bot(self):
+        self.wos.process_slack_output([message('U1', 'hi', channel='C1'),
+                                       {'type': 'hello'}])
+
+        self.assertEqual(0, self.admission.depth)
+
+    def test_per_user_limit_sheds_once(self):
+        shed = METRICS.snapshot()['counters'].get('admission.shed.user', 0)
+        self.wos.process_slack_output([message('U1', str(i))
+                                       for i in range(4)])
+
+        self.assertEqual(2, self.admission.depth)
+        self.assertEqual(shed + 2, METRICS.snapshot()['counters'][
+            'admission.shed.user'])
+        self.wos.post_to_slack.assert_called_once_with(
+            admission.BUSY_MESSAGE, 'D1')
+
+        # Once drained, the user is told again next time.
+        self.take_all()
+        self.wos.process_slack_output([message('U1', str(i))
+                                       for i in range(3)])
+        self.assertEqual(2, self.wos.post_to_slack.call_count)
+
+    def test_global_limit(self):
+        self.wos.process_slack_output([message('U%d' % i, 'hi')
+                                       for i in range(4)])
+
+        self.assertEqual(3, self.admission.depth)
+        self.assertEqual(['U0', 'U1', 'U2'], list(self.admission.pending))
+        self.wos.post_to_slack.assert_called_once_with(
+            admission.BUSY_MESSAGE, 'D1')
+
+    def test_debounce(self):
+        self.admission.debounce = 0.5
+        self.wos.process_slack_output([message('U1', 'a')])
+        self.assertEqual((None, 0.5), self.admission._next_ready())
+
+        self.clock.now += 0.4
+        self.wos.process_slack_output([message('U1', 'b')])
+        self.assertEqual(None, self.admission._next_ready()[0])
+
+        self.clock.now += 0.5
+        self.assertEqual(('U1', 0), self.admission._next_ready())
+
+    def test_withdraw(self):
+        self.wos.process_slack_output([message('U1', 'a'),
+                                       message('U2', 'b'),
+                                       message('U1', 'c')])
+
+        self.assertEqual([message('U1', 'a'), message('U1', 'c')],
+                         self.admission.withdraw(['U1', 'U3']))
+        self.assertEqual(['U2'], list(self.admission.pending))
+        self.assertEqual(1, self.admission.depth)
+
+    def test_withdraw_waits_for_running_turn(self):
+        self.wos.process_slack_output([message('U1', 'a')])
+        self.admission._take()
+        done = threading.Timer(0.1, self.admission._done)
+        done.start()
+
+        self.assertEqual([], self.admission.withdraw(['U1'], timeout=5))
+        self.assertIsNone(self.admission.running_user)
+        done.join()
+
+    def test_worker_handles_turns(self):
+        handled = threading.Event()
+        self.wos.handle_slack_output.side_effect = lambda e: handled.set()
+        self.wos.start_services()
+        try:
+            self.wos.process_slack_output([message('U1', 'hi')])
+            self.assertTrue(handled.wait(5))
+        finally:
+            self.admission.stop(5)
+        self.wos.handle_slack_output.assert_called_once_with(
+            [message('U1', 'hi')])
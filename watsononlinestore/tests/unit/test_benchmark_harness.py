@@ -0,0 +1,67 @@
+import unittest
+
+import mock
+
+from watsononlinestore.tests.benchmark import harness
+from watsononlinestore.tests.benchmark import hot_paths
+from watsononlinestore.tests.benchmark import session_memory
+from watsononlinestore.tests.benchmark import soak
+
+
+class BenchmarkHarnessTestCase(unittest.TestCase):
+
+    def test_measure(self):
+        result = harness.measure('sum', lambda: sum(range(100)), repeat=1)
+
+        self.assertEqual('sum', result['name'])
+        self.assertGreater(result['per_call_us'], 0)
+
+    def test_check_regressions(self):
+        baseline = {'fast': {'per_call_us': 100.0, 'peak_bytes': 10000},
+                    'slow': {'per_call_us': 100.0, 'peak_bytes': 10000}}
+        results = [
+            {'name': 'fast', 'per_call_us': 120.0, 'peak_bytes': 10000},
+            {'name': 'slow', 'per_call_us': 200.0, 'peak_bytes': 10000},
+            {'name': 'new', 'per_call_us': 900.0, 'peak_bytes': 10000},
+        ]
+
+        regressions = harness.check_regressions(results, baseline, 1.5)
+
+        self.assertEqual(1, len(regressions))
+        self.assertTrue(regressions[0].startswith('slow: per_call_us'))
+
+    def test_check_regressions_ignores_noise_floor(self):
+        baseline = {'tiny': {'per_call_us': 0.5, 'peak_bytes': 10}}
+        results = [{'name': 'tiny', 'per_call_us': 2.0, 'peak_bytes': 400}]
+
+        self.assertEqual(
+            [], harness.check_regressions(results, baseline, 1.5))
+
+    def test_hot_path_benchmarks_run(self):
+        benchmarks = hot_paths.hot_path_benchmarks(scale=100)
+
+        self.assertTrue(benchmarks)
+        for name, func in benchmarks:
+            func()
+
+    @unittest.skipIf(harness.tracemalloc is None, "needs tracemalloc")
+    def test_session_memory_runs(self):
+        self.assertGreater(session_memory.session_bytes(sessions=20), 0)
+
+    @unittest.skipIf(harness.tracemalloc is None, "needs tracemalloc")
+    def test_soak_passes(self):
+        self.assertEqual(0, soak.main(['--users', '50', '--rounds', '25']))
+
+    @unittest.skipIf(harness.tracemalloc is None, "needs tracemalloc")
+    def test_soak_fails_on_leak(self):
+        leaked = []
+        simulated_session = session_memory.simulated_session
+
+        def leaky_session(bot, index):
+            leaked.append(bytearray(1000))
+            return simulated_session(bot, index)
+
+        with mock.patch.object(session_memory, 'simulated_session',
+                               leaky_session):
+            self.assertEqual(1, soak.main(['--users', '50', '--rounds',
+                                           '25']))
@@ -0,0 +1,55 @@
+import unittest
+
+from watsononlinestore.database import cart_items
+
+
+class CartItemsTestCase(unittest.TestCase):
+
+    def test_add_increments(self):
+        cart = {}
+        item = cart_items.new_item('206347', 'Sweatshirt')
+
+        cart_items.add_item(cart, item, now=1)
+        cart_items.add_item(cart, item, 2, now=2)
+
+        self.assertEqual({'206347': {'name': 'Sweatshirt', 'qty': 3,
+                                     'added': 1}}, cart)
+        self.assertEqual([dict(item, quantity=3)], cart_items.list_items(cart))
+
+    def test_url_only_stored_when_not_canonical(self):
+        cart = {}
+
+        cart_items.add_item(cart, cart_items.new_item('1', 'a', 'http://a'))
+
+        self.assertEqual('http://a', cart['1']['url'])
+        self.assertEqual('http://a', cart_items.list_items(cart)[0]['url'])
+
+    def test_remove(self):
+        cart = cart_items.from_items([cart_items.new_item('1', 'a',
+                                                          quantity=2)])
+
+        self.assertTrue(cart_items.remove_item(cart, '1', 1))
+        self.assertEqual(1, cart['1']['qty'])
+        self.assertTrue(cart_items.remove_item(cart, '1'))
+        self.assertEqual({}, cart)
+        self.assertFalse(cart_items.remove_item(cart, '1'))
+
+    def test_migrate_cart(self):
+        legacy = [
+            'THINK Mug: http://www.logostore-globalid.us/'
+            'ProductDetail.aspx?pid=132254\n',
+            'Name: with colon: http://x/ProductDetail.aspx?pid=1\n',
+            'THINK Mug: http://www.logostore-globalid.us/'
+            'ProductDetail.aspx?pid=132254\n',
+            'No url: \n',
+        ]
+
+        items = cart_items.list_items(cart_items.migrate_cart(legacy))
+
+        self.assertEqual(3, len(items))
+        self.assertEqual(cart_items.new_item('132254', 'THINK Mug',
+                                             quantity=2), items[0])
+        self.assertEqual(('1', 'Name: with colon'),
+                         (items[1]['product_id'], items[1]['name']))
+        self.assertTrue(items[2]['product_id'].startswith('legacy-'))
+        self.assertEqual('', items[2]['url'])
@@ -0,0 +1,178 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from watsononlinestore.database import cart_items
+from watsononlinestore.database import cart_journal
+from watsononlinestore.database import sqlite_online_store
+from watsononlinestore import watson_online_store
+
+
+ITEM_A = cart_items.new_item('1', 'a')
+ITEM_B = cart_items.new_item('2', 'b')
+
+
+class WriteBehindOnlineStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.tmpdir, 'cart.journal')
+        self.backend = sqlite_online_store.SQLiteOnlineStore(
+            os.path.join(self.tmpdir, 'store.db'))
+        self.backend.init()
+        self.backend.add_customer_obj(watson_online_store.OnlineStoreCustomer(
+            email='e@mail', first_name='first', last_name='last',
+            shopping_cart=[]))
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.tmpdir)
+
+    def make_store(self, backend=None):
+        return cart_journal.WriteBehindOnlineStore(
+            backend or self.backend,
+            cart_journal.CartJournal(self.journal_path, sync_interval=0.01),
+            retry_delay=0.01)
+
+    def test_writes_reach_backend(self):
+        store = self.make_store()
+        store.init()
+
+        self.assertEqual(1, store.add_to_shopping_cart('e@mail', ITEM_A))
+        self.assertEqual(1, store.add_to_shopping_cart('e@mail', ITEM_B))
+        self.assertEqual(1, store.delete_item_shopping_cart('e@mail', '1'))
+        self.assertEqual(0, store.delete_item_shopping_cart('e@mail', 'x'))
+        store.stop()
+
+        self.assertEqual([ITEM_B], self.backend.list_shopping_cart('e@mail'))
+        self.assertEqual([], store.journal.pending())
+
+    def test_append_after_close_is_rejected(self):
+        journal = cart_journal.CartJournal(self.journal_path)
+        self.assertRaises(ValueError, journal.append, cart_journal.ADD,
+                          'e@mail', item=ITEM_A)
+        journal.open()
+        journal.append(cart_journal.ADD, 'e@mail', item=ITEM_A)
+        journal.close()
+
+        self.assertRaises(ValueError, journal.append, cart_journal.ADD,
+                          'e@mail', item=ITEM_B)
+        self.assertEqual(2, journal.next_seq)
+
+    def test_stop_stops_backend(self):
+        backend = mock.Mock(wraps=self.backend)
+        store = self.make_store(backend)
+        store.init()
+        store.add_to_shopping_cart('e@mail', ITEM_A)
+        store.stop(timeout=5)
+
+        backend.stop.assert_called_once_with(5)
+        self.assertIsNone(store.journal.journal_file)
+        self.assertIsNone(self.backend.conn)
+
+    def test_reads_overlay_unflushed_entries(self):
+        backend = mock.Mock(wraps=self.backend)
+        backend.add_to_shopping_cart.side_effect = Exception('offline')
+        store = self.make_store(backend)
+        store.init()
+
+        store.add_to_shopping_cart('e@mail', ITEM_A)
+        store.add_to_shopping_cart('e@mail', ITEM_B)
+        store.delete_item_shopping_cart('e@mail', '1')
+
+        self.assertEqual([ITEM_B], store.list_shopping_cart('e@mail'))
+        self.assertEqual([], self.backend.list_shopping_cart('e@mail'))
+        store.stop()
+
+    def test_replay_on_restart(self):
+        backend = mock.Mock(wraps=self.backend)
+        backend.add_to_shopping_cart.side_effect = Exception('offline')
+        store = self.make_store(backend)
+        store.init()
+        store.add_to_shopping_cart('e@mail', ITEM_A)
+        store.add_to_shopping_cart('e@mail', ITEM_B)
+        store.stop()
+        self.assertEqual([], self.backend.list_shopping_cart('e@mail'))
+
+        restarted = self.make_store()
+        restarted.init()
+        restarted.stop()
+
+        self.assertEqual([ITEM_A, ITEM_B],
+                         self.backend.list_shopping_cart('e@mail'))
+
+    def test_replay_after_apply_is_idempotent(self):
+        store = self.make_store()
+        # Crash after the backend write, before the checkpoint.
+        store.journal.mark_applied = mock.Mock(side_effect=Exception('crash'))
+        store.init()
+        store.add_to_shopping_cart('e@mail', ITEM_A, quantity=2)
+        store.delete_item_shopping_cart('e@mail', '1', quantity=1)
+        store.stop()
+        # The add was retried without adding twice; the delete never ran.
+        self.assertEqual([dict(ITEM_A, quantity=2)],
+                         self.backend.list_shopping_cart('e@mail'))
+
+        restarted = self.make_store()
+        self.assertEqual(2, len(restarted.journal.open()))
+        restarted.journal.close()
+        restarted.init()
+        restarted.stop()
+        self.assertEqual([ITEM_A], self.backend.list_shopping_cart('e@mail'))
+        self.assertEqual([], restarted.journal.pending())
+
+    def test_compaction(self):
+        store = self.make_store()
+        store.compact_every = 1
+        store.init()
+        store.add_to_shopping_cart('e@mail', ITEM_A)
+        store.stop()
+
+        with open(self.journal_path) as journal_file:
+            self.assertEqual('', journal_file.read())
+
+
+class CartJournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.journal = cart_journal.CartJournal(
+            os.path.join(self.tmpdir, 'cart.journal'), sync_interval=0.01)
+        self.journal.open()
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_append_waits_for_group_fsync(self):
+        fsyncs = []
+        real_fsync = os.fsync
+
+        def slow_fsync(fd):
+            time.sleep(0.02)
+            fsyncs.append(self.journal.next_seq - 1)
+            real_fsync(fd)
+
+        entries = []
+
+        def append(i):
+            entry = self.journal.append(cart_journal.ADD, 'e@mail',
+                                        item=ITEM_A, quantity=i)
+            # Acknowledged only once an fsync covered the entry.
+            entries.append(self.journal.synced_seq >= entry['seq'])
+
+        with mock.patch.object(cart_journal.os, 'fsync', slow_fsync):
+            threads = [threading.Thread(target=append, args=(i,))
+                       for i in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([True] * 20, entries)
+        self.assertLess(len(fsyncs), 20)
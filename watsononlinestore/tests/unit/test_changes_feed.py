@@ -0,0 +1,228 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from watsononlinestore.database import changes_feed
+from watsononlinestore.tests.http_fixture import FixtureServer
+
+try:
+    from urllib.parse import parse_qs
+except ImportError:  # Python 2
+    from urlparse import parse_qs
+
+
+class FakeCouch(object):
+    """The _changes feed of one database, with long polling."""
+
+    def __init__(self):
+        self.changes = []
+        self.failures = 0
+        self.condition = threading.Condition()
+
+    def change(self, doc_id, deleted=False):
+        with self.condition:
+            seq = '%d-g1AAAA' % (len(self.changes) + 1)
+            change = {'seq': seq, 'id': doc_id,
+                      'changes': [{'rev': '1-abc'}]}
+            if deleted:
+                change['deleted'] = True
+            self.changes.append(change)
+            self.condition.notify_all()
+
+    def _after(self, since):
+        return self.changes[int(since.split('-')[0]):]
+
+    def __call__(self, request):
+        path, _, query = request.path.partition('?')
+        if path != '/store/_changes':
+            return 404, {}, b'{"error": "not_found"}'
+        with self.condition:
+            if self.failures:
+                self.failures -= 1
+                return 500, {}, b'{"error": "unavailable"}'
+            params = dict((k, v[0]) for k, v in parse_qs(query).items())
+            if params['since'] == 'now':
+                params['since'] = str(len(self.changes))
+            deadline = time.time() + int(params['timeout']) / 1000.0
+            while (not self._after(params['since']) and
+                   time.time() < deadline):
+                self.condition.wait(deadline - time.time())
+            results = self._after(params['since'])
+            last_seq = self.changes[-1]['seq'] if self.changes else '0'
+        return 200, {'Content-Type': 'application/json'}, json.dumps(
+            {'results': results, 'last_seq': last_seq}).encode()
+
+
+class ChangesFeedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.tmpdir, 'changes.json')
+        self.couch = FakeCouch()
+        self.changed = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def feed(self, server, **kwargs):
+        kwargs.setdefault('poll_timeout', 1)
+        return changes_feed.ChangesFeed(server.url, 'store', 'user', 'pass',
+                                        self.checkpoint,
+                                        on_change=self.changed.append,
+                                        **kwargs)
+
+    def test_poll_saves_checkpoint(self):
+        self.couch.change('cart:old@example.com')
+        with FixtureServer(self.couch) as server:
+            feed = self.feed(server)
+            # Without a checkpoint, history is skipped.
+            self.assertEqual(0, feed.poll())
+            self.couch.change('cart:a@example.com')
+            self.couch.change('customer-1', deleted=True)
+            self.assertEqual(2, feed.poll())
+
+            self.assertEqual(['cart:a@example.com', 'customer-1'],
+                             self.changed)
+            request = server.requests[-1]
+            self.assertIn('feed=longpoll', request.path)
+            self.assertIn('since=1-g1AAAA', request.path)
+            self.assertEqual('Basic dXNlcjpwYXNz',
+                             request.headers['Authorization'])
+
+            # A restart resumes after the last change handled.
+            self.couch.change('cart:b@example.com')
+            self.assertEqual(1, self.feed(server).poll())
+        self.assertEqual('cart:b@example.com', self.changed[-1])
+        with open(self.checkpoint) as f:
+            self.assertEqual({'since': '4-g1AAAA'}, json.load(f))
+
+    def test_background_poller_retries(self):
+        self.couch.failures = 2
+        with open(self.checkpoint, 'w') as f:
+            json.dump({'since': '0'}, f)
+        with FixtureServer(self.couch) as server:
+            feed = self.feed(server, retry_delay=0.01)
+            feed.start()
+            try:
+                self.couch.change('cart:a@example.com')
+                deadline = time.time() + 10
+                while not self.changed and time.time() < deadline:
+                    time.sleep(0.01)
+            finally:
+                feed.stop()
+
+        self.assertEqual(['cart:a@example.com'], self.changed)
+        self.assertIsNone(feed.poller)
+
+
+class CachingOnlineStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = mock.Mock()
+        self.backend.find_customer.return_value = {
+            '_id': 'customer-1', 'email': 'a@example.com'}
+        self.backend.list_shopping_cart.return_value = [
+            {'product_id': '1', 'name': 'Mug', 'quantity': 1}]
+        self.store = changes_feed.CachingOnlineStore(self.backend,
+                                                     max_entries=2)
+
+    def test_reads_are_cached(self):
+        for _ in range(3):
+            self.assertEqual('Mug', self.store.list_shopping_cart(
+                'a@example.com')[0]['name'])
+            self.assertEqual('a@example.com', self.store.find_customer(
+                'a@example.com')['email'])
+
+        self.assertEqual(1, self.backend.list_shopping_cart.call_count)
+        self.assertEqual(1, self.backend.find_customer.call_count)
+        # Callers get copies.
+        self.store.list_shopping_cart('a@example.com')[0]['name'] = 'x'
+        self.assertEqual('Mug', self.store.list_shopping_cart(
+            'a@example.com')[0]['name'])
+
+    def test_unknown_customers_are_not_cached(self):
+        self.backend.find_customer.return_value = None
+        self.assertIsNone(self.store.find_customer('new@example.com'))
+        self.assertIsNone(self.store.find_customer('new@example.com'))
+        self.assertEqual(2, self.backend.find_customer.call_count)
+
+    def test_own_writes_invalidate(self):
+        self.store.list_shopping_cart('a@example.com')
+        self.store.add_to_shopping_cart('a@example.com', {'product_id': '2'})
+        self.store.list_shopping_cart('a@example.com')
+        self.store.delete_item_shopping_cart('a@example.com', '2',
+                                             journal_entry=('j', 1))
+        self.store.list_shopping_cart('a@example.com')
+
+        self.assertEqual(3, self.backend.list_shopping_cart.call_count)
+        self.backend.delete_item_shopping_cart.assert_called_once_with(
+            'a@example.com', '2', None, journal_entry=('j', 1))
+
+    def test_changed_docs_invalidate(self):
+        self.store.find_customer('a@example.com')
+        self.store.list_shopping_cart('a@example.com')
+
+        self.store.invalidate_doc('cart:a@example.com')
+        self.store.list_shopping_cart('a@example.com')
+        self.store.find_customer('a@example.com')
+        self.store.invalidate_doc('customer-1')
+        self.store.find_customer('a@example.com')
+        self.store.invalidate_doc('cart_archive:a@example.com:1')
+
+        self.assertEqual(2, self.backend.list_shopping_cart.call_count)
+        self.assertEqual(3, self.backend.find_customer.call_count)
+
+    def test_read_racing_a_change_is_not_cached(self):
+        def list_shopping_cart(customer_str):
+            # Another replica's write lands while this read is running.
+            self.store.invalidate_doc('cart:' + customer_str)
+            return [{'product_id': 'stale'}]
+        self.backend.list_shopping_cart.side_effect = list_shopping_cart
+
+        self.store.list_shopping_cart('a@example.com')
+        self.store.list_shopping_cart('a@example.com')
+
+        self.assertEqual(2, self.backend.list_shopping_cart.call_count)
+        self.assertEqual({}, dict(self.store.reading))
+        self.assertEqual(set(), self.store.stale)
+
+    def test_least_recently_used_are_evicted(self):
+        self.backend.find_customer.side_effect = lambda email: {
+            '_id': 'id-' + email, 'email': email}
+        for email in ('a', 'b', 'a', 'c'):
+            self.store.find_customer(email)
+
+        self.assertEqual(['a', 'c'], list(self.store.customers))
+        self.assertEqual({'id-a': 'a', 'id-c': 'c'}, self.store.customer_ids)
+
+    def test_feed_keeps_cache_coherent(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        couch = FakeCouch()
+        with FixtureServer(couch) as server:
+            feed = changes_feed.ChangesFeed(
+                server.url, 'store', 'user', 'pass',
+                os.path.join(tmpdir, 'changes.json'), poll_timeout=1)
+            store = changes_feed.CachingOnlineStore(self.backend, feed)
+            store.init()
+            try:
+                store.list_shopping_cart('a@example.com')
+                # Wait for the first poll, which starts from now.
+                deadline = time.time() + 10
+                while not server.requests and time.time() < deadline:
+                    time.sleep(0.01)
+                couch.change('cart:a@example.com')
+                while store.carts and time.time() < deadline:
+                    time.sleep(0.01)
+                store.list_shopping_cart('a@example.com')
+            finally:
+                store.stop()
+
+        self.assertEqual(2, self.backend.list_shopping_cart.call_count)
+        self.backend.stop.assert_called_once_with(None)
@@ -0,0 +1,216 @@
+import copy
+import unittest
+
+import mock
+from requests.exceptions import HTTPError
+
+from watsononlinestore.database import cart_items
+from watsononlinestore import watson_online_store
+
+try:
+    from watsononlinestore.database import cloudant_online_store
+except ImportError:  # cloudant is not installed
+    cloudant_online_store = None
+
+MUG = cart_items.product_url('132254')
+
+
+def http_error(status_code):
+    return HTTPError(response=mock.Mock(status_code=status_code))
+
+
+class FakeDatabase(object):
+    """Cloudant database in memory, with revisions and 409 conflicts."""
+
+    def __init__(self, docs=()):
+        self.docs = {}
+        for doc in docs:
+            self.docs[doc['_id']] = dict(doc, _rev='1')
+        # Called before each create or save, to let another replica in.
+        self.before_write = None
+
+    def create_document(self, data):
+        self._before_write()
+        doc_id = data.get('_id') or 'doc%d' % len(self.docs)
+        if doc_id in self.docs:
+            raise http_error(409)
+        doc = FakeDocument(self, doc_id)
+        doc.update(data)
+        doc['_rev'] = '1'
+        self.docs[doc_id] = copy.deepcopy(dict(doc))
+        return doc
+
+    def _before_write(self):
+        before_write, self.before_write = self.before_write, None
+        if before_write:
+            before_write()
+
+    def __iter__(self):
+        for doc_id in sorted(self.docs):
+            doc = FakeDocument(self, doc_id)
+            doc.fetch()
+            yield doc
+
+
+class FakeDocument(dict):
+
+    def __init__(self, database, document_id):
+        dict.__init__(self, _id=document_id)
+        self.database = database
+
+    def fetch(self):
+        stored = self.database.docs.get(self['_id'])
+        if stored is None:
+            raise http_error(404)
+        self.clear()
+        self.update(copy.deepcopy(stored))
+
+    def save(self):
+        self.database._before_write()
+        stored = self.database.docs.get(self['_id'])
+        if stored is not None and stored['_rev'] != self.get('_rev'):
+            raise http_error(409)
+        self['_rev'] = str(int(self.get('_rev', 0)) + 1)
+        self.database.docs[self['_id']] = copy.deepcopy(dict(self))
+
+
+class FakeQuery(object):
+
+    def __init__(self, database, selector, fields=None):
+        self.database = database
+        self.selector = dict((key, value) for key, value in selector.items()
+                             if key != '_id')
+        self.fields = fields
+
+    def __call__(self):
+        docs = []
+        for doc in self.database.docs.values():
+            if all(doc.get(key) == value
+                   for key, value in self.selector.items()):
+                doc = copy.deepcopy(doc)
+                if self.fields:
+                    doc = dict((field, doc[field]) for field in self.fields
+                               if field in doc)
+                docs.append(doc)
+        return {'docs': docs}
+
+
+class FakeClient(object):
+
+    def __init__(self, database):
+        self.database = database
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def __getitem__(self, db_name):
+        return self.database
+
+
+@unittest.skipIf(cloudant_online_store is None, "cloudant is not installed")
+class CloudantOnlineStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDatabase([
+            {'_id': 'c1', 'type': 'customer', 'email': 'e@mail',
+             'first_name': 'first', 'last_name': 'last',
+             'shopping_cart': ['Mug: %s\n' % MUG]},
+            {'_id': 'c2', 'type': 'customer', 'email': 'new@mail',
+             'first_name': 'new', 'last_name': 'customer'}])
+        self.db.docs['cart:new@mail'] = {
+            '_id': 'cart:new@mail', '_rev': '1', 'type': 'cart',
+            'email': 'new@mail', 'shopping_cart': {}}
+        for name, fake in (('Document', FakeDocument), ('Query', FakeQuery)):
+            patcher = mock.patch.object(cloudant_online_store, name, fake)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.store = cloudant_online_store.CloudantOnlineStore(
+            FakeClient(self.db), 'store')
+
+    def test_cart_is_split_out_on_first_use(self):
+        self.assertEqual(
+            [{'product_id': '132254', 'name': 'Mug', 'url': MUG,
+              'quantity': 1}],
+            self.store.list_shopping_cart('e@mail'))
+
+        self.assertNotIn('shopping_cart', self.db.docs['c1'])
+        cart = self.db.docs['cart:e@mail']
+        self.assertEqual('cart', cart['type'])
+        self.assertEqual(['132254'], list(cart['shopping_cart']))
+        # Identity lookups never read the cart.
+        self.assertNotIn('shopping_cart',
+                         self.store.find_customer('e@mail'))
+
+    def test_split_raced_by_another_replica(self):
+        def other_replica():
+            # Splits the same customer between our fetch and create.
+            self.db.docs['cart:e@mail'] = {
+                '_id': 'cart:e@mail', '_rev': '1', 'type': 'cart',
+                'email': 'e@mail', 'shopping_cart': cart_items.from_items(
+                    [cart_items.new_item('1', 'Cap')])}
+            customer = dict(self.db.docs['c1'], _rev='2')
+            del customer['shopping_cart']
+            self.db.docs['c1'] = customer
+        self.db.before_write = other_replica
+
+        self.assertEqual(['1'], [item['product_id'] for item in
+                                 self.store.list_shopping_cart('e@mail')])
+        self.assertNotIn('shopping_cart', self.db.docs['c1'])
+        self.assertEqual('2', self.db.docs['c1']['_rev'])
+
+    def test_migrate_shopping_carts(self):
+        self.assertEqual(1, self.store.migrate_shopping_carts())
+        self.assertEqual(0, self.store.migrate_shopping_carts())
+
+        self.assertNotIn('shopping_cart', self.db.docs['c1'])
+        cart = self.db.docs['cart:e@mail']['shopping_cart']
+        self.assertEqual('Mug', cart['132254']['name'])
+
+    def test_add_customer_creates_cart_doc(self):
+        customer = watson_online_store.OnlineStoreCustomer(
+            email='x@mail', first_name='x', last_name='y',
+            shopping_cart=[cart_items.new_item('1', 'Cap')])
+
+        self.store.add_customer_obj(customer)
+
+        self.assertEqual([dict(cart_items.new_item('1', 'Cap'))],
+                         self.store.list_shopping_cart('x@mail'))
+        self.assertNotIn('shopping_cart', self.store.find_doc(
+            'customer', 'email', 'x@mail'))
+
+    def test_journal_entries_apply_once(self):
+        item = cart_items.new_item('1', 'Cap')
+
+        for _ in range(2):
+            self.assertEqual(1, self.store.add_to_shopping_cart(
+                'new@mail', item, 2, journal_entry=('j1', 1)))
+            self.assertEqual(1, self.store.delete_item_shopping_cart(
+                'new@mail', '1', 1, journal_entry=('j1', 2)))
+
+        self.assertEqual([item], self.store.list_shopping_cart('new@mail'))
+        self.assertEqual({'id': 'j1', 'seq': 2},
+                         self.db.docs['cart:new@mail']['journal'])
+
+    def test_archive_shopping_carts(self):
+        self.store.add_to_shopping_cart('new@mail',
+                                        cart_items.new_item('1', 'Cap'))
+        cart = self.db.docs['cart:new@mail']['shopping_cart']
+        cart['1']['added'] = 1000.0
+        self.store.add_to_shopping_cart('new@mail',
+                                        cart_items.new_item('2', 'Mug'))
+        added = self.db.docs['cart:new@mail']['shopping_cart']['2']['added']
+
+        self.assertEqual(1, self.store.archive_shopping_carts(
+            max_age=60, now=added + 1))
+
+        self.assertEqual(['2'], list(
+            self.db.docs['cart:new@mail']['shopping_cart']))
+        archive = self.db.docs[cloudant_online_store.cart_archive_doc_id(
+            'new@mail', added + 1)]
+        self.assertEqual('cart_archive', archive['type'])
+        self.assertEqual(['1'], list(archive['shopping_cart']))
+        self.assertEqual(0, self.store.archive_shopping_carts(
+            max_age=60, now=added + 1))
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from watsononlinestore.catalog import crawler
+from watsononlinestore.tests.http_fixture import FixtureServer
+
+
+class FakeStore(object):
+    """Product pages with ETags; can fail a page a few times."""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.failures = {}
+        self.send_etags = True
+
+    def etag(self, path):
+        return '"%s"' % hashlib.md5(self.pages[path]).hexdigest()
+
+    def __call__(self, request):
+        if self.failures.get(request.path):
+            self.failures[request.path] -= 1
+            return 503, {}, b'busy'
+        if request.path not in self.pages:
+            return 404, {}, b'not found'
+        headers = {'Content-Type': 'text/html'}
+        if self.send_etags:
+            etag = self.etag(request.path)
+            if request.headers.get('If-None-Match') == etag:
+                return 304, {}, b''
+            headers['ETag'] = etag
+        return 200, headers, self.pages[request.path]
+
+
+class CrawlerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = FakeStore(dict(
+            ('/p/%d' % i, (u'<html>product %d</html>' % i).encode('utf-8'))
+            for i in range(20)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def products(self, server, ids=range(20)):
+        return [{'product_id': str(i), 'url': '%s/p/%d' % (server.url, i),
+                 'title': 'Product %d' % i, 'category': 'mug/mugs'}
+                for i in ids]
+
+    def crawl(self, products, **kwargs):
+        kwargs.setdefault('workers', 4)
+        kwargs.setdefault('retry_delay', 0.01)
+        return crawler.Crawler(self.tmpdir, **kwargs).crawl(products)
+
+    def read(self, name):
+        with open(os.path.join(self.tmpdir, name), 'rb') as f:
+            return f.read()
+
+    def test_crawl_then_recrawl(self):
+        with FixtureServer(self.store) as server:
+            products = self.products(server)
+            counts = self.crawl(products)
+            self.assertEqual(20, counts[crawler.FETCHED])
+            self.assertEqual(b'<html>product 3</html>', self.read('3.html'))
+
+            manifest = json.loads(self.read(crawler.MANIFEST).decode())
+            self.assertEqual('3.html', manifest['3']['file'])
+            self.assertEqual('Product 3', manifest['3']['title'])
+            self.assertEqual(self.store.etag('/p/3'), manifest['3']['etag'])
+
+            # Second run: conditional requests; only the changed page is sent.
+            self.store.pages['/p/5'] = b'<html>new price</html>'
+            counts = self.crawl(products)
+            self.assertEqual(19, counts[crawler.NOT_MODIFIED])
+            self.assertEqual(1, counts[crawler.FETCHED])
+            self.assertEqual(b'<html>new price</html>', self.read('5.html'))
+            manifest = json.loads(self.read(crawler.MANIFEST).decode())
+            self.assertEqual(self.store.etag('/p/5'), manifest['5']['etag'])
+            self.assertTrue(all(r.headers.get('If-None-Match')
+                                for r in server.requests[20:]))
+
+    def test_unchanged_content_is_not_rewritten(self):
+        self.store.send_etags = False
+        with FixtureServer(self.store) as server:
+            products = self.products(server, ids=[1])
+            self.crawl(products)
+            os.utime(os.path.join(self.tmpdir, '1.html'), (0, 0))
+
+            counts = self.crawl(products)
+            self.assertEqual(1, counts[crawler.UNCHANGED])
+            self.assertEqual(
+                0, os.stat(os.path.join(self.tmpdir, '1.html')).st_mtime)
+        self.assertEqual(['1.html', crawler.MANIFEST],
+                         sorted(os.listdir(self.tmpdir)))
+
+    def test_manifest_is_saved_while_crawling(self):
+        saved = []
+
+        def store(request):
+            if request.path == '/p/19':
+                with open(os.path.join(self.tmpdir, crawler.MANIFEST)) as f:
+                    saved.append(sorted(json.load(f), key=int))
+            return self.store(request)
+
+        with FixtureServer(store) as server:
+            self.crawl(self.products(server), workers=1, save_every=5)
+
+        self.assertEqual([[str(i) for i in range(15)]], saved)
+        manifest = json.loads(self.read(crawler.MANIFEST).decode())
+        self.assertEqual(20, len(manifest))
+
+    def test_retries_then_gives_up(self):
+        self.store.failures = {'/p/1': 2, '/p/2': 5}
+        with FixtureServer(self.store) as server:
+            counts = self.crawl(self.products(server, ids=[1, 2, 3]),
+                                retries=2)
+
+        self.assertEqual({crawler.FETCHED: 2, crawler.FAILED: 1,
+                          crawler.NOT_MODIFIED: 0, crawler.UNCHANGED: 0},
+                         counts)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, '2.html')))
+
+    def test_missing_page_is_not_retried(self):
+        with FixtureServer(self.store) as server:
+            products = [{'product_id': 'x', 'url': server.url + '/p/nope'}]
+            counts = self.crawl(products, retries=3)
+            self.assertEqual(1, counts[crawler.FAILED])
+            self.assertEqual(1, len(server.requests))
+
+    def test_load_products(self):
+        path = os.path.join(os.path.dirname(__file__), '..', '..', '..',
+                            'data', 'ibm_store_products.json')
+        products = crawler.load_products(path)
+
+        self.assertEqual(15, len(products))
+        self.assertEqual('206347', products[0]['product_id'])
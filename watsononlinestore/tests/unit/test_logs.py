@@ -0,0 +1,106 @@
+import io
+import logging
+import unittest
+
+from watsononlinestore import logs
+from watsononlinestore.metrics import METRICS
+
+
+class Expensive(object):
+    """Counts how often it is formatted."""
+
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return 'x' * 50
+
+
+def record(category=None, level=logging.DEBUG):
+    rec = logging.LogRecord('test', level, __file__, 1, 'msg', (), None)
+    if category:
+        rec.category = category
+    return rec
+
+
+class PayloadTestCase(unittest.TestCase):
+
+    def test_truncates(self):
+        self.assertEqual('x' * 50, str(logs.Payload(Expensive())))
+        self.assertEqual('xxxxx... (45 more chars)',
+                         str(logs.Payload(Expensive(), limit=5)))
+
+    def test_not_formatted_when_disabled(self):
+        logger = logging.getLogger('watsononlinestore.test_logs')
+        logger.setLevel(logging.INFO)
+        value = Expensive()
+
+        logger.debug("payload %s", logs.Payload(value))
+
+        self.assertEqual(0, value.formatted)
+
+
+class SamplingFilterTestCase(unittest.TestCase):
+
+    def test_passes_a_fraction_per_category(self):
+        sampling = logs.SamplingFilter({'noisy': 0.25})
+
+        passed = [sampling.filter(record('noisy')) for _ in range(8)]
+
+        self.assertEqual(2, passed.count(True))
+        self.assertTrue(sampling.filter(record('other')))
+        self.assertTrue(sampling.filter(record()))
+        self.assertTrue(sampling.filter(record('noisy', logging.WARNING)))
+
+    def test_parse_rates(self):
+        self.assertEqual({'a': 0.1, 'b': 1.0},
+                         logs.parse_rates(' a=0.1, b=1 ,'))
+        self.assertEqual({}, logs.parse_rates(None))
+
+
+@unittest.skipIf(logs.QueueHandler is None, "needs QueueHandler")
+class ConfigureTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = logging.getLogger()
+        self.level = self.root.level
+        self.stream = io.StringIO()
+
+    def tearDown(self):
+        self.root.setLevel(self.level)
+        logs.Payload.default_limit = logs.DEFAULT_TRUNCATE
+
+    def test_writes_in_background(self):
+        async_logging = logs.configure(
+            level='DEBUG', sample_rates={'noisy': 0.5}, truncate=10,
+            stream=self.stream, environ={})
+        logger = logging.getLogger('watsononlinestore.test_logs')
+        logger.setLevel(logging.DEBUG)
+        try:
+            logger.debug("turn %s", logs.Payload('y' * 20),
+                         extra=logs.category('message'))
+            for i in range(4):
+                logger.debug("noisy %d", i, extra=logs.category('noisy'))
+        finally:
+            async_logging.stop()
+            logger.setLevel(logging.NOTSET)
+
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertIn('DEBUG watsononlinestore.test_logs [message] turn '
+                      'yyyyyyyyyy... (10 more chars)', lines[0])
+        self.assertTrue(lines[1].endswith('[noisy] noisy 1'))
+        self.assertNotIn(async_logging.queue_handler, self.root.handlers)
+
+    def test_full_queue_drops(self):
+        async_logging = logs.AsyncLogging(logging.NullHandler())
+        handler = logs.DroppingQueueHandler(logs.queue.Queue(1))
+        dropped = METRICS.snapshot()['counters'].get('log.dropped', 0)
+
+        handler.handle(record())
+        handler.handle(record())
+
+        self.assertEqual(dropped + 1,
+                         METRICS.snapshot()['counters']['log.dropped'])
+        self.assertIsNone(async_logging.listener)
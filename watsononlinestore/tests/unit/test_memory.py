@@ -0,0 +1,121 @@
+import sys
+import unittest
+
+import mock
+
+from watsononlinestore.admission import AdmissionController
+from watsononlinestore import memory
+from watsononlinestore import watson_online_store
+
+
+class DeepSizeTestCase(unittest.TestCase):
+
+    def test_counts_nested_objects_once(self):
+        shared = 'x' * 1000
+        value = {'a': [shared, shared], 'b': (shared,)}
+
+        size = memory.deep_size(value)
+
+        self.assertGreater(size, sys.getsizeof(shared))
+        self.assertLess(size, 2 * sys.getsizeof(shared))
+
+    def test_slots_and_attributes(self):
+        customer = watson_online_store.OnlineStoreCustomer(
+            email='x' * 1000, shopping_cart=['mug'])
+
+        self.assertGreater(memory.deep_size(customer), 1000)
+        self.assertGreater(memory.deep_size(mock.sentinel), 0)
+
+
+class SessionReportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        conversation = mock.Mock()
+        conversation.list_workspaces.return_value = {
+            'workspaces': [{'workspace_id': 'ws',
+                            'name': 'watson-online-store'}]}
+        self.wos = watson_online_store.WatsonOnlineStore(
+            'UBOTID', mock.Mock(), conversation, mock.Mock(), mock.Mock())
+
+    def test_sessions_by_subsystem(self):
+        small = self.wos.session_for('USMALL')
+        small.context = {'a': 'b'}
+        big = self.wos.session_for('UBIG')
+        big.context = {'discovery_result': 'y' * 5000}
+        big.response_tuple = [{'name': 'z' * 3000}]
+
+        report = memory.session_report(self.wos, top=1)
+
+        self.assertEqual(2, report['sessions'])
+        self.assertEqual(['UBIG'], [row['user'] for row in report['top']])
+        top = report['top'][0]
+        self.assertGreater(top['context'], 5000)
+        self.assertGreater(top['cached_results'], 3000)
+        self.assertEqual(top['bytes'], top['context'] + top['customer'] +
+                         top['cached_results'])
+        self.assertGreater(report['bytes']['context'], top['context'])
+        self.assertEqual(0, report['bytes']['admission'])
+        self.assertEqual(0, report['bytes']['slack_outbox'])
+
+    def test_admission_buffer(self):
+        self.wos.admission = AdmissionController(self.wos)
+        self.wos.admission.offer([{'type': 'message', 'channel': 'D1',
+                                   'user': 'U1', 'text': 'w' * 2000}])
+
+        report = memory.report(self.wos)
+
+        self.assertGreater(report['sessions']['bytes']['admission'], 2000)
+        self.assertIsNone(report['tracemalloc'])
+
+    def test_top_from(self):
+        self.assertEqual(memory.DEFAULT_TOP, memory.top_from({}))
+        self.assertEqual(3, memory.top_from({'QUERY_STRING': 'top=3'}))
+        self.assertRaises(ValueError, memory.top_from,
+                          {'QUERY_STRING': 'top=many'})
+
+
+@unittest.skipIf(memory.tracemalloc is None, "needs tracemalloc")
+class MemoryTrackerTestCase(unittest.TestCase):
+
+    def test_report(self):
+        wos = mock.Mock(sessions={})
+        tracker = memory.MemoryTracker(wos, interval=60)
+        tracker.start()
+        try:
+            retained = [str(i) * 100 for i in range(1000)]
+            tracker.sample()
+            report = tracker.report(top=3)
+        finally:
+            tracker.stop()
+
+        self.assertFalse(memory.tracemalloc.is_tracing())
+        self.assertGreater(report['traced'], 100000)
+        self.assertEqual(3, len(report['grown_since_start']))
+        self.assertIn('test_memory.py', report['grown_since_start'][0][
+            'where'])
+        self.assertGreater(report['growth']['bytes'], 100000)
+        self.assertIsNone(report['growth']['traced_per_session'])
+        self.assertEqual(2, len(report['history']))
+        del retained
+
+    def test_trackers_share_tracing(self):
+        first = memory.MemoryTracker(mock.Mock(sessions={}), interval=60)
+        second = memory.MemoryTracker(mock.Mock(sessions={}), interval=60)
+        first.start()
+        try:
+            second.start()
+            second.stop()
+            self.assertTrue(memory.tracemalloc.is_tracing())
+        finally:
+            first.stop()
+        self.assertFalse(memory.tracemalloc.is_tracing())
+
+    def test_growth(self):
+        tracker = memory.MemoryTracker(mock.Mock(sessions={}))
+        self.assertIsNone(tracker.growth())
+        tracker.history.extend([
+            {'time': 0, 'traced': 1000, 'sessions': 1},
+            {'time': 1800, 'traced': 3000, 'sessions': 10}])
+
+        self.assertEqual({'bytes': 2000, 'bytes_per_hour': 4000.0,
+                          'traced_per_session': 300.0}, tracker.growth())
@@ -0,0 +1,66 @@
+import unittest
+
+from watsononlinestore import metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_snapshot(self):
+        registry = metrics.Metrics()
+
+        registry.incr('shed')
+        registry.incr('shed', 2)
+        registry.set_gauge('depth', 7)
+        for seconds in range(1, 101):
+            registry.observe('turn_seconds', seconds / 100.0)
+        with registry.timer('timed'):
+            pass
+
+        snapshot = registry.snapshot()
+        self.assertEqual({'shed': 3}, snapshot['counters'])
+        self.assertEqual({'depth': 7}, snapshot['gauges'])
+        turn = snapshot['timings']['turn_seconds']
+        self.assertEqual(100, turn['count'])
+        self.assertAlmostEqual(0.96, turn['p95'])
+        self.assertAlmostEqual(1.0, turn['max'])
+        self.assertEqual(1, snapshot['timings']['timed']['count'])
+
+    def test_scope(self):
+        registry = metrics.Metrics()
+
+        with metrics.scope('acme'):
+            registry.incr('turns')
+            registry.set_gauge('depth', 2)
+            registry.observe('turn_seconds', 0.5)
+        registry.incr('turns')
+        with metrics.scope(None):
+            registry.incr('turns')
+
+        snapshot = registry.snapshot()
+        self.assertEqual({'turns': 3, 'tenant.acme.turns': 1},
+                         snapshot['counters'])
+        self.assertEqual({'depth': 2, 'tenant.acme.depth': 2},
+                         snapshot['gauges'])
+        self.assertEqual(1, snapshot['timings'][
+            'tenant.acme.turn_seconds']['count'])
+
+    def test_merge_snapshots(self):
+        first, second = metrics.Metrics(), metrics.Metrics()
+        first.incr('turns', 2)
+        second.incr('turns', 3)
+        second.incr('shed')
+        first.set_gauge('depth', 1)
+        second.set_gauge('depth', 4)
+        first.observe('turn_seconds', 1.0)
+        second.observe('turn_seconds', 2.0)
+        second.observe('turn_seconds', 3.0)
+
+        merged = metrics.merge_snapshots([first.snapshot(),
+                                          second.snapshot()])
+
+        self.assertEqual({'turns': 5, 'shed': 1}, merged['counters'])
+        self.assertEqual({'depth': 5}, merged['gauges'])
+        turn = merged['timings']['turn_seconds']
+        self.assertEqual(3, turn['count'])
+        self.assertAlmostEqual(2.0, turn['mean'])
+        self.assertAlmostEqual(3.0, turn['max'])
@@ -0,0 +1,102 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from watsononlinestore.catalog import crawler
+from watsononlinestore.catalog import preprocess
+
+HTML_DIR = os.path.join(os.path.dirname(__file__), '..', '..', '..',
+                        'data', 'ibm_store_html')
+
+PAGE = u"""<html><head><script>var x = "<td>";</script><title>
+\tIBM Logostore
+Product:Test Mug
+Category:mug/mugs
+
+</title></head><body>
+<form action="./ProductDetail.aspx?pid=123456">
+<a href="https://img.example/lf?set=scale[2300]" class="jqzoom">x</a>
+<table><tr><td class="ProductDetailText" colspan="2"><b>Great</b><br>mug &amp;
+<table><tr><td>inner</td></tr></table> handle</td>
+<td class="ProductDetailText">not the description</td></tr></table>
+<div class="Upselltabs"><a href="ProductDetail.aspx?pid=999999">Other</a>
+</div></form></body></html>"""
+
+
+class PreprocessTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pages = os.path.join(self.tmpdir, 'pages')
+        self.out = os.path.join(self.tmpdir, 'docs')
+        os.mkdir(self.pages)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_page(self, name, html=PAGE):
+        path = os.path.join(self.pages, name)
+        with open(path, 'w') as f:
+            f.write(html)
+        return path
+
+    def test_extract(self):
+        path = self.write_page('1.html')
+        # Feed the page in small chunks to exercise the streaming parser.
+        preprocess.CHUNK_SIZE, chunk_size = 7, preprocess.CHUNK_SIZE
+        try:
+            document = preprocess.extract(path)
+        finally:
+            preprocess.CHUNK_SIZE = chunk_size
+
+        self.assertEqual(
+            {'product_id': '123456',
+             'title': 'Test Mug',
+             'category': 'mug/mugs',
+             'url': preprocess.PRODUCT_URL + '123456',
+             'image_url': 'https://img.example/lf?set=scale[2300]',
+             'text': 'Great\nmug & inner handle'}, document)
+
+    def test_extract_store_page(self):
+        path = os.path.join(HTML_DIR, '1.html')
+        document = preprocess.extract(path)
+
+        self.assertEqual('206347', document['product_id'])
+        self.assertEqual('Applique Crew Sweatshirt', document['title'])
+        self.assertEqual('shirt/shirts/sweatshirts', document['category'])
+        self.assertIn('dark grey sweatshirt', document['text'])
+        self.assertLess(len(json.dumps(document)),
+                        os.path.getsize(path) / 10)
+
+    def test_preprocess(self):
+        self.write_page('1.html')
+        self.write_page('2.html')  # duplicate
+        self.write_page('3.html', PAGE.replace('123456', '654321')
+                        .replace('Test Mug', 'Other Mug'))
+        self.write_page('4.html', u'<html>no product here</html>')
+        jobs = preprocess.find_pages(self.pages)
+
+        counts = preprocess.preprocess(jobs, self.out, processes=2)
+        self.assertEqual({preprocess.WRITTEN: 2, preprocess.UNCHANGED: 0,
+                          preprocess.DUPLICATE: 1, preprocess.FAILED: 1},
+                         counts)
+        self.assertEqual(['123456.json', '654321.json'],
+                         sorted(os.listdir(self.out)))
+
+        counts = preprocess.preprocess(jobs, self.out, processes=2)
+        self.assertEqual(2, counts[preprocess.UNCHANGED])
+
+    def test_find_pages_uses_crawler_manifest(self):
+        self.write_page('123456.html', PAGE.replace('Product:Test Mug', ''))
+        manifest = {'123456': {'file': '123456.html', 'title': 'From Crawl',
+                               'url': 'http://store/p/123456'}}
+        with open(os.path.join(self.pages, crawler.MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+
+        [(path, metadata)] = preprocess.find_pages(self.pages)
+        document = preprocess.extract(path, metadata)
+        self.assertEqual('From Crawl', document['title'])
+        self.assertEqual('http://store/p/123456', document['url'])
+        self.assertEqual('mug/mugs', document['category'])
@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from watsononlinestore import profiling
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+class SamplingProfilerTestCase(unittest.TestCase):
+
+    def test_samples_other_threads(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=busy_loop, args=(stop,),
+                                  name='busy')
+        thread.start()
+        sampler = profiling.SamplingProfiler(interval=0.001)
+        sampler.start()
+        time.sleep(0.05)
+        stacks = sampler.stop()
+        stop.set()
+        thread.join()
+
+        self.assertFalse(sampler.running)
+        self.assertGreater(sampler.samples, 0)
+        busy = [s for s in stacks if s.startswith('busy;')]
+        self.assertTrue(busy)
+        self.assertTrue(all('test_profiling.py:busy_loop' in s
+                            for s in busy))
+        self.assertFalse([s for s in stacks if s.startswith('profiler;')])
+
+    def test_fold(self):
+        def inner():
+            import sys
+            return profiling.fold(sys._getframe(), 'main')
+
+        stack = inner().split(';')
+        self.assertEqual('main', stack[0])
+        self.assertEqual(['test_profiling.py:test_fold',
+                          'test_profiling.py:inner'], stack[-2:])
+
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_on_demand(self):
+        profiler = profiling.Profiler(self.directory, interval=0.001)
+
+        self.assertTrue(profiler.control('start')['running'])
+        time.sleep(0.02)
+        status = profiler.toggle()
+
+        self.assertFalse(status['running'])
+        self.assertEqual(os.getpid(), status['pid'])
+        with open(status['last_path']) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertGreater(int(count), 0)
+        self.assertRaises(ValueError, profiler.control, 'restart')
+
+    def test_slow_messages(self):
+        profiler = profiling.Profiler(self.directory, interval=0.001,
+                                      slow_message=0.02)
+
+        with profiler.message('UFAST'):
+            pass
+        with profiler.message('USLOW'):
+            time.sleep(0.03)
+
+        written = os.listdir(self.directory)
+        self.assertEqual(1, len(written))
+        self.assertTrue(written[0].startswith('message-'))
+        self.assertTrue(written[0].endswith('-USLOW.folded'))
+
+    def test_messages_not_profiled_without_threshold(self):
+        profiler = profiling.Profiler(self.directory)
+        with profiler.message('U1'):
+            self.assertNotIn('profiler',
+                             [t.name for t in threading.enumerate()])
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_action_from(self):
+        self.assertEqual('status', profiling.action_from({}))
+        self.assertEqual('stop', profiling.action_from(
+            {'QUERY_STRING': 'action=stop'}))
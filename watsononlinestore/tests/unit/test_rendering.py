@@ -0,0 +1,87 @@
+import unittest
+
+import mock
+
+from watsononlinestore.database import cart_items
+from watsononlinestore import rendering
+
+
+class RenderingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.renderer = rendering.Renderer()
+
+    def test_slack_decode(self):
+        text = 'R&D <cap> &amp; more'
+
+        self.assertEqual('R&amp;D &lt;cap&gt; &amp;amp; more',
+                         rendering.slack_encode(text))
+        self.assertEqual(text, rendering.slack_decode(
+            rendering.slack_encode(text)))
+
+    def test_card_is_made_once_per_source(self):
+        make = mock.Mock(side_effect=[{'name': 'Mug'}, {'name': 'Mug 2'}])
+
+        first = self.renderer.card('1', ('Mug',), make)
+        again = self.renderer.card('1', ('Mug',), make)
+        changed = self.renderer.card('1', ('Mug 2',), make)
+
+        self.assertIs(first, again)
+        self.assertEqual({'name': 'Mug 2'}, changed)
+        self.assertEqual(2, make.call_count)
+
+    def test_cards_are_bounded(self):
+        renderer = rendering.Renderer(max_cards=2)
+        for key in ('1', '2', '1', '3'):
+            renderer.card(key, (), dict)
+
+        self.assertEqual(['1', '3'], list(renderer.cards))
+
+    def test_cart_listing(self):
+        cart = [cart_items.new_item('1', 'Mug', 'http://m', 2),
+                cart_items.new_item('2', 'Cap', 'http://c')]
+
+        self.assertEqual("1) Mug (x2): http://m\n2) Cap: http://c\n",
+                         self.renderer.cart_listing('e@mail', cart))
+
+        cart.append(cart_items.new_item('3', 'Pen', 'http://p'))
+        with mock.patch.object(rendering, 'cart_line',
+                               wraps=rendering.cart_line) as cart_line:
+            listing = self.renderer.cart_listing('e@mail', cart)
+            self.assertEqual("1) Mug (x2): http://m\n2) Cap: http://c\n"
+                             "3) Pen: http://p\n", listing)
+            self.assertEqual(1, cart_line.call_count)
+
+            self.renderer.cart_listing('e@mail', list(cart))
+            self.assertEqual(1, cart_line.call_count)
+
+        del cart[0]
+        self.assertEqual("1) Cap: http://c\n2) Pen: http://p\n",
+                         self.renderer.cart_listing('e@mail', cart))
+        cart[1]['quantity'] = 3
+        self.assertEqual("1) Cap: http://c\n2) Pen (x3): http://p\n",
+                         self.renderer.cart_listing('e@mail', cart))
+        self.assertEqual("", self.renderer.cart_listing('e@mail', []))
+
+    def test_result_attachments(self):
+        entries = [
+            {'cart_number': '1', 'product_id': '1', 'name': 'R&amp;D Mug',
+             'url': 'http://m', 'image': 'http://i?a=1&amp;b=2'},
+            {'cart_number': '2', 'product_id': '2', 'name': 'Cap',
+             'url': '', 'image': ''}]
+
+        attachments = rendering.result_attachments(entries)
+
+        self.assertEqual(
+            [{'fallback': '1) R&amp;D Mug\nhttp://i?a=1&amp;b=2\n2) Cap',
+              'blocks': [
+                  {'type': 'section',
+                   'text': {'type': 'mrkdwn',
+                            'text': '*1)* <http://m|R&amp;D Mug>'},
+                   'accessory': {'type': 'image',
+                                 'image_url': 'http://i?a=1&b=2',
+                                 'alt_text': 'R&D Mug'}},
+                  {'type': 'section',
+                   'text': {'type': 'mrkdwn', 'text': '*2)* Cap'}}]}],
+            attachments)
+        self.assertIsNone(rendering.result_attachments([]))
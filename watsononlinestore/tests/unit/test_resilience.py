@@ -0,0 +1,140 @@
+import threading
+import time
+import unittest
+
+import mock
+
+from watsononlinestore.metrics import METRICS
+from watsononlinestore import resilience
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = resilience.CircuitBreaker(
+            'test', failure_threshold=2, reset_timeout=10, slow_call=1.0,
+            clock=self.clock)
+
+    def test_opens_after_failures(self):
+        self.breaker.record(False)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(False)
+
+        self.assertEqual(resilience.OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.allow())
+
+    def test_slow_calls_count_as_failures(self):
+        self.breaker.record(True, 2.0)
+        self.breaker.record(True, 2.0)
+
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_resets_failures(self):
+        self.breaker.record(False)
+        self.breaker.record(True, 0.1)
+        self.breaker.record(False)
+
+        self.assertTrue(self.breaker.allow())
+
+    def test_half_open_trial(self):
+        self.breaker.record(False)
+        self.breaker.record(False)
+        self.clock.now += 10
+
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(resilience.HALF_OPEN, self.breaker.state)
+        # Only one trial call at a time.
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.record(False)
+        self.assertEqual(resilience.OPEN, self.breaker.state)
+        self.clock.now += 10
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(True, 0.1)
+        self.assertEqual(resilience.CLOSED, self.breaker.state)
+
+
+class ResilientCallerTestCase(unittest.TestCase):
+
+    def make_caller(self, name, **kwargs):
+        kwargs.setdefault('timeout', 0.2)
+        kwargs.setdefault('min_timeout', 0.05)
+        return resilience.ResilientCaller(name, **kwargs)
+
+    def test_returns_result(self):
+        func = mock.Mock(return_value='ok')
+        caller = self.make_caller('rc.ok')
+
+        self.assertEqual('ok', caller.call(func, a=1))
+        func.assert_called_once_with(a=1)
+
+    def test_retries_quick_failure(self):
+        func = mock.Mock(side_effect=[ValueError('boom'), 'ok'])
+        caller = self.make_caller('rc.retry')
+
+        self.assertEqual('ok', caller.call(func))
+        self.assertEqual(2, func.call_count)
+
+    def test_failure_raises_without_fallback(self):
+        func = mock.Mock(side_effect=ValueError('boom'))
+        caller = self.make_caller('rc.fail')
+
+        self.assertRaises(resilience.ServiceUnavailable, caller.call, func)
+        self.assertEqual(2, func.call_count)
+
+    def test_deadline_uses_fallback(self):
+        release = threading.Event()
+        caller = self.make_caller(
+            'rc.slow', hedge=False,
+            fallback=lambda **kwargs: ('fallback', kwargs))
+
+        started = time.time()
+        result = caller.call(lambda x: release.wait(5), x=1)
+        release.set()
+
+        self.assertEqual(('fallback', {'x': 1}), result)
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(1, METRICS.snapshot()['counters']['rc.slow.timeouts'])
+
+    def test_budget_limits_timeout(self):
+        release = threading.Event()
+        caller = self.make_caller('rc.budget', timeout=5, hedge=False)
+        budget = resilience.LatencyBudget(0.1)
+
+        started = time.time()
+        self.assertRaises(resilience.DeadlineExceeded, caller.call,
+                          lambda: release.wait(5), budget)
+        release.set()
+        self.assertLess(time.time() - started, 1)
+
+    def test_hedges_after_p95(self):
+        for _ in range(resilience.MIN_HEDGE_SAMPLES):
+            METRICS.observe('rc.hedge.seconds', 0.01)
+        release = threading.Event()
+        results = iter([lambda: release.wait(5) and 'slow',
+                        lambda: 'fast'])
+        caller = self.make_caller('rc.hedge', timeout=2)
+
+        self.assertEqual('fast', caller.call(lambda: next(results)()))
+        release.set()
+        self.assertEqual(1, METRICS.snapshot()['counters']['rc.hedge.hedged'])
+
+    def test_open_breaker_short_circuits(self):
+        func = mock.Mock(return_value='ok')
+        breaker = resilience.CircuitBreaker('rc.open', failure_threshold=1)
+        breaker.record(False)
+        caller = self.make_caller('rc.open', breaker=breaker,
+                                  fallback=lambda: 'fallback')
+
+        self.assertEqual('fallback', caller.call(func))
+        func.assert_not_called()
@@ -0,0 +1,166 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from watsononlinestore.metrics import METRICS
+from watsononlinestore import runtime_config
+from watsononlinestore import watson_online_store
+
+WORKSPACE = {
+    'language': 'en',
+    'intents': [{'intent': 'hello', 'examples': [{'text': 'hi'}]},
+                {'intent': 'bye', 'examples': [{'text': 'bye'}]}],
+    'entities': [],
+    'dialog_nodes': [{'dialog_node': 'root', 'output': {'text': 'Hi'}}],
+    'counterexamples': [],
+    'metadata': None,
+}
+
+
+class DiffWorkspaceTestCase(unittest.TestCase):
+
+    def test_no_changes(self):
+        self.assertEqual({}, runtime_config.diff_workspace(WORKSPACE,
+                                                           WORKSPACE))
+
+    def test_changes(self):
+        new = dict(WORKSPACE, language='fr', intents=[
+            {'intent': 'hello', 'examples': [{'text': 'hey'}]},
+            {'intent': 'thanks', 'examples': []}])
+
+        self.assertEqual(
+            {'language': 'changed',
+             'intents': {'added': 1, 'removed': 1, 'changed': 1}},
+            runtime_config.diff_workspace(WORKSPACE, new))
+
+
+class ParseConfigTestCase(unittest.TestCase):
+
+    def test_parse(self):
+        base = runtime_config.RuntimeConfig(workspace_id='ws')
+        config = runtime_config.parse_config(
+            '{"discovery_score_filter": "0.2"}', base)
+
+        self.assertEqual({'workspace_id': 'ws',
+                          'discovery_score_filter': 0.2,
+                          'latency_budget': 15.0}, config.as_dict())
+        self.assertEqual(0.0, base.discovery_score_filter)
+
+    def test_invalid(self):
+        base = runtime_config.RuntimeConfig()
+        for text in ('[]', '{"nope": 1}', '{"latency_budget": "x"}'):
+            self.assertRaises(ValueError, runtime_config.parse_config,
+                              text, base)
+
+
+class ConfigWatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.workspace_path = os.path.join(self.tmpdir, 'workspace.json')
+        self.config_path = os.path.join(self.tmpdir, 'config.json')
+        self.write(self.workspace_path, WORKSPACE)
+
+        self.conv_client = mock.Mock()
+        self.conv_client.list_workspaces.return_value = {
+            'workspaces': [{'workspace_id': 'ws',
+                            'name': 'watson-online-store'}]}
+        self.wos = watson_online_store.WatsonOnlineStore(
+            'UBOTID', mock.Mock(), self.conv_client, None, mock.Mock())
+        self.watcher = runtime_config.ConfigWatcher(
+            self.wos, self.workspace_path, self.config_path, interval=60)
+        self.watcher.start()
+
+    def tearDown(self):
+        self.watcher.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, data, text=None):
+        with open(path, 'w') as f:
+            f.write(text if text is not None else json.dumps(data))
+        # Make the change visible even within the mtime resolution.
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 1))
+
+    def workspaces(self, *statuses):
+        """get_workspace reports ws as live and ws2 with statuses."""
+        statuses = list(statuses)
+
+        def get_workspace(workspace_id):
+            if workspace_id == 'ws':
+                return {'name': 'watson-online-store', 'description': 'd',
+                        'status': runtime_config.AVAILABLE}
+            return {'name': 'watson-online-store', 'status': statuses.pop(0)}
+        self.conv_client.get_workspace.side_effect = get_workspace
+        self.conv_client.create_workspace.return_value = {
+            'workspace_id': 'ws2'}
+
+    @mock.patch.object(runtime_config, 'TRAINING_POLL_INTERVAL', 0.01)
+    def test_workspace_changes_swap_in_a_trained_workspace(self):
+        self.assertFalse(self.watcher.check())
+
+        self.workspaces('Training', 'Training', runtime_config.AVAILABLE)
+        self.watcher.drain_seconds = 0
+        nodes = WORKSPACE['dialog_nodes'] + [{'dialog_node': 'new'}]
+        self.write(self.workspace_path, dict(WORKSPACE, dialog_nodes=nodes))
+        reloads = METRICS.snapshot()['counters'].get('config.reloads', 0)
+
+        self.assertTrue(self.watcher.check())
+        self.conv_client.update_workspace.assert_not_called()
+        self.conv_client.create_workspace.assert_called_once_with(
+            'watson-online-store', 'd', 'en', intents=WORKSPACE['intents'],
+            entities=[], dialog_nodes=nodes, counterexamples=[],
+            metadata=None)
+        self.assertEqual(4, self.conv_client.get_workspace.call_count)
+        self.assertEqual('ws2', self.wos.workspace_id)
+        self.assertEqual(reloads + 1,
+                         METRICS.snapshot()['counters']['config.reloads'])
+        self.assertIn('config.reload_seconds',
+                      METRICS.snapshot()['timings'])
+
+        # The old workspace goes once its drain period is over.
+        self.conv_client.delete_workspace.assert_not_called()
+        self.assertFalse(self.watcher.check())
+        self.conv_client.delete_workspace.assert_called_once_with('ws')
+
+        # A config file without workspace_id keeps the new workspace.
+        self.write(self.config_path, {'discovery_score_filter': 0.3})
+        self.watcher.check()
+        self.assertEqual('ws2', self.wos.workspace_id)
+
+    @mock.patch.object(runtime_config, 'TRAINING_POLL_INTERVAL', 0.01)
+    def test_workspace_that_fails_to_train_is_dropped(self):
+        self.workspaces('Training', runtime_config.FAILED)
+        self.write(self.workspace_path, dict(WORKSPACE, language='fr'))
+
+        self.assertFalse(self.watcher.check())
+        self.assertEqual('ws', self.wos.workspace_id)
+        self.conv_client.delete_workspace.assert_called_once_with('ws2')
+        self.assertEqual([], self.watcher.retired)
+
+    def test_config_swap_waits_for_turn(self):
+        self.write(self.config_path, {'workspace_id': 'ws2',
+                                      'discovery_score_filter': 0.3})
+        self.wos.pinned_config = self.wos.config
+
+        self.assertTrue(self.watcher.check())
+        # The turn in progress still sees the config it started with.
+        self.assertEqual('ws', self.wos.workspace_id)
+        self.wos.pinned_config = None
+        self.assertEqual('ws2', self.wos.workspace_id)
+        self.assertEqual(0.3, self.wos.discovery_score_filter)
+
+        # Removing a setting reverts it to the startup value.
+        self.write(self.config_path, {'workspace_id': 'ws2'})
+        self.watcher.check()
+        self.assertEqual(0.0, self.wos.discovery_score_filter)
+
+    def test_bad_config_keeps_current(self):
+        self.write(self.config_path, None, text='{not json')
+
+        self.assertFalse(self.watcher.check())
+        self.assertEqual('ws', self.wos.workspace_id)
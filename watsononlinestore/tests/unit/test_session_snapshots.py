@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from watsononlinestore.database import session_snapshots
+from watsononlinestore import watson_online_store
+
+
+class SessionSnapshotsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmpdir, 'sessions.db')
+        self.snapshots = self.make_snapshots()
+
+    def tearDown(self):
+        self.snapshots.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def make_snapshots(self, **kwargs):
+        snapshots = session_snapshots.SessionSnapshots(self.db_path,
+                                                       **kwargs)
+        snapshots.init()
+        return snapshots
+
+    def test_put_flush_load(self):
+        data = {'user_id': 'U1', 'context': {'a': 1}}
+        self.snapshots.put('U1', data)
+        data['context']['a'] = 2
+
+        # Pending snapshots are visible before they are written.
+        self.assertEqual({'a': 1}, self.snapshots.load('U1')['context'])
+        self.assertEqual(1, self.snapshots.flush())
+        self.assertEqual(0, self.snapshots.flush())
+        self.snapshots.stop()
+
+        reopened = self.make_snapshots()
+        self.assertEqual({'a': 1}, reopened.load('U1')['context'])
+        self.assertIsNone(reopened.load('U2'))
+        reopened.stop()
+
+    def test_only_latest_snapshot_is_written(self):
+        for i in range(3):
+            self.snapshots.put('U1', {'n': i})
+
+        self.assertEqual(1, self.snapshots.flush())
+        self.assertEqual({'n': 2}, self.snapshots.load('U1'))
+
+    def test_stop_writes_pending(self):
+        self.snapshots.start()
+        self.snapshots.put('U1', {'n': 1})
+        self.snapshots.stop()
+
+        reopened = self.make_snapshots()
+        self.assertEqual({'n': 1}, reopened.load('U1'))
+        reopened.stop()
+
+    def test_old_sessions_expire(self):
+        self.snapshots.put('U1', {'n': 1})
+        with mock.patch.object(session_snapshots.time, 'time',
+                               return_value=time.time() - 100):
+            self.snapshots.flush()
+        self.snapshots.stop()
+
+        reopened = self.make_snapshots(max_age=10)
+        self.assertIsNone(reopened.load('U1'))
+        reopened.stop()
+
+
+class WarmRestartTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmpdir, 'sessions.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_bot(self):
+        conv_client = mock.Mock()
+        conv_client.list_workspaces.return_value = {
+            'workspaces': [{'workspace_id': 'ws',
+                            'name': 'watson-online-store'}]}
+        conv_client.message.side_effect = lambda **kw: {
+            'context': dict(kw['context'], turns=kw['context'].get(
+                'turns', 0) + 1),
+            'output': {'text': ['ok']}}
+        bot = watson_online_store.WatsonOnlineStore(
+            'UBOTID', mock.Mock(), conv_client, None, mock.Mock())
+        bot.session_snapshots = session_snapshots.SessionSnapshots(
+            self.db_path)
+        bot.init_customer = mock.Mock(side_effect=self.identify(bot))
+        bot.start_services()
+        return bot
+
+    @staticmethod
+    def identify(bot):
+        def init_customer(user_id):
+            bot.customer = watson_online_store.OnlineStoreCustomer(
+                email='e@mail', first_name='f', last_name='l',
+                shopping_cart=[])
+        return init_customer
+
+    def message(self, bot):
+        bot.process_slack_output([{'type': 'message', 'channel': 'D1',
+                                   'user': 'U1', 'text': 'hi'}])
+
+    def test_session_survives_restart(self):
+        bot = self.make_bot()
+        self.message(bot)
+        self.message(bot)
+        bot.stop_services()
+
+        restarted = self.make_bot()
+        self.assertEqual({}, restarted.sessions)
+        self.message(restarted)
+        restarted.stop_services()
+
+        session = restarted.sessions['U1']
+        self.assertEqual(3, session.context['turns'])
+        self.assertEqual('e@mail', session.customer.email)
+        # The customer came from the snapshot, not from Slack and the DB.
+        restarted.init_customer.assert_not_called()
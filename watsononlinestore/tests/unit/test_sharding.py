@@ -0,0 +1,346 @@
+import functools
+import multiprocessing
+import os
+import time
+import unittest
+
+import mock
+
+from watsononlinestore import admission
+from watsononlinestore.metrics import METRICS
+from watsononlinestore import sharding
+from watsononlinestore import tenants
+from watsononlinestore import watson_online_store
+
+
+class FakeWos(object):
+    """Counts messages per user, so tests can see whether sessions moved."""
+
+    def __init__(self, results, index=None):
+        self.results = results
+        self.index = index
+        self.sessions = {}
+
+    def start_services(self):
+        pass
+
+    def stop_services(self):
+        pass
+
+    def process_slack_output(self, events):
+        for event in events:
+            user = event['user']
+            METRICS.incr('fake.messages')
+            self.sessions[user] = self.sessions.get(user, 0) + 1
+            self.results.put((user, os.getpid(), self.sessions[user]))
+
+    def export_sessions(self, user_ids):
+        return [(user, self.sessions.pop(user)) for user in user_ids
+                if user in self.sessions]
+
+    def import_sessions(self, exported):
+        self.sessions.update(exported)
+
+
+class SlowExportFakeWos(FakeWos):
+    """FakeWos that takes too long to hand its sessions over."""
+
+    def export_sessions(self, user_ids):
+        time.sleep(1)
+        return FakeWos.export_sessions(self, user_ids)
+
+
+class AdmittingFakeWos(FakeWos):
+    """FakeWos whose messages wait in admission, like the bot's default."""
+
+    def __init__(self, results, debounce, index=None):
+        FakeWos.__init__(self, results, index)
+        self.admission = admission.AdmissionController(self,
+                                                       debounce=debounce)
+
+    def start_services(self):
+        self.admission.start()
+
+    def stop_services(self):
+        self.admission.stop(5)
+
+    def parse_slack_output(self, events):
+        return events[0]['text'], 'D1', events[0]['user']
+
+    def post_to_slack(self, message, channel):
+        pass
+
+    def process_slack_output(self, events):
+        self.admission.offer(events)
+
+    def handle_slack_output(self, events):
+        FakeWos.process_slack_output(self, events)
+
+
+class HashRingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = ['U%05d' % i for i in range(2000)]
+
+    def test_spread(self):
+        ring = sharding.HashRing(['a', 'b', 'c', 'd'])
+        counts = {}
+        for key in self.keys:
+            node = ring.node_for(key)
+            counts[node] = counts.get(node, 0) + 1
+
+        self.assertEqual(['a', 'b', 'c', 'd'], sorted(counts))
+        for count in counts.values():
+            self.assertGreater(count, 300)
+
+    def test_add_moves_keys_only_to_new_node(self):
+        ring = sharding.HashRing(['a', 'b', 'c'])
+        before = dict((key, ring.node_for(key)) for key in self.keys)
+        ring.add('d')
+
+        moved = [key for key in self.keys if ring.node_for(key) != before[key]]
+        self.assertTrue(moved)
+        self.assertLess(len(moved), len(self.keys) / 2)
+        for key in moved:
+            self.assertEqual('d', ring.node_for(key))
+
+    def test_remove_moves_only_its_keys(self):
+        ring = sharding.HashRing(['a', 'b', 'c'])
+        before = dict((key, ring.node_for(key)) for key in self.keys)
+        ring.remove('b')
+
+        self.assertEqual(['a', 'c'], ring.nodes)
+        for key in self.keys:
+            if before[key] != 'b':
+                self.assertEqual(before[key], ring.node_for(key))
+
+    def test_empty(self):
+        self.assertIsNone(sharding.HashRing().node_for('U1'))
+
+
+class ShardEnvironTestCase(unittest.TestCase):
+
+    def test_files_are_named_for_the_worker(self):
+        environ = {'CART_JOURNAL_PATH': '/var/wos/carts.journal',
+                   'SESSION_SNAPSHOT_PATH': 'sessions',
+                   'STORE_CACHE': 'true', 'SLACK_BOT_TOKEN': 'xoxb'}
+
+        shard = sharding.shard_environ(environ, 2)
+
+        self.assertEqual('/var/wos/carts.2.journal',
+                         shard['CART_JOURNAL_PATH'])
+        self.assertEqual('sessions.2', shard['SESSION_SNAPSHOT_PATH'])
+        self.assertEqual('changes_checkpoint.2.json',
+                         shard['CHANGES_CHECKPOINT_PATH'])
+        self.assertEqual('xoxb', shard['SLACK_BOT_TOKEN'])
+        self.assertNotIn('CHANGES_CHECKPOINT_PATH', environ)
+        tenants.check_separate_files(
+            [('wos-worker-%d' % index, sharding.shard_environ(environ, index))
+             for index in range(4)])
+
+    def test_sqlite_is_refused(self):
+        self.assertRaises(ValueError, sharding.shard_environ,
+                          {'STORE_BACKEND': 'sqlite'}, 0)
+
+
+class SessionTestCase(unittest.TestCase):
+
+    def test_export_round_trip(self):
+        session = watson_online_store.Session('U1')
+        session.context = {'conversation_id': 'c1'}
+        session.customer = watson_online_store.OnlineStoreCustomer(
+            email='e@mail', first_name='f', last_name='l', shopping_cart=[])
+        session.response_tuple = [{'name': 'mug'}]
+
+        copy = watson_online_store.Session.from_export(session.export())
+
+        self.assertEqual('U1', copy.user_id)
+        self.assertEqual(session.context, copy.context)
+        self.assertEqual(session.customer.get_customer_dict(),
+                         copy.customer.get_customer_dict())
+        self.assertEqual([{'name': 'mug'}], copy.response_tuple)
+
+
+class ShardRouterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.results = multiprocessing.Queue()
+        self.router = sharding.ShardRouter(
+            functools.partial(FakeWos, self.results), 2, replicas=20)
+        self.router.start_services()
+
+    def tearDown(self):
+        self.router.stop_services()
+
+    def route(self, users):
+        self.router.process_slack_output(
+            [{'type': 'message', 'user': user, 'text': 'hi'}
+             for user in users])
+        results = {}
+        for _ in users:
+            user, pid, count = self.results.get(timeout=10)
+            results[user] = (pid, count)
+        return results
+
+    def test_users_stay_on_one_worker(self):
+        users = ['U%d' % i for i in range(20)]
+        first = self.route(users)
+        second = self.route(users)
+
+        self.assertEqual(2, len(set(pid for pid, _ in first.values())))
+        for user in users:
+            self.assertEqual(first[user][0], second[user][0])
+            self.assertEqual(2, second[user][1])
+
+    def test_metrics_from_workers(self):
+        users = ['U%d' % i for i in range(20)]
+        self.route(users)
+
+        snapshot = self.router.metrics_snapshot()
+        self.assertEqual(20, snapshot['counters']['fake.messages'])
+        self.assertEqual(sorted(self.router.workers),
+                         sorted(snapshot['workers']))
+        self.assertEqual(20, sum(s['counters']['fake.messages']
+                                 for s in snapshot['workers'].values()))
+
+    def test_profile_in_workers(self):
+        # FakeWos has no profiler.
+        self.assertEqual(dict((name, None) for name in self.router.workers),
+                         self.router.profile('status')['workers'])
+        self.assertRaises(ValueError, self.router.profile, 'restart')
+
+    def test_memory_from_workers(self):
+        self.route(['U%d' % i for i in range(20)])
+
+        workers = self.router.memory_report()['workers']
+        self.assertEqual(sorted(self.router.workers), sorted(workers))
+        self.assertEqual(20, sum(report['sessions']['sessions']
+                                 for report in workers.values()))
+
+    def test_events_without_user_are_dropped(self):
+        self.router.process_slack_output([{'type': 'hello'}, None])
+        self.assertEqual(set(), set(self.router.owners))
+
+    def test_idle_users_are_forgotten(self):
+        self.router.idle_timeout = 0.2
+        self.route(['U1', 'U2'])
+        time.sleep(0.3)
+        self.route(['U2'])
+
+        self.assertEqual(['U2'], list(self.router.owners))
+        self.assertEqual(['U2'], list(self.router.seen))
+        # U1's worker dropped the session too: its count starts over.
+        self.assertEqual(1, self.route(['U1'])['U1'][1])
+        self.assertEqual(['U2', 'U1'], list(self.router.seen))
+
+    def test_sessions_follow_users_on_rebalance(self):
+        users = ['U%d' % i for i in range(30)]
+        first = self.route(users)
+
+        self.router.add_worker()
+        second = self.route(users)
+        moved = [u for u in users if second[u][0] != first[u][0]]
+        self.assertTrue(moved)
+        for user in users:
+            # The count continues, so the session came along.
+            self.assertEqual(2, second[user][1])
+
+        self.router.remove_worker('wos-worker-0')
+        third = self.route(users)
+        for user in users:
+            self.assertEqual(3, third[user][1])
+
+
+class AdmittingShardRouterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.results = multiprocessing.Queue()
+        # Turns wait a while in admission, so they are still queued on the
+        # old worker when its users move.
+        self.router = sharding.ShardRouter(
+            functools.partial(AdmittingFakeWos, self.results, 1.0), 2,
+            replicas=20)
+        self.router.start_services()
+
+    def tearDown(self):
+        self.router.stop_services()
+
+    def collect(self, users):
+        results = {}
+        for _ in users:
+            user, pid, count = self.results.get(timeout=10)
+            results[user] = (pid, count)
+        return results
+
+    def owner_pid(self, user):
+        return self.router.workers[self.router.owners[user]].process.pid
+
+    def test_waiting_turns_move_with_users(self):
+        users = ['U%d' % i for i in range(30)]
+        events = [{'type': 'message', 'user': user, 'text': 'hi'}
+                  for user in users]
+        self.router.process_slack_output(events)
+        self.router.add_worker()
+
+        first = self.collect(users)
+        self.assertEqual(3, len(set(pid for pid, _ in first.values())))
+        for user in users:
+            # Handled once, by the worker that owns the session now.
+            self.assertEqual((self.owner_pid(user), 1), first[user])
+
+        self.router.process_slack_output(events)
+        second = self.collect(users)
+        for user in users:
+            self.assertEqual((self.owner_pid(user), 2), second[user])
+
+
+class HandoverTimeoutTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.results = multiprocessing.Queue()
+        self.router = sharding.ShardRouter(
+            functools.partial(SlowExportFakeWos, self.results), 2,
+            replicas=20)
+        self.router.start_services()
+
+    def tearDown(self):
+        self.router.stop_services()
+
+    def route(self, users):
+        self.router.process_slack_output(
+            [{'type': 'message', 'user': user, 'text': 'hi'}
+             for user in users])
+        results = {}
+        for _ in users:
+            user, pid, count = self.results.get(timeout=10)
+            results[user] = (pid, count)
+        return results
+
+    @mock.patch.object(sharding, 'HANDOVER_TIMEOUT', 0.2)
+    def test_sessions_are_lost_not_stuck(self):
+        users = ['U%d' % i for i in range(30)]
+        first = self.route(users)
+
+        new_worker = self.router.add_worker()
+        second = self.route(users)
+        moved = [u for u in users if self.router.owners[u] == new_worker]
+        self.assertTrue(moved)
+        for user in users:
+            # Moved users start over on their new worker.
+            self.assertEqual(1 if user in moved else 2, second[user][1])
+            if user not in moved:
+                self.assertEqual(first[user][0], second[user][0])
+
+    def test_late_reply_is_dropped(self):
+        worker = mock.Mock()
+        worker.replies = multiprocessing.Queue()
+        request_id = self.router.request_id
+        worker.replies.put((request_id, 'late'))
+        worker.replies.put((request_id + 1, 'handover'))
+
+        self.assertEqual('handover', self.router._request(
+            worker, sharding.EXPORT, ['U1'], 5))
+        worker.send.assert_called_once_with(sharding.EXPORT,
+                                            (request_id + 1, ['U1']))
+        self.assertIsNone(self.router._request(
+            worker, sharding.REPORT_METRICS, None, 0.1))
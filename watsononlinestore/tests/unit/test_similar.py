@@ -0,0 +1,77 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from watsononlinestore.catalog import similar
+
+DOCS_DIR = os.path.join(os.path.dirname(__file__), '..', '..', '..',
+                        'data', 'ibm_store_docs')
+
+DOCUMENTS = [
+    {'product_id': '1', 'title': 'Blue Coffee Mug', 'category': 'mug/mugs',
+     'text': 'Ceramic mug, holds 11 oz of coffee.', 'url': 'http://1'},
+    {'product_id': '2', 'title': 'Travel Mug', 'category': 'mug/mugs',
+     'text': 'Steel travel mug for coffee.', 'url': 'http://2'},
+    {'product_id': '3', 'title': 'Golf Cap', 'category': 'cap/caps',
+     'text': 'Cotton twill cap.', 'url': 'http://3'},
+    {'product_id': '4', 'title': 'Baseball Cap', 'category': 'cap/caps',
+     'text': 'Low profile cotton cap.', 'url': 'http://4'},
+    {'product_id': '5', 'title': 'Notebook', 'category': 'paper',
+     'text': 'Lined pages.', 'url': 'http://5'},
+]
+
+
+class SimilarProductsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'similar.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_build_and_lookup(self):
+        docs_dir = os.path.join(self.tmpdir, 'docs')
+        os.mkdir(docs_dir)
+        for document in DOCUMENTS:
+            with open(os.path.join(docs_dir, document['product_id'] +
+                                   '.json'), 'w') as doc_file:
+                json.dump(document, doc_file)
+
+        self.assertEqual(5, similar.build(docs_dir, self.path, k=2))
+        products = similar.SimilarProducts(self.path)
+        try:
+            mugs = products.similar('1')
+            self.assertEqual([('2', 'Travel Mug', 'http://2')],
+                             [(p['product_id'], p['name'], p['url'])
+                              for p in mugs])
+            self.assertGreater(mugs[0]['score'], 0)
+            self.assertEqual(['3'], [p['product_id']
+                                     for p in products.similar('4')])
+            # Nothing shares a term with the notebook.
+            self.assertEqual([], products.similar('5'))
+            self.assertEqual([], products.similar('unknown'))
+        finally:
+            products.close()
+
+    def test_not_a_similar_products_file(self):
+        with open(self.path, 'wb') as bad_file:
+            bad_file.write(b'\0' * 64)
+        self.assertRaises(ValueError, similar.SimilarProducts, self.path)
+
+    @unittest.skipIf(similar.numpy is None, "NumPy is not installed")
+    def test_numpy_matches_python(self):
+        documents = similar.load_documents(DOCS_DIR)
+        vectorized = similar.top_k_similar(documents, k=4)
+        numpy, similar.numpy = similar.numpy, None
+        try:
+            expected = similar.top_k_similar(documents, k=4)
+        finally:
+            similar.numpy = numpy
+
+        self.assertEqual(expected[0], vectorized[0])
+        for row, expected_row in zip(vectorized[1], expected[1]):
+            for score, expected_score in zip(row, expected_row):
+                self.assertAlmostEqual(expected_score, score, places=5)
@@ -0,0 +1,145 @@
+import io
+import json
+import threading
+import unittest
+
+import mock
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from watsononlinestore import slack_events
+from watsononlinestore.tests import fake_slack
+
+
+class SlackEventsAppTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1500000000
+        self.queue = queue.Queue(maxsize=2)
+        self.app = slack_events.SlackEventsApp(
+            fake_slack.SIGNING_SECRET, self.queue, clock=lambda: self.now)
+
+    def call(self, payload, method='POST', timestamp=None, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        if headers is None:
+            headers = fake_slack.signed_headers(
+                body, timestamp=timestamp or self.now)
+        environ = {'REQUEST_METHOD': method,
+                   'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': io.BytesIO(body)}
+        for name, value in headers.items():
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+        start_response = mock.Mock()
+        response = b''.join(self.app(environ, start_response))
+        return start_response.call_args[0][0], response
+
+    def test_event_is_queued(self):
+        payload = fake_slack.event_payload('hi')
+        status, _ = self.call(payload)
+
+        self.assertEqual('200 OK', status)
+        self.assertEqual(payload['event'], self.queue.get_nowait())
+
+    def test_team_from_envelope(self):
+        payload = fake_slack.event_payload('hi')
+        payload['team_id'] = 'T1'
+        self.call(payload)
+
+        self.assertEqual('T1', self.queue.get_nowait()['team'])
+
+    def test_url_verification(self):
+        status, body = self.call({'type': 'url_verification',
+                                  'challenge': 'abc123'})
+
+        self.assertEqual('200 OK', status)
+        self.assertEqual({'challenge': 'abc123'}, json.loads(body))
+
+    def test_bad_signature(self):
+        headers = fake_slack.signed_headers(b'{}', timestamp=self.now)
+        status, _ = self.call(fake_slack.event_payload('hi'),
+                              headers=headers)
+
+        self.assertEqual('401 Unauthorized', status)
+        self.assertTrue(self.queue.empty())
+
+    def test_stale_timestamp(self):
+        status, _ = self.call(fake_slack.event_payload('hi'),
+                              timestamp=self.now - 600)
+
+        self.assertEqual('401 Unauthorized', status)
+
+    def test_get_not_allowed(self):
+        status, _ = self.call({}, method='GET')
+
+        self.assertEqual('405 Method Not Allowed', status)
+
+    def test_retried_event_is_dropped(self):
+        payload = fake_slack.event_payload('hi')
+        self.call(payload)
+        status, _ = self.call(payload)
+
+        self.assertEqual('200 OK', status)
+        self.assertEqual(1, self.queue.qsize())
+
+    def test_concurrent_retries_are_queued_once(self):
+        self.app.event_queue = queue.Queue()
+        payload = fake_slack.event_payload('hi')
+        start = threading.Event()
+
+        def deliver():
+            start.wait()
+            self.call(payload)
+
+        threads = [threading.Thread(target=deliver) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, self.app.event_queue.qsize())
+
+    def test_full_queue(self):
+        for i in range(2):
+            self.call(fake_slack.event_payload('hi', event_id='Ev%d' % i))
+        payload = fake_slack.event_payload('hi', event_id='Ev9')
+        status, _ = self.call(payload)
+        self.assertEqual('503 Service Unavailable', status)
+
+        # Slack's retry is accepted once there is room.
+        self.queue.get_nowait()
+        status, _ = self.call(payload)
+        self.assertEqual('200 OK', status)
+
+
+class EventsServerTestCase(unittest.TestCase):
+
+    def test_fake_slack_round_trip(self):
+        wos = mock.Mock()
+        handled = threading.Event()
+        wos.process_slack_output.side_effect = lambda e: handled.set()
+        server, dispatcher = slack_events.make_events_server(
+            wos, fake_slack.SIGNING_SECRET, host='127.0.0.1', port=0)
+        dispatcher.start()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/' % server.server_port
+            payload = fake_slack.event_payload('<@UBOT> hi')
+            status, _ = fake_slack.post_event(url, payload)
+            self.assertEqual(200, status)
+            self.assertTrue(handled.wait(5))
+            wos.process_slack_output.assert_called_once_with(
+                [payload['event']])
+
+            status, _ = fake_slack.post_event(url, payload,
+                                              signing_secret='wrong')
+            self.assertEqual(401, status)
+        finally:
+            server.shutdown()
+            server.server_close()
+            dispatcher.stop()
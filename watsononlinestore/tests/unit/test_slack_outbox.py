@@ -0,0 +1,119 @@
+import json
+import unittest
+
+import mock
+
+from watsononlinestore import slack_outbox
+from watsononlinestore import watson_online_store
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def test_rate_and_burst(self):
+        clock = FakeClock()
+        bucket = slack_outbox.TokenBucket(1.0, 2, clock)
+
+        for _ in range(2):
+            self.assertEqual(0, bucket.wait_time())
+            bucket.consume()
+        self.assertAlmostEqual(1.0, bucket.wait_time())
+
+        clock.now += 0.5
+        self.assertAlmostEqual(0.5, bucket.wait_time())
+        clock.now += 0.5
+        self.assertEqual(0, bucket.wait_time())
+
+
+class SlackOutboxTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.slack_client = mock.Mock()
+        self.slack_client.api_call.return_value = {'ok': True}
+        self.outbox = slack_outbox.SlackOutbox(self.slack_client, rate=100,
+                                               burst=100)
+        self.outbox.start()
+
+    def tearDown(self):
+        self.outbox.stop(timeout=5)
+
+    def posted(self):
+        return [(c[1]['channel'], c[1]['text'])
+                for c in self.slack_client.api_call.call_args_list]
+
+    def test_acknowledge_then_update(self):
+        self.slack_client.api_call.return_value = {'ok': True, 'ts': '1.5'}
+        self.outbox.begin_turn('C1')
+        self.outbox.post('C1', 'Let me look.\n')
+        self.outbox.acknowledge('C1', 'Searching...')
+        self.assertTrue(self.outbox.flush(timeout=5))
+
+        self.outbox.post('C1', 'Here are mugs.\n')
+        self.outbox.end_turn('C1')
+        self.assertTrue(self.outbox.flush(timeout=5))
+
+        self.slack_client.api_call.assert_has_calls([
+            mock.call('chat.postMessage', channel='C1', as_user=True,
+                      text='Let me look.\nSearching...'),
+            mock.call('chat.update', channel='C1', as_user=True, ts='1.5',
+                      text='Let me look.\nHere are mugs.')])
+
+    def test_attachments_follow_the_turn(self):
+        self.slack_client.api_call.return_value = {'ok': True, 'ts': '1.5'}
+        cards = [{'fallback': 'Mug', 'blocks': []}]
+        self.outbox.begin_turn('C1')
+        self.outbox.acknowledge('C1', 'Searching...')
+        self.assertTrue(self.outbox.flush(timeout=5))
+
+        self.outbox.post('C1', 'Here are mugs.\n', cards)
+        self.outbox.post('C1', 'Anything else?\n')
+        self.outbox.end_turn('C1')
+        self.assertTrue(self.outbox.flush(timeout=5))
+
+        self.slack_client.api_call.assert_called_with(
+            'chat.update', channel='C1', as_user=True, ts='1.5',
+            text='Here are mugs.\nAnything else?',
+            attachments=json.dumps(cards))
+
+    def test_turn_is_one_post(self):
+        self.outbox.begin_turn('C1')
+        self.outbox.post('C1', 'one\n')
+        self.outbox.post('C2', 'other')
+        self.outbox.post('C1', 'two\n')
+        self.assertTrue(self.outbox.flush(timeout=5))
+        self.assertEqual([('C2', 'other')], self.posted())
+
+        self.outbox.end_turn('C1')
+
+        self.assertTrue(self.outbox.flush(timeout=5))
+        self.assertEqual([('C2', 'other'), ('C1', 'one\ntwo')],
+                         self.posted())
+
+    def test_retry_after(self):
+        self.slack_client.api_call.side_effect = [
+            {'ok': False, 'error': 'ratelimited',
+             'headers': {'Retry-After': '0.01'}},
+            {'ok': True}]
+
+        self.outbox.post('C1', 'hello')
+
+        self.assertTrue(self.outbox.flush(timeout=5))
+        self.assertEqual([('C1', 'hello')] * 2, self.posted())
+        self.assertEqual(0, self.outbox.pending())
+
+    def test_sender_uses_outbox(self):
+        sender = watson_online_store.SlackSender(
+            self.slack_client, 'C1', self.outbox)
+
+        sender.send_message('queued')
+
+        self.assertTrue(self.outbox.flush(timeout=5))
+        self.assertEqual([('C1', 'queued')], self.posted())
@@ -0,0 +1,128 @@
+import unittest
+
+from watsononlinestore.database import cart_items
+from watsononlinestore.database import sqlite_online_store
+from watsononlinestore import watson_online_store
+
+
+class SQLiteOnlineStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = sqlite_online_store.SQLiteOnlineStore(':memory:')
+        self.store.init()
+        self.customer = watson_online_store.OnlineStoreCustomer(
+            email='e@mail', first_name='first', last_name='last',
+            shopping_cart=[])
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_add_and_find_customer(self):
+        added = self.store.add_customer_obj(self.customer)
+
+        self.assertEqual('e@mail', added['email'])
+        self.assertEqual(added, self.store.find_customer('e@mail'))
+        self.assertEqual('first', added['first_name'])
+        self.assertEqual('last', added['last_name'])
+
+    def test_add_customer_twice(self):
+        self.store.add_customer_obj(self.customer)
+        self.customer.first_name = 'changed'
+
+        existing = self.store.add_customer_obj(self.customer)
+
+        self.assertEqual('first', existing['first_name'])
+
+    def test_find_customer_not_found(self):
+        self.assertIsNone(self.store.find_customer('nobody'))
+        self.assertIsNone(self.store.list_shopping_cart('nobody'))
+        self.assertEqual(0, self.store.add_to_shopping_cart(
+            'nobody', cart_items.new_item('1', 'x')))
+
+    def test_journal_entries_apply_once(self):
+        self.store.add_customer_obj(self.customer)
+        item = cart_items.new_item('1', 'a')
+
+        for _ in range(2):
+            self.assertEqual(1, self.store.add_to_shopping_cart(
+                'e@mail', item, 2, journal_entry=('j1', 1)))
+            self.assertEqual(1, self.store.delete_item_shopping_cart(
+                'e@mail', '1', 1, journal_entry=('j1', 2)))
+        self.assertEqual([item], self.store.list_shopping_cart('e@mail'))
+
+        # A different journal starts its own sequence.
+        self.store.add_to_shopping_cart('e@mail', item,
+                                        journal_entry=('j2', 1))
+        self.assertEqual([dict(item, quantity=2)],
+                         self.store.list_shopping_cart('e@mail'))
+
+    def test_shopping_cart(self):
+        self.store.add_customer_obj(self.customer)
+        item_a = cart_items.new_item('1', 'a')
+        item_b = cart_items.new_item('2', 'b', 'http://b')
+
+        self.assertEqual([], self.store.list_shopping_cart('e@mail'))
+        self.assertEqual(1, self.store.add_to_shopping_cart('e@mail', item_a))
+        self.assertEqual(1, self.store.add_to_shopping_cart('e@mail', item_b))
+        self.assertEqual(1, self.store.add_to_shopping_cart('e@mail', item_a))
+        self.assertEqual([dict(item_a, quantity=2), item_b],
+                         self.store.list_shopping_cart('e@mail'))
+
+        self.assertEqual(
+            1, self.store.delete_item_shopping_cart('e@mail', '1', 1))
+        self.assertEqual([item_a, item_b],
+                         self.store.list_shopping_cart('e@mail'))
+        self.assertEqual(
+            1, self.store.delete_item_shopping_cart('e@mail', '1'))
+        self.assertEqual([item_b], self.store.list_shopping_cart('e@mail'))
+        self.assertEqual(
+            0, self.store.delete_item_shopping_cart('e@mail', '3'))
+
+    def test_migrate_legacy_cart(self):
+        self.store.add_customer_obj(self.customer)
+        conn = self.store.conn
+        with conn:
+            conn.execute('CREATE TABLE shopping_cart (id INTEGER PRIMARY KEY '
+                         'AUTOINCREMENT, customer_id INTEGER, item TEXT)')
+            for item in ('Mug: http://x/ProductDetail.aspx?pid=132254\n',
+                         'Cap: http://x/ProductDetail.aspx?pid=131626\n',
+                         'Mug: http://x/ProductDetail.aspx?pid=132254\n'):
+                conn.execute('INSERT INTO shopping_cart (customer_id, item) '
+                             'VALUES (1, ?)', (item,))
+
+        self.store.init()
+
+        cart = self.store.list_shopping_cart('e@mail')
+        self.assertEqual([('132254', 'Mug', 2), ('131626', 'Cap', 1)],
+                         [(i['product_id'], i['name'], i['quantity'])
+                          for i in cart])
+
+    def test_archive_shopping_cart(self):
+        self.store.add_customer_obj(self.customer)
+        self.store.add_to_shopping_cart('e@mail',
+                                        cart_items.new_item('1', 'old'))
+        conn = self.store.conn
+        with conn:
+            conn.execute("UPDATE cart_item SET added = 0")
+        self.store.add_to_shopping_cart('e@mail',
+                                        cart_items.new_item('2', 'new'))
+
+        self.assertEqual(
+            1, self.store.archive_shopping_cart('e@mail', 3600))
+
+        self.assertEqual(['2'], [i['product_id'] for i in
+                                 self.store.list_shopping_cart('e@mail')])
+        archived = conn.execute(
+            'SELECT product_id FROM cart_item_archive').fetchall()
+        self.assertEqual([('1',)], [tuple(row) for row in archived])
+
+    def test_hot_document_sizes(self):
+        self.store.add_customer_obj(self.customer)
+        self.store.add_to_shopping_cart('e@mail',
+                                        cart_items.new_item('1', 'a'))
+
+        report = self.store.hot_document_sizes()
+
+        self.assertEqual(1, report['customer']['count'])
+        self.assertEqual(1, report['cart']['count'])
+        self.assertGreater(report['cart']['max_bytes'], 0)
@@ -0,0 +1,139 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from watsononlinestore.metrics import METRICS
+from watsononlinestore import metrics
+from watsononlinestore import tenants
+
+
+class FakeWos(object):
+
+    def __init__(self, team):
+        self.slack_client = mock.Mock()
+        self.slack_client.api_call.return_value = {'ok': bool(team),
+                                                   'team_id': team}
+        self.events = []
+        self.started = self.stopped = False
+
+    def start_services(self):
+        self.started = True
+
+    def stop_services(self):
+        self.stopped = True
+
+    def process_slack_output(self, events):
+        self.events.extend(events)
+
+
+class TenantsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, config):
+        path = os.path.join(self.directory, 'tenants.json')
+        with open(path, 'w') as f:
+            json.dump(config, f)
+        return path
+
+    def test_load_tenants(self):
+        path = self.write({'tenants': [
+            {'name': 'acme', 'WORKSPACE_ID': 'w1',
+             'ADMISSION_GLOBAL_LIMIT': 20},
+            {'name': 'globex', 'WORKSPACE_ID': 'w2'}]})
+
+        self.assertEqual(
+            [('acme', {'WORKSPACE_ID': 'w1', 'ADMISSION_GLOBAL_LIMIT': '20'}),
+             ('globex', {'WORKSPACE_ID': 'w2'})],
+            tenants.load_tenants(path))
+
+    def test_load_tenants_checks(self):
+        for config in ({'tenants': []},
+                       {'tenants': [{'WORKSPACE_ID': 'w1'}]},
+                       {'tenants': [{'name': 'a.b'}]},
+                       {'tenants': [{'name': 'acme'}, {'name': 'acme'}]}):
+            self.assertRaises(ValueError, tenants.load_tenants,
+                              self.write(config))
+
+    def test_check_separate_files(self):
+        shared_sqlite = [('acme', {'STORE_BACKEND': 'sqlite'}),
+                         ('globex', {'STORE_BACKEND': 'sqlite'})]
+        self.assertRaises(ValueError, tenants.check_separate_files,
+                          shared_sqlite)
+        shared_journal = [('acme', {'CART_JOURNAL_PATH': 'journal.log'}),
+                          ('globex', {'CART_JOURNAL_PATH': './journal.log'})]
+        self.assertRaises(ValueError, tenants.check_separate_files,
+                          shared_journal)
+
+        # Cloudant tenants without a cache write no local files.
+        tenants.check_separate_files([
+            ('acme', {'SQLITE_DB_PATH': 'store.db'}),
+            ('globex', {'SQLITE_DB_PATH': 'store.db'})])
+        tenants.check_separate_files([
+            ('acme', {'STORE_BACKEND': 'sqlite',
+                      'SQLITE_DB_PATH': 'acme.db'}),
+            ('globex', {'STORE_BACKEND': 'sqlite',
+                        'SQLITE_DB_PATH': 'globex.db'})])
+
+    def test_shared_resources(self):
+        shared = tenants.SharedResources()
+        factory = mock.Mock(side_effect=[object(), object()])
+
+        first = shared.get(('conversation', 'user'), factory)
+        second = shared.get(('conversation', 'user'), factory)
+        other = shared.get(('conversation', 'other'), factory)
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+        self.assertEqual(2, factory.call_count)
+
+    def test_routes_by_team(self):
+        acme, globex, broken = FakeWos('T1'), FakeWos('T2'), FakeWos(None)
+        router = tenants.TenantRouter({'acme': acme, 'globex': globex,
+                                       'broken': broken})
+        unknown = METRICS.snapshot()['counters'].get('tenants.unknown_team',
+                                                     0)
+        router.start_services()
+
+        router.process_slack_output([
+            {'type': 'message', 'team': 'T1', 'text': 'a'},
+            {'type': 'message', 'team': 'T2', 'text': 'b'},
+            {'type': 'message', 'team': 'T9', 'text': 'c'}])
+        router.stop_services()
+
+        self.assertEqual(['a'], [e['text'] for e in acme.events])
+        self.assertEqual(['b'], [e['text'] for e in globex.events])
+        self.assertEqual([], broken.events)
+        self.assertTrue(all(wos.started and wos.stopped
+                            for wos in (acme, globex, broken)))
+        self.assertEqual(unknown + 1, METRICS.snapshot()['counters'][
+            'tenants.unknown_team'])
+
+    def test_metrics_by_tenant(self):
+        registry = metrics.Metrics()
+        router = tenants.TenantRouter({'acme': FakeWos('T1'),
+                                       'globex': FakeWos('T2')})
+        with metrics.scope('acme'):
+            registry.incr('messages.received', 2)
+            registry.observe('latency.message', 0.5)
+        with metrics.scope('globex'):
+            registry.incr('messages.received')
+
+        with mock.patch.object(tenants, 'METRICS', registry):
+            by_tenant = router.metrics_by_tenant()
+
+        self.assertEqual({'messages.received': 2},
+                         by_tenant['acme']['counters'])
+        self.assertIn('latency.message', by_tenant['acme']['timings'])
+        self.assertEqual({'messages.received': 1},
+                         by_tenant['globex']['counters'])
+        self.assertEqual(3, registry.snapshot()['counters'][
+            'messages.received'])
@@ -0,0 +1,132 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from watsononlinestore.catalog import uploader
+from watsononlinestore.tests.http_fixture import FixtureServer
+
+PREFIX = '/v1/environments/env/collections/col/documents/'
+
+
+class FakeDiscovery(object):
+    """Stores uploaded documents; can throttle or reject requests."""
+
+    def __init__(self):
+        self.documents = {}
+        self.throttle = 0
+        self.reject = set()
+        self.lock = threading.Lock()
+
+    def __call__(self, request):
+        path, _, query = request.path.partition('?')
+        document_id = path[len(PREFIX):]
+        with self.lock:
+            if self.throttle:
+                self.throttle -= 1
+                return 429, {'Retry-After': '0'}, b'{"error": "slow down"}'
+            if document_id in self.reject:
+                return 400, {}, b'{"error": "bad document"}'
+            self.documents[document_id] = request
+        return 202, {'Content-Type': 'application/json'}, json.dumps(
+            {'document_id': document_id, 'status': 'processing'}).encode()
+
+
+class UploaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.docs = os.path.join(self.tmpdir, 'docs')
+        os.mkdir(self.docs)
+        for i in range(10):
+            self.write_doc(i, {'product_id': str(i), 'title': 'Mug %d' % i})
+        self.checkpoint = os.path.join(self.tmpdir, 'checkpoint.json')
+        self.discovery = FakeDiscovery()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_doc(self, i, doc):
+        with open(os.path.join(self.docs, '%d.json' % i), 'w') as f:
+            json.dump(doc, f)
+
+    def upload(self, server, **kwargs):
+        kwargs.setdefault('retry_delay', 0.01)
+        upload = uploader.Uploader('env', 'col', 'user', 'pass',
+                                   self.checkpoint, url=server.url + '/',
+                                   **kwargs)
+        return upload, upload.upload(uploader.find_documents(self.docs))
+
+    def test_upload_then_skip_unchanged(self):
+        with FixtureServer(self.discovery) as server:
+            _, counts = self.upload(server)
+            self.assertEqual({uploader.UPLOADED: 10, uploader.SKIPPED: 0,
+                              uploader.FAILED: 0}, counts)
+
+            request = self.discovery.documents['3']
+            self.assertEqual('POST', request.method)
+            self.assertTrue(request.path.endswith(
+                '/3?version=' + uploader.DISCOVERY_VERSION))
+            self.assertEqual('Basic dXNlcjpwYXNz',
+                             request.headers['Authorization'])
+            self.assertIn(b'filename="3.json"', request.body)
+            self.assertIn(b'Content-Type: application/json', request.body)
+            self.assertIn(b'"title": "Mug 3"', request.body)
+
+            self.write_doc(3, {'product_id': '3', 'title': 'New mug'})
+            _, counts = self.upload(server)
+            self.assertEqual({uploader.UPLOADED: 1, uploader.SKIPPED: 9,
+                              uploader.FAILED: 0}, counts)
+            self.assertEqual(11, len(server.requests))
+
+    def test_interrupted_run_resumes(self):
+        self.discovery.reject = {'4', '7'}
+        with FixtureServer(self.discovery) as server:
+            _, counts = self.upload(server)
+            self.assertEqual(2, counts[uploader.FAILED])
+            with open(self.checkpoint) as f:
+                self.assertEqual(8, len(json.load(f)))
+
+            self.discovery.reject = set()
+            _, counts = self.upload(server)
+            self.assertEqual({uploader.UPLOADED: 2, uploader.SKIPPED: 8,
+                              uploader.FAILED: 0}, counts)
+            self.assertEqual(10, len(self.discovery.documents))
+
+    def test_throttled_uploads_back_off(self):
+        self.discovery.throttle = 3
+        with FixtureServer(self.discovery) as server:
+            upload, counts = self.upload(server, workers=8)
+
+        self.assertEqual(10, counts[uploader.UPLOADED])
+        self.assertLess(upload.throttle.limit, 8)
+
+
+class AdaptiveThrottleTestCase(unittest.TestCase):
+
+    def test_backoff_and_recover(self):
+        now = [100.0]
+        throttle = uploader.AdaptiveThrottle(8, recover_after=2,
+                                             clock=lambda: now[0])
+        self.assertTrue(throttle.try_acquire())
+        throttle.release(throttled=True, retry_after=5)
+        self.assertEqual(4, throttle.limit)
+        self.assertEqual(105.0, throttle.paused_until)
+        # Everyone waits out Retry-After.
+        self.assertFalse(throttle.try_acquire())
+
+        now[0] = 106.0
+        self.assertTrue(throttle.try_acquire())
+        throttle.release(throttled=True)
+        self.assertEqual(2, throttle.limit)
+
+        self.assertTrue(throttle.try_acquire())
+        self.assertTrue(throttle.try_acquire())
+        self.assertFalse(throttle.try_acquire())
+        throttle.release()
+        throttle.release()
+        # recover_after successes grow the limit by one.
+        self.assertEqual(3, throttle.limit)
+        self.assertEqual(0, throttle.active)
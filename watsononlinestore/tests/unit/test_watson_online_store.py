@@ -1,8 +1,17 @@
+import json
+import threading
+import time
 import unittest
 
+try:
+    from sys import intern
+except ImportError:  # Python 2
+    pass
+
 import ddt
 import mock
 
+from watsononlinestore.metrics import METRICS
 from watsononlinestore import watson_online_store
 
 
@@ -238,3 +247,394 @@ class WOSTestCase(unittest.TestCase):
             counterexamples=ws_json['counterexamples'],
             metadata=ws_json['metadata'])
         self.assertEqual(expected_workspace_id, actual)
+
+    def test_context_merge_in_place(self):
+        context = {'conversation_id': 'c1', 'cart_item': '1'}
+
+        merged = self.wosbot.context_merge(context, {'cart_item': '2'})
+
+        self.assertIs(context, merged)
+        self.assertEqual({'conversation_id': 'c1', 'cart_item': '2'}, merged)
+        self.assertIs(context, self.wosbot.context_merge(context, None))
+
+    def test_intern_keys(self):
+        context = json.loads('{"system": {"dialog_stack": [{"dialog_node":'
+                             ' "root"}]}, "get_input": "yes"}')
+        system = context['system']
+
+        watson_online_store.intern_keys(context)
+
+        self.assertEqual({'system': {'dialog_stack': [{'dialog_node':
+                                                       'root'}]},
+                          'get_input': 'yes'}, context)
+        self.assertIs(system, context['system'])
+        self.assertTrue(any(key is intern('get_input') for key in context))
+
+    def test_session_has_no_instance_dict(self):
+        session = watson_online_store.Session('U1')
+        self.assertRaises(AttributeError, setattr, session, 'extra', 1)
+        customer = watson_online_store.OnlineStoreCustomer(email='e@mail')
+        self.assertFalse(hasattr(customer, '__dict__'))
+
+    def test_handle_add_to_cart(self):
+        self.wosbot.customer = watson_online_store.OnlineStoreCustomer(
+            email='e@mail')
+        self.wosbot.response_tuple = [
+            {'cart_number': '1', 'product_id': '132254', 'name': 'Mug',
+             'url': 'http://x/ProductDetail.aspx?pid=132254', 'image': ''}]
+        self.wosbot.context = {'shopping_cart': 'add', 'cart_item': '1'}
+
+        self.assertFalse(self.wosbot.handle_add_to_cart())
+
+        self.cloudant_store.add_to_shopping_cart.assert_called_once_with(
+            'e@mail', {'product_id': '132254', 'name': 'Mug',
+                       'url': 'http://x/ProductDetail.aspx?pid=132254',
+                       'quantity': 1})
+        self.assertEqual('', self.wosbot.context['cart_item'])
+
+    def test_handle_add_to_cart_from_old_snapshot(self):
+        # Results saved before they had a product ID are keyed by name.
+        self.wosbot.customer = watson_online_store.OnlineStoreCustomer(
+            email='e@mail')
+        self.wosbot.response_tuple = [
+            {'cart_number': '1', 'name': 'Mug', 'url': 'http://x/mug',
+             'image': ''}]
+        self.wosbot.context = {'shopping_cart': 'add', 'cart_item': '1'}
+
+        self.assertFalse(self.wosbot.handle_add_to_cart())
+
+        self.cloudant_store.add_to_shopping_cart.assert_called_once_with(
+            'e@mail', {'product_id': 'Mug', 'name': 'Mug',
+                       'url': 'http://x/mug', 'quantity': 1})
+
+    def test_handle_add_to_cart_suggests_similar(self):
+        self.wosbot.customer = watson_online_store.OnlineStoreCustomer(
+            email='e@mail')
+        self.wosbot.response_tuple = [
+            {'cart_number': '1', 'product_id': '132254', 'name': 'Mug',
+             'url': 'http://m', 'image': ''}]
+        self.wosbot.context = {'shopping_cart': 'add', 'cart_item': '1'}
+        self.wosbot.similar_products = mock.Mock()
+        self.wosbot.similar_products.similar.return_value = [
+            {'product_id': '2', 'name': 'Cup', 'url': 'http://c',
+             'score': 0.5}]
+        sender = mock.Mock()
+
+        self.assertFalse(self.wosbot.handle_add_to_cart(sender))
+
+        self.wosbot.similar_products.similar.assert_called_once_with(
+            '132254', watson_online_store.SIMILAR_COUNT)
+        sender.send_message.assert_called_once_with(
+            "You might also like:\n- Cup: http://c")
+
+    def test_handle_list_and_delete_from_cart(self):
+        self.wosbot.customer = watson_online_store.OnlineStoreCustomer(
+            email='e@mail')
+        self.cloudant_store.list_shopping_cart.return_value = [
+            {'product_id': '1', 'name': 'Mug', 'url': 'http://m',
+             'quantity': 2},
+            {'product_id': '2', 'name': 'Cap', 'url': 'http://c',
+             'quantity': 1}]
+
+        self.wosbot.handle_list_shopping_cart()
+        self.assertEqual("1) Mug (x2): http://m\n2) Cap: http://c\n",
+                         self.wosbot.context['shopping_cart'])
+
+        self.wosbot.context['cart_item'] = '2'
+        self.wosbot.handle_delete_from_cart()
+        self.cloudant_store.delete_item_shopping_cart.assert_called_once_with(
+            'e@mail', '2')
+
+    def test_discovery_search_updates_placeholder(self):
+        fake_channel = "fake channel"
+        sender = watson_online_store.SlackSender(
+            self.slack_client, fake_channel)
+        self.slack_client.api_call.return_value = {'ok': True, 'ts': '1.5'}
+        self.discovery_client.query.return_value = {'results': []}
+        self.conv_client.message.side_effect = [
+            {'context': {'discovery_string': 'mugs'},
+             'output': {'text': ['Looking for mugs.']}},
+            {'context': {'discovery_string': ''},
+             'output': {'text': ['Here you go.']}},
+        ]
+
+        self.assertFalse(self.wosbot.handle_message("mugs", sender))
+        self.assertTrue(self.wosbot.handle_message("mugs", sender))
+
+        self.slack_client.api_call.assert_has_calls([
+            mock.call('chat.postMessage', as_user=True,
+                      channel=fake_channel, text='Looking for mugs.\n'),
+            mock.call('chat.postMessage', as_user=True,
+                      channel=fake_channel,
+                      text=watson_online_store.SEARCHING_MESSAGE),
+            mock.call('chat.update', as_user=True, channel=fake_channel,
+                      ts='1.5', text='Here you go.\n'),
+        ])
+        self.assertIsNone(self.wosbot.discovery_finished_at)
+
+    def test_discovery_results_are_shown_as_cards(self):
+        sender = watson_online_store.SlackSender(self.slack_client, 'D1')
+        self.slack_client.api_call.return_value = {'ok': True, 'ts': '1.5'}
+        self.discovery_client.query.return_value = {'results': [
+            {'product_id': '131628', 'title': 'Cap',
+             'url': 'http://store/p/131628',
+             'image_url': 'http://img/cap'}]}
+        self.conv_client.message.side_effect = [
+            {'context': {'discovery_string': 'caps'},
+             'output': {'text': ['Looking for caps.']}},
+            {'context': {'discovery_string': ''},
+             'output': {'text': ['Here you go.']}},
+        ]
+
+        self.assertFalse(self.wosbot.handle_message("caps", sender))
+        self.assertTrue(self.wosbot.handle_message("caps", sender))
+
+        self.assertEqual('\n1) Cap\nhttp://img/cap',
+                         self.conv_client.message.call_args[1]['context'][
+                             'discovery_result'])
+        update = self.slack_client.api_call.call_args
+        self.assertEqual('chat.update', update[0][0])
+        blocks = json.loads(update[1]['attachments'])[0]['blocks']
+        self.assertEqual('*1)* <http://store/p/131628|Cap>',
+                         blocks[0]['text']['text'])
+        self.assertEqual('http://img/cap',
+                         blocks[0]['accessory']['image_url'])
+        self.assertIsNone(self.wosbot.result_attachments)
+
+    def search_results(self, total):
+        def query(environment_id, collection_id, query_options):
+            offset = query_options['offset']
+            count = min(query_options['count'], max(total - offset, 0))
+            return {'results': [
+                {'product_id': str(100 + offset + i),
+                 'title': 'Mug %d' % (offset + i + 1),
+                 'url': 'http://store/p/%d' % (100 + offset + i)}
+                for i in range(count)]}
+        self.discovery_client.query.side_effect = query
+
+    def test_show_more_results(self):
+        self.search_results(15)
+        self.wosbot.customer = watson_online_store.OnlineStoreCustomer(
+            email='e@mail')
+        self.wosbot.context = {'discovery_string': 'mugs'}
+        sender = mock.Mock()
+
+        self.wosbot.handle_DiscoveryQuery()
+        self.assertEqual(['1', '2', '3', '4', '5'],
+                         [e['cart_number'] for e in
+                          self.wosbot.response_tuple])
+        self.assertEqual(1, self.discovery_client.query.call_count)
+
+        # Already fetched: no query, but the next page is prefetched.
+        self.assertTrue(self.wosbot.wants_more_results('show me more'))
+        self.wosbot.handle_turn('show me more', sender)
+        text, attachments = sender.send_message.call_args[0]
+        self.assertTrue(text.startswith(
+            watson_online_store.MORE_RESULTS_MESSAGE + '\n6) Mug 6\n'))
+        self.assertEqual(5, len(attachments[0]['blocks']))
+        self.conv_client.message.assert_not_called()
+        deadline = time.time() + 5
+        while (not self.wosbot.result_cursor['pending'] and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(2, self.discovery_client.query.call_count)
+        self.assertEqual(10, self.discovery_client.query.call_args[1][
+            'query_options']['offset'])
+
+        self.wosbot.handle_turn('more', sender)
+        self.assertEqual(15, len(self.wosbot.response_tuple))
+        self.assertEqual('15) Mug 15', sender.send_message.call_args[0][
+            0].splitlines()[-2])
+        self.wosbot.handle_turn('more', sender)
+        sender.send_message.assert_called_with(
+            watson_online_store.NO_MORE_RESULTS)
+        self.assertEqual(2, self.discovery_client.query.call_count)
+
+        self.wosbot.context['cart_item'] = '12'
+        self.wosbot.handle_add_to_cart()
+        self.cloudant_store.add_to_shopping_cart.assert_called_once_with(
+            'e@mail', {'product_id': '111', 'name': 'Mug 12',
+                       'url': 'http://store/p/111', 'quantity': 1})
+
+    def test_prefetch_uses_the_config_it_was_started_with(self):
+        self.search_results(30)
+        query = self.discovery_client.query.side_effect
+        turn_over = threading.Event()
+
+        def blocking_query(**kwargs):
+            if kwargs['query_options']['offset']:
+                turn_over.wait(5)
+            return query(**kwargs)
+        self.discovery_client.query.side_effect = blocking_query
+        self.wosbot.context = {'discovery_string': 'mugs'}
+        session = self.wosbot.session
+        self.wosbot.handle_DiscoveryQuery()
+        self.wosbot.prefetch_results(session, session.result_cursor)
+
+        # The next turn: a new config and another user's session.
+        self.wosbot.discovery_score_filter = 0.9
+        self.wosbot.session = watson_online_store.Session('U2')
+        turn_over.set()
+        deadline = time.time() + 5
+        while (len(session.result_cursor['pending']) < 15 and
+               time.time() < deadline):
+            time.sleep(0.01)
+
+        # Unscored results pass only the old config's filter.
+        self.assertEqual(15, len(session.result_cursor['pending']))
+        self.assertIsNone(self.wosbot.session.result_cursor)
+
+        # The next page is fetched by the same worker thread.
+        worker = self.wosbot.prefetch_worker
+        self.wosbot.prefetch_results(session, session.result_cursor)
+        self.assertIs(worker, self.wosbot.prefetch_worker)
+
+    def test_more_is_only_taken_while_choosing(self):
+        self.search_results(3)
+        self.wosbot.context = {'discovery_string': 'mugs'}
+        self.assertFalse(self.wosbot.wants_more_results('more'))
+
+        self.wosbot.handle_DiscoveryQuery()
+        self.assertEqual({'query': 'mugs', 'offset': 10, 'next_number': 4,
+                          'pending': [], 'exhausted': True},
+                         self.wosbot.result_cursor)
+        self.assertTrue(self.wosbot.wants_more_results('more'))
+        self.assertFalse(self.wosbot.wants_more_results('more mugs'))
+        self.wosbot.context['discovery_result'] = ''
+        self.assertFalse(self.wosbot.wants_more_results('more'))
+
+    def test_session_export_keeps_result_cursor(self):
+        session = watson_online_store.Session('U1')
+        session.result_cursor = {'query': 'mugs', 'offset': 10,
+                                 'next_number': 11, 'pending': [],
+                                 'exhausted': False}
+        exported = session.export()
+
+        self.assertEqual(session.result_cursor,
+                         watson_online_store.Session.from_export(
+                             exported).result_cursor)
+        del exported['result_cursor']
+        self.assertIsNone(watson_online_store.Session.from_export(
+            exported).result_cursor)
+
+    def test_format_discovery_response_caches_cards(self):
+        page = {'id': 'doc-1', 'html': ' <a href="/ProductDetail.aspx'
+                '?pid=132254">', 'text': ' Product:Mug Category: Drink'}
+        response = {'results': [page]}
+        renderer = self.wosbot.renderer
+
+        with mock.patch.object(watson_online_store.WatsonOnlineStore,
+                               '_product_card',
+                               wraps=self.wosbot._product_card) as make:
+            first = self.wosbot.format_discovery_response(response, renderer)
+            second = self.wosbot.format_discovery_response(response,
+                                                           renderer)
+            page['text'] = ' Product:Big Mug Category: Drink'
+            changed = self.wosbot.format_discovery_response(response,
+                                                            renderer)
+
+        self.assertEqual(first, second)
+        self.assertEqual('Mug', first[0]['name'])
+        self.assertEqual('132254', first[0]['product_id'])
+        self.assertEqual('Big Mug', changed[0]['name'])
+        self.assertEqual(2, make.call_count)
+
+    def test_format_discovery_response_documents(self):
+        response = {'results': [{
+            'product_id': '131628',
+            'title': 'Eye-Bee-M Cap <new>',
+            'url': 'http://store/p/131628',
+            'image_url': 'http://img/lf?set=scale[2300],sku[1]',
+            'text': 'A cap.'}]}
+
+        self.assertEqual(
+            [{'cart_number': '1',
+              'product_id': '131628',
+              'name': 'Eye-Bee-M Cap &lt;new&gt;',
+              'url': 'http://store/p/131628',
+              'image': 'http://img/lf?set=scale[50],sku[1]'}],
+            self.wosbot.format_discovery_response(response))
+
+    def test_stop_services_stops_store(self):
+        self.wosbot.start_services()
+        self.wosbot.stop_services()
+
+        self.cloudant_store.stop.assert_called_once_with(timeout=5)
+
+    def test_sessions_are_per_user(self):
+        self.wosbot.init_customer = mock.Mock()
+        self.conv_client.message.side_effect = lambda **kw: {
+            'context': {'conversation_id': kw['message_input']['text']},
+            'output': {'text': ['ok']}}
+
+        for user in ('U1', 'U2'):
+            self.wosbot.process_slack_output([
+                {'type': 'message', 'channel': 'D1', 'user': user,
+                 'text': 'hi ' + user}])
+
+        self.assertEqual({'conversation_id': 'hi u1'},
+                         self.wosbot.sessions['U1'].context)
+        self.assertEqual({'conversation_id': 'hi u2'},
+                         self.wosbot.sessions['U2'].context)
+
+        exported = self.wosbot.export_sessions(['U1', 'missing'])
+        self.assertEqual(['U2'], list(self.wosbot.sessions))
+        self.wosbot.import_sessions(exported)
+        self.assertEqual({'conversation_id': 'hi u1'},
+                         self.wosbot.session_for('U1').context)
+
+    def test_messages_are_profiled(self):
+        self.wosbot.init_customer = mock.Mock()
+        self.wosbot.profiler = mock.MagicMock()
+        self.conv_client.message.return_value = {
+            'context': {}, 'output': {'text': ['ok']}}
+
+        self.wosbot.process_slack_output([
+            {'type': 'message', 'channel': 'D1', 'user': 'U1',
+             'text': 'hi'}])
+
+        self.wosbot.profiler.message.assert_called_once_with('U1')
+        self.assertTrue(self.conv_client.message.called)
+
+    def test_tenant_settings_and_metrics(self):
+        wosbot = watson_online_store.WatsonOnlineStore(
+            'UBOTID', self.slack_client, self.conv_client,
+            self.discovery_client, self.cloudant_store,
+            environ={'WORKSPACE_ID': self.fake_workspace_id,
+                     'DISCOVERY_COLLECTION_ID': 'acme collection',
+                     'MESSAGE_LATENCY_BUDGET': '3'})
+        wosbot.tenant = 'acme'
+        wosbot.init_customer = mock.Mock()
+        self.conv_client.message.return_value = {
+            'context': {}, 'output': {'text': ['ok']}}
+
+        wosbot.process_slack_output([
+            {'type': 'message', 'channel': 'D1', 'user': 'U1',
+             'text': 'hi'}])
+
+        self.assertEqual('acme collection', wosbot.discovery_collection_id)
+        self.assertEqual(3.0, wosbot.latency_budget)
+        self.assertIn('tenant.acme.conversation.seconds',
+                      METRICS.snapshot()['timings'])
+
+    def test_conversation_failure_uses_fallback(self):
+        sender = watson_online_store.SlackSender(self.slack_client, 'D1')
+        self.wosbot.context = {'discovery_string': 'mugs'}
+        self.conv_client.message.side_effect = Exception('down')
+
+        self.assertTrue(self.wosbot.handle_message("mugs", sender))
+
+        self.slack_client.api_call.assert_called_once_with(
+            'chat.postMessage', as_user=True, channel='D1',
+            text=watson_online_store.CONVERSATION_UNAVAILABLE + '\n')
+        self.assertEqual({'discovery_string': 'mugs'}, self.wosbot.context)
+        self.discovery_client.query.assert_not_called()
+
+    def test_discovery_failure_uses_fallback(self):
+        self.wosbot.context = {'discovery_string': 'mugs'}
+        self.discovery_client.query.side_effect = Exception('down')
+
+        self.assertFalse(self.wosbot.handle_DiscoveryQuery())
+
+        self.assertEqual(watson_online_store.DISCOVERY_UNAVAILABLE,
+                         self.wosbot.context['discovery_result'])
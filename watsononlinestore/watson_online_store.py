@@ -10,16 +10,35 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import functools
 import json
 import logging
 import os
 import random
 import re
+import threading
 import time
 
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+try:
+    from sys import intern
+except ImportError:  # Python 2
+    pass
+
+from watsononlinestore.database import cart_items
+from watsononlinestore.logs import category
+from watsononlinestore.logs import Payload
+from watsononlinestore import metrics
+from watsononlinestore.metrics import METRICS
+from watsononlinestore import rendering
+from watsononlinestore import resilience
+from watsononlinestore.runtime_config import RuntimeConfig
 from watsononlinestore.tests.fake_discovery import FAKE_DISCOVERY
 
-logging.basicConfig(level=logging.DEBUG)
 LOG = logging.getLogger(__name__)
 
 # Limit the result count when calling Discovery query.
@@ -30,22 +49,92 @@ DISCOVERY_QUERY_COUNT = 10
 DISCOVERY_KEEP_COUNT = 5
 # Truncate the Discovery 'text'. It can be a lot. We'll add "..." if truncated.
 DISCOVERY_TRUNCATE = 500
+# Most results one search shows, over all its pages.
+DISCOVERY_MAX_RESULTS = 50
+# "show me more", "more results", "next", ... while choosing an item.
+MORE_RESULTS = re.compile(r'^(?:show\s+(?:me\s+)?)?(?:some\s+)?(?:more|next)'
+                          r'(?:\s+(?:results|items|products|page))?[.!]*$')
+MORE_RESULTS_MESSAGE = "Here's more from Watson Discovery:"
+NO_MORE_RESULTS = ("That's all I found. Which item will you add to your "
+                   "cart?")
+# Related products suggested after an item is added to the cart.
+SIMILAR_COUNT = 3
+# Shown right away while a Discovery search runs, then replaced in place.
+SEARCHING_MESSAGE = "Searching..."
+# Seconds all remote calls for one message may take together.
+DEFAULT_LATENCY_BUDGET = 15.0
+# Most seconds one Conversation or Discovery call may take.
+SERVICE_TIMEOUT = 8.0
+# Successful calls slower than this still count against the breaker.
+SLOW_SERVICE_CALL = 5.0
+CONVERSATION_UNAVAILABLE = ("Sorry, I'm having trouble thinking right now. "
+                            "Please try again in a minute.")
+DISCOVERY_UNAVAILABLE = ("Sorry, product search isn't available right now. "
+                         "Please try again in a minute.")
+
+
+def intern_keys(context):
+    """ Intern the context's top-level keys in place, so the keys every
+        user's context shares are stored once instead of once per session.
+    """
+    for key in list(context):
+        if not isinstance(key, str):
+            continue
+        interned = intern(key)
+        if interned is not key:
+            context[interned] = context.pop(key)
 
 
 class SlackSender:
 
-    def __init__(self, slack_client, channel):
+    def __init__(self, slack_client, channel, outbox=None):
         self.slack_client = slack_client
         self.channel = channel
+        self.outbox = outbox
+        self.placeholder_ts = None
 
-    def send_message(self, message):
+    def send_placeholder(self, message):
+        """Post message now. The next message of the turn replaces it."""
+        if self.outbox:
+            self.outbox.acknowledge(self.channel, message)
+            return
+        response = self.slack_client.api_call("chat.postMessage",
+                                              channel=self.channel,
+                                              text=message,
+                                              as_user=True)
+        if isinstance(response, dict):
+            self.placeholder_ts = response.get('ts')
+
+    def send_message(self, message, attachments=None):
+        """Post message, with Slack attachments (a list of dicts) if any.
+        """
+        if self.outbox:
+            # Sent (and merged with the rest of the turn) in the background.
+            self.outbox.post(self.channel, message, attachments)
+            return
+        kwargs = {}
+        if attachments:
+            kwargs['attachments'] = json.dumps(attachments)
+        if self.placeholder_ts:
+            ts, self.placeholder_ts = self.placeholder_ts, None
+            self.slack_client.api_call("chat.update",
+                                       channel=self.channel,
+                                       ts=ts,
+                                       text=message,
+                                       as_user=True,
+                                       **kwargs)
+            return
         self.slack_client.api_call("chat.postMessage",
                                    channel=self.channel,
                                    text=message,
-                                   as_user=True)
+                                   as_user=True,
+                                   **kwargs)
 
 
-class OnlineStoreCustomer:
+class OnlineStoreCustomer(object):
+    # One per active user; no per-instance __dict__.
+    __slots__ = ('email', 'first_name', 'last_name', 'shopping_cart')
+
     def __init__(self, email=None, first_name=None, last_name=None,
                  shopping_cart=None):
 
@@ -67,45 +156,219 @@ class OnlineStoreCustomer:
         return customer
 
 
-class WatsonOnlineStore:
+class Session(object):
+    """ Dialog state for one Slack user.
+
+        export() returns plain data that can be pickled or JSON encoded
+        to hand the session to another process.
+    """
+    # One per user seen, so no per-instance __dict__.
+    __slots__ = ('user_id', 'context', 'customer', 'response_tuple',
+                 'discovery_finished_at', 'result_cursor')
+
+    def __init__(self, user_id=None):
+        self.user_id = user_id
+        self.context = {}
+        self.customer = None
+        self.response_tuple = None
+        # When the last Discovery query finished, until the follow-up reply
+        self.discovery_finished_at = None
+        # Where the last search stands: its query, the Discovery offset
+        # and cart number of its next result, the results fetched but not
+        # shown yet, and whether there are more. Replaced, not changed,
+        # so an export never sees one half updated.
+        self.result_cursor = None
+
+    def export(self):
+        customer = None
+        if self.customer:
+            customer = {'email': self.customer.email,
+                        'first_name': self.customer.first_name,
+                        'last_name': self.customer.last_name,
+                        'shopping_cart': self.customer.shopping_cart}
+        return {'user_id': self.user_id,
+                'context': self.context,
+                'customer': customer,
+                'response_tuple': self.response_tuple,
+                'discovery_finished_at': self.discovery_finished_at,
+                'result_cursor': self.result_cursor}
+
+    @classmethod
+    def from_export(cls, data):
+        session = cls(data['user_id'])
+        session.context = data['context']
+        if data['customer']:
+            session.customer = OnlineStoreCustomer(**data['customer'])
+        session.response_tuple = data['response_tuple']
+        session.discovery_finished_at = data['discovery_finished_at']
+        # Sessions saved before paging have no cursor.
+        session.result_cursor = data.get('result_cursor')
+        return session
+
+
+def _session_attribute(name):
+    """ A WatsonOnlineStore attribute stored on the current session.
+    """
+    return property(lambda self: getattr(self.session, name),
+                    lambda self, value: setattr(self.session, name, value))
+
+
+def _config_attribute(name):
+    """ A WatsonOnlineStore tunable read from the turn's RuntimeConfig.
+    """
+    def get(self):
+        return getattr(self.pinned_config or self.config, name)
+
+    def set(self, value):
+        self.config = self.config.replace(**{name: value})
+    return property(get, set)
+
+
+class WatsonOnlineStore(object):
     def __init__(self, bot_id, slack_client,
                  conversation_client, discovery_client,
-                 cloudant_online_store):
+                 online_store, slack_outbox=None, environ=None):
+        """ environ holds the settings (os.environ unless given).
+        """
+        environ = os.environ if environ is None else environ
+        # Name of the tenant this store serves, when one process hosts
+        # several; its metrics are also recorded under its name.
+        self.tenant = None
 
         # specific for Slack as UI
         self.bot_id = bot_id
         self.slack_client = slack_client
         self.at_bot = "<@" + bot_id + ">"
+        # Optional SlackOutbox so Slack writes leave the critical path
+        self.slack_outbox = slack_outbox
+        # Optional AdmissionController that bounds and merges inbound work
+        self.admission = None
+        # Optional SessionSnapshots that keep sessions across restarts
+        self.session_snapshots = None
+        # Optional catalog.similar.SimilarProducts for cart suggestions
+        self.similar_products = None
+        # Optional profiling.Profiler for on-demand and slow-message profiles
+        self.profiler = None
+        # Optional memory.MemoryTracker for tracemalloc diagnostics
+        self.memory_tracker = None
 
         # IBM Watson Conversation
         self.conversation_client = conversation_client
         self.discovery_client = discovery_client
-        self.workspace_id = self.setup_conversation_workspace(
-            conversation_client, os.environ)
+        workspace_id = self.setup_conversation_workspace(
+            conversation_client, environ)
 
-        # IBM Cloudant noSQL database
-        self.cloudant_online_store = cloudant_online_store
+        # Customer and shopping cart storage (Cloudant, SQLite, ...)
+        self.online_store = online_store
 
         # IBM Discovery Service
-        self.discovery_environment_id = os.environ.get(
+        self.discovery_environment_id = environ.get(
             'DISCOVERY_ENVIRONMENT_ID')
-        self.discovery_collection_id = os.environ.get(
+        self.discovery_collection_id = environ.get(
             'DISCOVERY_COLLECTION_ID')
 
         try:
-            self.discovery_score_filter = float(os.environ.get(
+            discovery_score_filter = float(environ.get(
                 "DISCOVERY_SCORE_FILTER", 0))
         except ValueError:
             LOG.error("DISCOVERY_SCORE_FILTER must be a number between " +
                       "0.0 and 1.0. Using default value of 0.0")
-            self.discovery_score_filter = 0
+            discovery_score_filter = 0
             pass
 
-        self.context = {}
-        self.customer = None
-        self.response_tuple = None
+        # Conversation and Discovery calls get deadlines from a per-message
+        # latency budget, hedging and circuit breakers.
+        try:
+            latency_budget = float(environ.get(
+                "MESSAGE_LATENCY_BUDGET", DEFAULT_LATENCY_BUDGET))
+        except ValueError:
+            LOG.error("MESSAGE_LATENCY_BUDGET must be a number of seconds. "
+                      "Using default value of {}".format(
+                          DEFAULT_LATENCY_BUDGET))
+            latency_budget = DEFAULT_LATENCY_BUDGET
+        self.budget = None
+
+        # Cached product cards and cart listings.
+        self.renderer = rendering.Renderer()
+        # Block Kit results for the turn's reply that presents them.
+        self.result_attachments = None
+        # Background fetches of the next page of results: an event per
+        # user, set once theirs is done, and the (session, cursor, config,
+        # done) jobs for the one worker thread that runs them.
+        self.prefetches = {}
+        self.prefetch_jobs = queue.Queue()
+        self.prefetch_worker = None
+        self.cursor_lock = threading.Lock()
+
+        # Tunables that a ConfigWatcher may replace while we run. A turn
+        # pins the config it starts with until it finishes.
+        self.config = RuntimeConfig(
+            workspace_id=workspace_id,
+            discovery_score_filter=discovery_score_filter,
+            latency_budget=latency_budget)
+        self.pinned_config = None
+        self.config_watcher = None
+        self.conversation_caller = resilience.ResilientCaller(
+            'conversation', timeout=SERVICE_TIMEOUT,
+            breaker=resilience.CircuitBreaker(
+                'conversation', slow_call=SLOW_SERVICE_CALL),
+            fallback=self.conversation_unavailable)
+        self.discovery_caller = resilience.ResilientCaller(
+            'discovery', timeout=SERVICE_TIMEOUT,
+            breaker=resilience.CircuitBreaker(
+                'discovery', slow_call=SLOW_SERVICE_CALL))
+
+        # Sessions by Slack user ID. self.session is the one being served;
+        # context, customer etc. below read and write it.
+        self.sessions = {}
+        self.session = Session()
         self.delay = 0.5  # second
 
+    workspace_id = _config_attribute('workspace_id')
+    discovery_score_filter = _config_attribute('discovery_score_filter')
+    latency_budget = _config_attribute('latency_budget')
+
+    context = _session_attribute('context')
+    customer = _session_attribute('customer')
+    response_tuple = _session_attribute('response_tuple')
+    discovery_finished_at = _session_attribute('discovery_finished_at')
+    result_cursor = _session_attribute('result_cursor')
+
+    def session_for(self, user_id):
+        """ Get or create the session for a Slack user.
+
+            The first time a user is seen after a restart, their session
+            is restored from the latest snapshot.
+        """
+        session = self.sessions.get(user_id)
+        if session is None:
+            data = None
+            if self.session_snapshots:
+                data = self.session_snapshots.load(user_id)
+            if data:
+                session = Session.from_export(data)
+                METRICS.incr('session.restored')
+            else:
+                session = Session(user_id)
+            self.sessions[user_id] = session
+        return session
+
+    def export_sessions(self, user_ids):
+        """ Remove the sessions for user_ids and return them as plain data,
+            to hand over to the process that serves those users next.
+        """
+        exported = []
+        for user_id in user_ids:
+            session = self.sessions.pop(user_id, None)
+            if session is not None:
+                exported.append(session.export())
+        return exported
+
+    def import_sessions(self, exported):
+        for data in exported:
+            session = Session.from_export(data)
+            self.sessions[session.user_id] = session
+
     @staticmethod
     def setup_conversation_workspace(conversation_client, environ):
         """Verify and/or initialize the conversation workspace.
@@ -135,7 +398,7 @@ class WatsonOnlineStore:
         if env_workspace_id:
             # Optionally, we have an env var to give us a WORKSPACE_ID.
             # If one was set in the env, require that it can be found.
-            LOG.debug("Using WORKSPACE_ID=%s" % env_workspace_id)
+            LOG.debug("Using WORKSPACE_ID=%s", env_workspace_id)
             for workspace in workspaces:
                 if workspace['workspace_id'] == env_workspace_id:
                     ret = env_workspace_id
@@ -150,8 +413,8 @@ class WatsonOnlineStore:
             for workspace in workspaces:
                 if workspace['name'] == name:
                     ret = workspace['workspace_id']
-                    LOG.debug("Found WORKSPACE_ID=%(id)s using lookup by "
-                              "name=%(name)s" % {'id': ret, 'name': name})
+                    LOG.debug("Found WORKSPACE_ID=%s using lookup by "
+                              "name=%s", ret, name)
                     break
             else:
                 # Not found, so create it.
@@ -167,8 +430,7 @@ class WatsonOnlineStore:
                     counterexamples=workspace['counterexamples'],
                     metadata=workspace['metadata'])
                 ret = created['workspace_id']
-                LOG.debug("Created WORKSPACE_ID=%(id)s with "
-                          "name=%(name)s" % {'id': ret, 'name': name})
+                LOG.debug("Created WORKSPACE_ID=%s with name=%s", ret, name)
         return ret
 
     @staticmethod
@@ -178,11 +440,15 @@ class WatsonOnlineStore:
         return workspace
 
     def context_merge(self, dict1, dict2):
-        new_dict = dict1.copy()
-        if dict2:
-            new_dict.update(dict2)
+        """ Merge dict2 into dict1 in place and return dict1.
 
-        return new_dict
+            The context belongs to the session alone (Conversation returns
+            a new one each turn, and snapshots encode it right away), so
+            there is no need to copy it on every merge.
+        """
+        if dict2:
+            dict1.update(dict2)
+        return dict1
 
     def parse_slack_output(self, output_list):
         if output_list and len(output_list) > 0:
@@ -204,6 +470,9 @@ class WatsonOnlineStore:
         return None, None, None
 
     def post_to_slack(self, response, channel):
+        if self.slack_outbox:
+            self.slack_outbox.post(channel, response)
+            return
         self.slack_client.api_call("chat.postMessage",
                                    channel=channel,
                                    text=response,
@@ -212,14 +481,14 @@ class WatsonOnlineStore:
     def add_customer_to_context(self):
         """ We have a customer, send info to Watson
 
-           The customer data from the UI is in the Cloudant DB, or has
+           The customer data from the UI is in the store DB, or has
             been added. Now add it to the context and pass back to Watson.
         """
         self.context = self.context_merge(self.context,
                                           self.customer.get_customer_dict())
 
     def customer_from_db(self, user_data):
-        """ Set the customer using data from Cloudant DB
+        """ Set the customer using data from the store DB
         """
 
         email_addr = user_data['email']
@@ -264,20 +533,22 @@ class WatsonOnlineStore:
             return
 
         # Not found returns json with error.
-        LOG.debug("user_from_slack:\n{}\n".format(user_json))
+        LOG.debug("user_from_slack:\n%s\n", Payload(user_json),
+                  extra=category('slack_user'))
 
         if user_json and 'user' in user_json:
             cust = user_json['user'].get('profile', {}).get('email')
             if cust:
-                user_data = self.cloudant_online_store.find_customer(cust)
+                user_data = self.online_store.find_customer(cust)
                 if user_data:
-                    # We found this Slack user in our Cloudant DB
-                    LOG.debug("user_from_DB\n{}\n".format(user_data))
+                    # We found this Slack user in our store DB
+                    LOG.debug("user_from_DB\n%s\n", Payload(user_data),
+                              extra=category('store'))
                     self.customer_from_db(user_data)
                 else:
                     # Didn't find Slack user in DB, so add them
                     self.create_user_from_ui(user_json)
-                    self.cloudant_online_store.add_customer_obj(self.customer)
+                    self.online_store.add_customer_obj(self.customer)
 
             if self.customer:
                 # Now Watson will have customer info
@@ -288,148 +559,308 @@ class WatsonOnlineStore:
         ret_string = {'discovery_result': FAKE_DISCOVERY[index]}
         return ret_string
 
-    def handle_DiscoveryQuery(self):
+    def handle_DiscoveryQuery(self, sender=None):
         """ Do a Discovery query
+
+            With a sender, post a placeholder first. The reply to the
+            follow-up turn replaces it once the results are in.
         """
         query_string = self.context['discovery_string']
+        if sender:
+            sender.send_placeholder(SEARCHING_MESSAGE)
+        started = time.time()
         if self.discovery_client:
             try:
                 response = self.get_discovery_response(query_string)
-            except Exception as e:
-                response = {'discovery_result': repr(e)}
+            except resilience.ServiceUnavailable:
+                response = {'discovery_result': DISCOVERY_UNAVAILABLE}
+            except Exception:
+                LOG.exception("Discovery response failed:")
+                response = {'discovery_result': DISCOVERY_UNAVAILABLE}
         else:
             response = self.get_fake_discovery_response(query_string)
+        self.discovery_finished_at = time.time()
+        METRICS.observe('search.discovery_seconds',
+                        self.discovery_finished_at - started)
 
         self.context = self.context_merge(self.context, response)
-        LOG.debug("watson_discovery:\n{}\ncontext:\n{}".format(
-                   response, self.context))
+        LOG.debug("watson_discovery:\n%s\ncontext:\n%s", Payload(response),
+                  Payload(self.context), extra=category('discovery'))
 
         # no need for user input, return to Watson Dialogue
         return False
 
     def get_watson_response(self, message):
-        response = self.conversation_client.message(
+        response = self.conversation_caller.call(
+            self.conversation_client.message,
+            self.budget,
             workspace_id=self.workspace_id,
             message_input={'text': message},
             context=self.context)
         return response
 
     @staticmethod
-    def format_discovery_response(response):
-        """Specific to ibm_store_html data
+    def conversation_unavailable(**kwargs):
+        """ Reply used when Conversation fails, times out or its breaker
+            is open. The dialog context is left as it was.
+        """
+        return {'output': {'text': [CONVERSATION_UNAVAILABLE]},
+                'fallback': True}
+
+    @staticmethod
+    def format_discovery_response(response, renderer=None,
+                                  keep=DISCOVERY_KEEP_COUNT, first_number=1):
+        """Specific to the IBM Logo Store data. Results are either the
+           compact documents from tools/preprocess_ibm_store.py, with the
+           fields ready to use, or raw ibm_store_html pages to dig them
+           out of. With a rendering.Renderer, each product's card is made
+           once and reused while its document is unchanged.
+
+           The first keep results (all if None) are numbered from
+           first_number.
         """
         output = []
         if not ('results' in response and response['results']):
             return output
 
-        def slack_encode(input_text):
-            """Slack does not like <, &, >. That's all."""
-
-            if not input_text:
-                return input_text
-
-            args = [('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;')]
-            for from_to in args:
-                input_text = input_text.replace(*from_to)
-
-            return input_text
-
         results = response['results']
+        if keep is not None:
+            results = results[:keep]
+
+        for i, result in enumerate(results):
+            make = functools.partial(WatsonOnlineStore._product_card, result)
+            if 'product_id' in result:
+                key = result['product_id']
+                source = (result.get('title'), result.get('url'),
+                          result.get('image_url'))
+            else:
+                key = result.get('id')
+                source = (result.get('html'), result.get('text'))
+            if renderer and key:
+                card = renderer.card(key, source, make)
+            else:
+                card = make()
+            product_data = dict(card, cart_number=str(first_number + i))
+            output.append(product_data)
 
-        cart_number = 1
+        return output
+
+    @staticmethod
+    def _product_card(result):
+        """ The card (see rendering.product_card) of one Discovery result.
+        """
         href_tag = "/ProductDetail.aspx?pid="
         img_tag = '<a class="jqzoom" href="'
         product_tag = "Product:"
         category_tag = "Category:"
         url_start = "http://www.logostore-globalid.us"
 
-        for i in range(min(len(results), DISCOVERY_KEEP_COUNT)):
-            result = results[i]
-
-            product_name = ""
-            product_url = ""
-            img_url = ""
-
-            # Pull out product number so that we can build url link.
-            if 'html' in result:
-                html = result['html']
-                sidx = html.find(href_tag)
-                if sidx > 0:
-                    sidx += len(href_tag)
-                    product_id = html[sidx:sidx+6]
-                    product_url = url_start + href_tag + product_id
-
-                # grab the image url to allow pictures in slack
-                simg = html.find(img_tag)
-                if simg > 0:
-                    simg += len(img_tag)
-                    eimg = html.find('"', simg)
-                    if eimg > 0:
-                        img = html[simg:eimg]
-                        # shrink the picture
-                        img_url = re.sub(
-                            r'scale\[[0-9]+\]', 'scale[50]', img)
-
-            # Pull out product name from page text.
-            if 'text' in result:
-                text = result['text']
-                sidx = text.find(product_tag)
-                if sidx > 0:
-                    sidx += len(product_tag)
-                    eidx = text.find(category_tag, sidx, len(text))
-                    if eidx > 0:
-                        product_name = text[sidx:eidx-1]
-
-            product_data = {"cart_number": str(cart_number),
-                            "name": slack_encode(product_name),
-                            "url": slack_encode(product_url),
-                            "image": slack_encode(img_url),
-                            }
-            cart_number += 1
-            output.append(product_data)
-
-        return output
+        product_name = ""
+        product_id = ""
+        product_url = ""
+        img_url = ""
+
+        if 'product_id' in result:
+            product_id = result['product_id']
+            product_name = result.get('title') or ""
+            product_url = (result.get('url') or
+                           url_start + href_tag + product_id)
+            img_url = re.sub(r'scale\[[0-9]+\]', 'scale[50]',
+                             result.get('image_url') or "")
+
+        # Pull out product number so that we can build url link.
+        elif 'html' in result:
+            html = result['html']
+            sidx = html.find(href_tag)
+            if sidx > 0:
+                sidx += len(href_tag)
+                product_id = html[sidx:sidx+6]
+                product_url = url_start + href_tag + product_id
+
+            # grab the image url to allow pictures in slack
+            simg = html.find(img_tag)
+            if simg > 0:
+                simg += len(img_tag)
+                eimg = html.find('"', simg)
+                if eimg > 0:
+                    img = html[simg:eimg]
+                    # shrink the picture
+                    img_url = re.sub(
+                        r'scale\[[0-9]+\]', 'scale[50]', img)
+
+        # Pull out product name from page text.
+        if 'text' in result and not product_name:
+            text = result['text']
+            sidx = text.find(product_tag)
+            if sidx > 0:
+                sidx += len(product_tag)
+                eidx = text.find(category_tag, sidx, len(text))
+                if eidx > 0:
+                    product_name = text[sidx:eidx-1]
+
+        return rendering.product_card(product_id, product_name,
+                                      product_url, img_url)
 
     def get_discovery_response(self, input_text):
-
-        discovery_response = self.discovery_client.query(
+        """ Search for input_text and keep the first page of results.
+            The other results fetched are kept in the session's
+            result_cursor for "show me more".
+        """
+        cursor = self.fetch_results({'query': input_text, 'offset': 0,
+                                     'next_number': 1, 'pending': [],
+                                     'exhausted': False},
+                                    self.budget)
+        response = cursor['pending'][:DISCOVERY_KEEP_COUNT]
+        self.response_tuple = response
+        cursor = dict(cursor, pending=cursor['pending'][DISCOVERY_KEEP_COUNT:])
+        self.set_result_cursor(self.session, cursor)
+        if (len(cursor['pending']) < DISCOVERY_KEEP_COUNT and
+                not cursor['exhausted']):
+            self.prefetch_results(self.session, cursor)
+        # Shown with the reply that presents the results.
+        self.result_attachments = rendering.result_attachments(response)
+
+        return {'discovery_result': rendering.result_listing(response)}
+
+    def fetch_results(self, cursor, budget=None, config=None):
+        """ Fetch the next DISCOVERY_QUERY_COUNT results of a search.
+            config is the RuntimeConfig to filter with (the turn's unless
+            given).
+            Returns: a new cursor with them added to its pending results
+        """
+        score_filter = (config.discovery_score_filter if config else
+                        self.discovery_score_filter)
+        discovery_response = self.discovery_caller.call(
+            self.discovery_client.query,
+            budget,
             environment_id=self.discovery_environment_id,
             collection_id=self.discovery_collection_id,
-            query_options={'query': input_text, 'count': DISCOVERY_QUERY_COUNT}
+            query_options={'query': cursor['query'],
+                           'count': DISCOVERY_QUERY_COUNT,
+                           'offset': cursor['offset']}
         )
+        results = discovery_response.get('results') or []
+        # A short page is the last one.
+        exhausted = len(results) < DISCOVERY_QUERY_COUNT
 
         # Watson discovery assigns a confidence level to each result.
         # Based on data mix, we can assign a minimum tolerance value in an
         # attempt to filter out the "weakest" results.
-        if self.discovery_score_filter and 'results' in discovery_response:
+        if score_filter and 'results' in discovery_response:
             fr = [x for x in discovery_response['results'] if 'score' in x and
-                  x['score'] > self.discovery_score_filter]
+                  x['score'] > score_filter]
 
+            # Results come best first, so later pages score lower still.
+            exhausted = exhausted or len(fr) < len(results)
             discovery_response['matching_results'] = len(fr)
             discovery_response['results'] = fr
 
-        response = self.format_discovery_response(discovery_response)
-        self.response_tuple = response
-
-        formatted_response = ""
-        for item in response:
-            formatted_response += "\n" + item['cart_number'] + ") " + \
-                                  item['name'] + \
-                                  "\n" + item['image']  # "\n" + item['url']
-
-        return {'discovery_result': formatted_response}
+        keep = max(DISCOVERY_MAX_RESULTS - cursor['next_number'] + 1, 0)
+        entries = self.format_discovery_response(
+            discovery_response, self.renderer, keep=keep,
+            first_number=cursor['next_number'])
+        next_number = cursor['next_number'] + len(entries)
+        return dict(cursor,
+                    offset=cursor['offset'] + DISCOVERY_QUERY_COUNT,
+                    next_number=next_number,
+                    pending=cursor['pending'] + entries,
+                    exhausted=(exhausted or
+                               next_number > DISCOVERY_MAX_RESULTS))
+
+    def set_result_cursor(self, session, cursor, replacing=None):
+        """ Set session's result cursor; with replacing, only if that
+            is still its cursor (a new search replaces a prefetched one).
+        """
+        with self.cursor_lock:
+            if replacing is None or session.result_cursor is replacing:
+                session.result_cursor = cursor
+
+    def prefetch_results(self, session, cursor):
+        """ Fetch the next page of results in the background, while the
+            user reads the current one. The session and config are taken
+            now, as self.session and self.config move on with later turns.
+        """
+        done = threading.Event()
+        with self.cursor_lock:
+            self.prefetches[session.user_id] = done
+            if self.prefetch_worker is None:
+                self.prefetch_worker = threading.Thread(
+                    target=self._run_prefetches, name='discovery-prefetch')
+                self.prefetch_worker.daemon = True
+                self.prefetch_worker.start()
+        self.prefetch_jobs.put(
+            (session, cursor, self.pinned_config or self.config, done))
+
+    def _run_prefetches(self):
+        while True:
+            session, cursor, config, done = self.prefetch_jobs.get()
+            with metrics.scope(self.tenant):
+                try:
+                    fetched = self.fetch_results(cursor, config=config)
+                except Exception:
+                    METRICS.incr('search.prefetch_errors')
+                    LOG.warning("Prefetching more results failed",
+                                exc_info=True)
+                else:
+                    METRICS.incr('search.prefetched')
+                    self.set_result_cursor(session, fetched,
+                                           replacing=cursor)
+                finally:
+                    done.set()
+                    with self.cursor_lock:
+                        if self.prefetches.get(session.user_id) is done:
+                            del self.prefetches[session.user_id]
+
+    def wants_more_results(self, message):
+        """ Whether message asks for more results while the user is
+            choosing one of them.
+        """
+        return bool(self.result_cursor and
+                    self.context.get('discovery_result') and
+                    MORE_RESULTS.match(message.strip()))
+
+    def handle_more_results(self, sender):
+        """ Show the next page of the last search's results, numbered
+            after those already shown, so any of them can be added to the
+            cart by number. The dialog keeps waiting for that number.
+        """
+        with self.cursor_lock:
+            prefetch = self.prefetches.pop(self.session.user_id, None)
+        if prefetch:
+            # Usually done: it started when the last page was shown.
+            timeout = self.budget.remaining() if self.budget else None
+            prefetch.wait(timeout)
+        cursor = self.result_cursor
+        if not cursor['pending'] and not cursor['exhausted']:
+            try:
+                cursor = self.fetch_results(cursor, self.budget)
+            except Exception:
+                LOG.exception("Fetching more results failed:")
+                sender.send_message(DISCOVERY_UNAVAILABLE)
+                return
+        page = cursor['pending'][:DISCOVERY_KEEP_COUNT]
+        cursor = dict(cursor, pending=cursor['pending'][DISCOVERY_KEEP_COUNT:])
+        self.set_result_cursor(self.session, cursor)
+        if not page:
+            sender.send_message(NO_MORE_RESULTS)
+            return
+        METRICS.incr('search.more_pages')
+        self.response_tuple = (self.response_tuple or []) + page
+        sender.send_message(
+            MORE_RESULTS_MESSAGE + rendering.result_listing(page) + "\n",
+            rendering.result_attachments(page))
+        if (len(cursor['pending']) < DISCOVERY_KEEP_COUNT and
+                not cursor['exhausted']):
+            self.prefetch_results(self.session, cursor)
 
     def handle_list_shopping_cart(self):
         """ Get shopping_cart from DB and return to Watson
             Returns: list of shopping_cart items
         """
         cust = self.customer.email
-        formatted_out = ""
-        shopping_list = self.cloudant_online_store.list_shopping_cart(cust)
-        for index, item in enumerate(shopping_list):
-            formatted_out += str(index+1) + ") " + str(item) + "\n"
-
-        self.context['shopping_cart'] = formatted_out
+        shopping_list = self.online_store.list_shopping_cart(cust)
+        self.context['shopping_cart'] = self.renderer.cart_listing(
+            cust, shopping_list)
 
         # no need for user input, return to Watson Dialogue
         return False
@@ -442,24 +873,27 @@ class WatsonOnlineStore:
         """ Delete an item from this Customers shopping cart
         """
         email = self.customer.email
-        shopping_list = self.cloudant_online_store.list_shopping_cart(email)
+        shopping_list = self.online_store.list_shopping_cart(email)
         try:
             item_num = int(self.context['cart_item'])
         except ValueError:
             LOG.exception("cart_item must be a number")
             return False
 
-        for index, item in enumerate(shopping_list):
-            if index+1 == item_num:
-                self.cloudant_online_store.delete_item_shopping_cart(email,
-                                                                     item)
+        if 0 < item_num <= len(shopping_list):
+            item = shopping_list[item_num-1]
+            self.online_store.delete_item_shopping_cart(email,
+                                                        item['product_id'])
         self.clear_shopping_cart()
 
         # no need for user input, return to Watson Dialogue
         return False
 
-    def handle_add_to_cart(self):
+    def handle_add_to_cart(self, sender=None):
         """ Add an item to this Customers shopping cart
+
+            With a sender and similar products loaded, products like the
+            one added are suggested right away.
         """
         try:
             cart_item = int(self.context['cart_item'])
@@ -468,15 +902,31 @@ class WatsonOnlineStore:
             return False
         email = self.customer.email
 
-        for index, entry in enumerate(self.response_tuple):
-            if index+1 == cart_item:
-                item = entry['name'] + ': ' + entry['url'] + '\n'
-                self.cloudant_online_store.add_to_shopping_cart(email, item)
+        if self.response_tuple and 0 < cart_item <= len(self.response_tuple):
+            entry = self.response_tuple[cart_item-1]
+            # Results without a product ID are keyed by name instead, as
+            # are those in sessions saved before results had one.
+            item = cart_items.new_item(entry.get('product_id') or
+                                       entry['name'],
+                                       entry['name'], entry['url'])
+            self.online_store.add_to_shopping_cart(email, item)
+            if sender and self.similar_products:
+                self.suggest_similar(item['product_id'], sender)
         self.clear_shopping_cart()
 
         # no need for user input, return to Watson Dialogue
         return False
 
+    def suggest_similar(self, product_id, sender):
+        similar = self.similar_products.similar(product_id, SIMILAR_COUNT)
+        if not similar:
+            return
+        METRICS.incr('similar.suggested')
+        lines = ["You might also like:"]
+        lines.extend("- " + product['name'] + ": " + product['url']
+                     for product in similar)
+        sender.send_message("\n".join(lines))
+
     def handle_message(self, message, sender):
         """ Handler for messages.
             param: message from UI (slackbot)
@@ -487,19 +937,29 @@ class WatsonOnlineStore:
         """
 
         watson_response = self.get_watson_response(message)
-        LOG.debug("watson_response:\n{}\n".format(watson_response))
+        LOG.debug("watson_response:\n%s\n", Payload(watson_response),
+                  extra=category('watson_response'))
         if 'context' in watson_response:
+            intern_keys(watson_response['context'])
             self.context = watson_response['context']
 
-        response = ''
-        for text in watson_response['output']['text']:
-            response += text + "\n"
+        response = ''.join([text + "\n"
+                            for text in watson_response['output']['text']])
 
-        sender.send_message(response)
+        attachments, self.result_attachments = self.result_attachments, None
+        sender.send_message(response, attachments)
+        if watson_response.get('fallback'):
+            # Wait for the user to try again.
+            return True
+        if self.discovery_finished_at is not None:
+            # This was the follow-up turn that presents Discovery results.
+            METRICS.observe('search.followup_seconds',
+                            time.time() - self.discovery_finished_at)
+            self.discovery_finished_at = None
 
         if ('discovery_string' in self.context.keys() and
            self.context['discovery_string'] and self.discovery_client):
-            return self.handle_DiscoveryQuery()
+            return self.handle_DiscoveryQuery(sender)
 
         if ('shopping_cart' in self.context.keys() and
                 self.context['shopping_cart'] == 'list'):
@@ -509,7 +969,7 @@ class WatsonOnlineStore:
                 self.context['shopping_cart'] == 'add' and
             'cart_item' in self.context.keys() and
                 self.context['cart_item'] != ''):
-            return self.handle_add_to_cart()
+            return self.handle_add_to_cart(sender)
 
         if ('shopping_cart' in self.context.keys() and
                 self.context['shopping_cart'] == 'delete' and
@@ -523,30 +983,111 @@ class WatsonOnlineStore:
 
         return True
 
-    def run(self):
+    def process_slack_output(self, slack_output):
+        """ Take a batch of Slack events, from RTM or the Events API.
+        """
+        with metrics.scope(self.tenant):
+            if self.admission:
+                self.admission.offer(slack_output)
+            else:
+                self.handle_slack_output(slack_output)
+
+    def handle_slack_output(self, slack_output):
+        """ Handle the bot's message in a batch of Slack events.
+        """
+        with metrics.scope(self.tenant):
+            self._handle_slack_output(slack_output)
+
+    def _handle_slack_output(self, slack_output):
+        message, channel, user = self.parse_slack_output(slack_output)
+        if user:
+            self.session = self.session_for(user)
+        if user and not self.customer:
+            self.init_customer(user)
+
+        if message:
+            LOG.debug("message:\n %s\n channel:\n %s\n", Payload(message),
+                      channel, extra=category('message'))
+        if message and channel:
+            sender = SlackSender(self.slack_client, channel,
+                                 self.slack_outbox)
+            if self.slack_outbox:
+                self.slack_outbox.begin_turn(channel)
+            self.pinned_config = self.config
+            self.budget = resilience.LatencyBudget(self.latency_budget)
+            try:
+                if self.profiler:
+                    with self.profiler.message(user):
+                        self.handle_turn(message, sender)
+                else:
+                    self.handle_turn(message, sender)
+            finally:
+                self.budget = None
+                self.pinned_config = None
+                self.result_attachments = None
+                if self.slack_outbox:
+                    self.slack_outbox.end_turn(channel)
+                if self.session_snapshots and user:
+                    self.session_snapshots.put(user, self.session.export())
+
+    def handle_turn(self, message, sender):
+        """ Handle message until the dialog waits for the user again.
+        """
+        if self.wants_more_results(message):
+            self.handle_more_results(sender)
+            return
+        get_input = self.handle_message(message, sender)
+        while not get_input:
+            get_input = self.handle_message(message, sender)
+
+    def start_services(self):
         # make sure DB exists
-        self.cloudant_online_store.init()
+        self.online_store.init()
+        if self.slack_outbox:
+            self.slack_outbox.start()
+        if self.session_snapshots:
+            self.session_snapshots.init()
+            self.session_snapshots.start()
+        if self.admission:
+            self.admission.start()
+        if self.config_watcher:
+            self.config_watcher.start()
+        if self.memory_tracker:
+            self.memory_tracker.start()
+
+    def stop_services(self):
+        """ Finish queued work and save sessions before exiting.
+        """
+        if self.memory_tracker:
+            self.memory_tracker.stop()
+        if self.config_watcher:
+            self.config_watcher.stop()
+        if self.admission:
+            self.admission.stop()
+        if self.session_snapshots:
+            self.session_snapshots.stop()
+        # No turns are running any more, so no new cart writes arrive.
+        self.online_store.stop(timeout=5)
+        if self.slack_outbox:
+            self.slack_outbox.stop(timeout=5)
+
+    def run(self):
+        self.start_services()
 
         if self.slack_client.rtm_connect():
             LOG.info("Watson Online Store bot is connected and running!")
-            while True:
-                slack_output = self.slack_client.rtm_read()
-                if slack_output:
-                    LOG.debug("slack output\n:{}\n".format(slack_output))
-
-                message, channel, user = self.parse_slack_output(slack_output)
-                if user and not self.customer:
-                    self.init_customer(user)
-
-                if message:
-                    LOG.debug("message:\n %s\n channel:\n %s\n" %
-                              (message, channel))
-                if message and channel:
-                    sender = SlackSender(self.slack_client, channel)
-                    get_input = self.handle_message(message, sender)
-                    while not get_input:
-                        get_input = self.handle_message(message, sender)
-
-                time.sleep(self.delay)
+            try:
+                while True:
+                    slack_output = self.slack_client.rtm_read()
+                    if slack_output:
+                        LOG.debug("slack output\n:%s\n",
+                                  Payload(slack_output),
+                                  extra=category('slack_batch'))
+
+                    self.process_slack_output(slack_output)
+
+                    time.sleep(self.delay)
+            finally:
+                self.stop_services()
         else:
             LOG.warning("Connection failed. Invalid Slack token or bot ID?")